@@ -0,0 +1,149 @@
+"""Benchmark for the API's admission control: latency of control commands
+(pause/resume) while slow catalogue requests saturate the server, with
+every function in one lane and with priority lanes, and what is shed.
+
+A few clients send control commands at a steady pace and time them,
+against an SLO; many others ask for a slow catalogue listing as fast as
+they can. Then one client goes over its rate limit.
+
+    python bench_admission.py --catalogue-clients 32 --slow-ms 50 --duration 10
+"""
+import os
+import sys
+import time
+import httplib
+import argparse
+import threading
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from api_server import EventLoopHTTPServer
+
+
+def percentile( sorted_vals, pct ):
+    if not sorted_vals:
+        return float( 'nan' )
+    indx = min( len( sorted_vals ) - 1, int( round( pct / 100.0 * (len( sorted_vals ) - 1) ) ) )
+    return sorted_vals[indx]
+
+
+class DummyController( object ):
+
+    def __init__( self, slow_secs ):
+        self.slow_secs = slow_secs
+        self.playing = False
+
+    def do_get_playlists( self, qargs_dict ):
+        time.sleep( self.slow_secs )
+        return [ 'Playlist %d' % i for i in xrange( 100 ) ]
+
+    def do_set_playback_enabled( self, qargs_dict ):
+        self.playing = not self.playing
+
+
+def make_server( controller, lanes ):
+    httpd = EventLoopHTTPServer( ('127.0.0.1', 0), controller )
+    httpd.register_api_function( 'get_playlists', controller.do_get_playlists, 'GET',
+                                 priority='bulk' if lanes else 'interactive' )
+    httpd.register_api_function( 'set_playback_enabled', controller.do_set_playback_enabled, 'PUT',
+                                 priority='control' if lanes else 'interactive' )
+    return httpd
+
+
+def request( conn, method, path ):
+    conn.request( method, path, '' if method == 'PUT' else None )
+    resp = conn.getresponse()
+    resp.read()
+    return resp.status, resp.getheader( 'Retry-After' )
+
+
+def catalogue_client( port, deadline, statuses ):
+    conn = httplib.HTTPConnection( '127.0.0.1', port, timeout=30 )
+    while time.time() < deadline:
+        status, retry_after = request( conn, 'GET', '/get_playlists' )
+        statuses.append( ( status, retry_after ) )
+        if status == 503:
+            # A well-behaved client would wait Retry-After; this one only
+            # backs off a little, to keep the pressure on
+            time.sleep( 0.01 )
+
+
+def control_client( port, deadline, interval, latencies, failures ):
+    conn = httplib.HTTPConnection( '127.0.0.1', port, timeout=30 )
+    while time.time() < deadline:
+        t0 = time.time()
+        status, retry_after = request( conn, 'PUT', '/set_playback_enabled' )
+        if status == 200:
+            latencies.append( time.time() - t0 )
+        else:
+            failures.append( status )
+        time.sleep( interval )
+
+
+def run( lanes, args ):
+    httpd = make_server( DummyController( args.slow_ms / 1000.0 ), lanes )
+    port = httpd.server_address[1]
+    server = threading.Thread( target=httpd.serve_forever )
+    server.start()
+
+    deadline = time.time() + args.duration
+    latencies, failures, statuses = [], [], []
+    clients = [ threading.Thread( target=catalogue_client, args=( port, deadline, statuses ) )
+                for i in xrange( args.catalogue_clients ) ]
+    clients += [ threading.Thread( target=control_client, args=( port, deadline, 0.05, latencies, failures ) )
+                 for i in xrange( args.control_clients ) ]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    httpd.shutdown()
+    server.join()
+
+    latencies.sort()
+    within = sum( 1 for l in latencies if l * 1000 <= args.slo_ms ) / float( max( 1, len( latencies ) ) )
+    served = sum( 1 for status, retry_after in statuses if status == 200 )
+    shed = [ retry_after for status, retry_after in statuses if status == 503 ]
+    print "%-15s control p50 %7.1f ms  p99 %7.1f ms  max %7.1f ms  within %d ms: %5.1f%%  failed %d" % (
+        'priority lanes' if lanes else 'one lane', percentile( latencies, 50 ) * 1000,
+        percentile( latencies, 99 ) * 1000, latencies[-1] * 1000 if latencies else float( 'nan' ),
+        args.slo_ms, within * 100, len( failures ) )
+    print "%-15s catalogue served %5.1f/s, shed %5.1f/s (Retry-After %s)" % (
+        '', served / args.duration, len( shed ) / args.duration, shed[0] if shed else '-' )
+
+
+def rate_limit( args ):
+    """One client at 50 requests a second against a limit of 10 a second,
+    in bursts of 20, over 3 seconds."""
+    httpd = make_server( DummyController( 0 ), True )
+    httpd.set_rate_limits( { 'control': ( 10, 20 ) }, exempt=() )
+    port = httpd.server_address[1]
+    server = threading.Thread( target=httpd.serve_forever )
+    server.start()
+    conn = httplib.HTTPConnection( '127.0.0.1', port, timeout=10 )
+    counts = {}
+    retry_afters = set()
+    deadline = time.time() + 3
+    while time.time() < deadline:
+        status, retry_after = request( conn, 'PUT', '/set_playback_enabled' )
+        counts[status] = counts.get( status, 0 ) + 1
+        if retry_after:
+            retry_afters.add( retry_after )
+        time.sleep( 0.02 )
+    httpd.shutdown()
+    server.join()
+    print "Rate limit of 10/s, burst 20, at ~50/s for 3 s: %d accepted, %d refused with 429 (Retry-After %s)" % (
+        counts.get( 200, 0 ), counts.get( 429, 0 ), ', '.join( sorted( retry_afters ) ) or '-' )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--catalogue-clients', type=int, default=32 )
+    parser.add_argument( '--control-clients', type=int, default=2 )
+    parser.add_argument( '--slow-ms', type=float, default=50.0, help="time taken by a catalogue request" )
+    parser.add_argument( '--slo-ms', type=float, default=50.0, help="latency objective for control commands" )
+    parser.add_argument( '--duration', type=float, default=10.0 )
+    args = parser.parse_args()
+
+    for lanes in ( False, True ):
+        run( lanes, args )
+    rate_limit( args )
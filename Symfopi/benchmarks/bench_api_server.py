@@ -0,0 +1,137 @@
+"""Load benchmark for the central controller API servers.
+
+Runs the same registered functions behind the ThreadedHTTPServer and the
+EventLoopHTTPServer on loopback, drives each with a number of keep-alive
+clients, and reports requests/sec and latency percentiles.
+
+    python bench_api_server.py --clients 32 --duration 10 --slow-ms 20
+"""
+import os
+import sys
+import time
+import threading
+import argparse
+import httplib
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from api_server import ThreadedHTTPServer, EventLoopHTTPServer
+
+
+def percentile( sorted_vals, pct ):
+    if not sorted_vals:
+        return float( 'nan' )
+    indx = min( len( sorted_vals ) - 1, int( round( pct / 100.0 * (len( sorted_vals ) - 1) ) ) )
+    return sorted_vals[indx]
+
+
+class DummyController( object ):
+
+    def __init__( self, slow_secs ):
+        self.slow_secs = slow_secs
+
+    def do_get_current_playlist( self, qargs_dict ):
+        return { 'playlist_name':'test_playlist', 'playlist_index': 33 }
+
+    def do_set_current_playlist( self, qargs_dict ):
+        time.sleep( self.slow_secs )
+
+
+class QuietRequestHandler( ThreadedHTTPServer.HTTPRequestHandler ):
+
+    def log_message( self, format, *args ):
+        pass
+
+
+def make_server( mode, controller ):
+    if mode == 'threaded':
+        httpd = ThreadedHTTPServer( ('127.0.0.1', 0), QuietRequestHandler, controller )
+        httpd.timeout = 0.5
+        httpd.request_queue_size = 128
+        stop_flag = []
+        def serve():
+            while not stop_flag:
+                httpd.handle_request()
+            httpd.server_close()
+        def stop():
+            stop_flag.append( True )
+    else:
+        httpd = EventLoopHTTPServer( ('127.0.0.1', 0), controller )
+        serve = httpd.serve_forever
+        stop = httpd.shutdown
+
+    httpd.register_api_function( 'get_current_playlist', controller.do_get_current_playlist,
+                                 'GET', inline=True )
+    httpd.register_api_function( 'set_current_playlist', controller.do_set_current_playlist, 'PUT' )
+    return httpd, serve, stop
+
+
+def client_loop( port, deadline, slow_every, latencies, errors ):
+    conn = httplib.HTTPConnection( '127.0.0.1', port, timeout=10 )
+    n = 0
+    while time.time() < deadline:
+        n += 1
+        if slow_every and n % slow_every == 0:
+            method, path = 'PUT', '/set_current_playlist'
+        else:
+            method, path = 'GET', '/get_current_playlist'
+        t0 = time.time()
+        try:
+            conn.request( method, path )
+            resp = conn.getresponse()
+            resp.read()
+        except Exception:
+            errors.append( 1 )
+            conn.close()
+            conn = httplib.HTTPConnection( '127.0.0.1', port, timeout=10 )
+            continue
+        latencies.append( time.time() - t0 )
+    conn.close()
+
+
+def run( mode, args ):
+    controller = DummyController( args.slow_ms / 1000.0 )
+    httpd, serve, stop = make_server( mode, controller )
+    port = httpd.server_address[1]
+    server_thread = threading.Thread( target=serve )
+    server_thread.start()
+
+    latencies = []
+    errors = []
+    deadline = time.time() + args.duration
+    clients = [ threading.Thread( target=client_loop,
+                                  args=( port, deadline, args.slow_every, latencies, errors ) )
+                for i in xrange( args.clients ) ]
+    t0 = time.time()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.time() - t0
+
+    t_stop = time.time()
+    stop()
+    server_thread.join()
+    stop_secs = time.time() - t_stop
+
+    latencies.sort()
+    print "%-10s %9.1f req/s  p50 %7.2f ms  p99 %7.2f ms  errors %d  shutdown %6.1f ms" % (
+        mode, len( latencies ) / elapsed,
+        percentile( latencies, 50 ) * 1000, percentile( latencies, 99 ) * 1000,
+        len( errors ), stop_secs * 1000 )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--clients', type=int, default=16 )
+    parser.add_argument( '--duration', type=float, default=5.0 )
+    parser.add_argument( '--slow-ms', type=float, default=20.0,
+                         help="time taken by the slow (PUT) handler" )
+    parser.add_argument( '--slow-every', type=int, default=10,
+                         help="every Nth request from a client is the slow one; 0 for never" )
+    parser.add_argument( '--mode', choices=('both', 'threaded', 'eventloop'), default='both' )
+    args = parser.parse_args()
+
+    modes = ('threaded', 'eventloop') if args.mode == 'both' else (args.mode,)
+    for mode in modes:
+        run( mode, args )
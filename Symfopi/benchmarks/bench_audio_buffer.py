@@ -0,0 +1,130 @@
+"""Benchmark for the buffered audio delivery path.
+
+Delivers 44.1 kHz 16-bit stereo frames into a BufferedAudioOutput the way
+libspotify does (batches of frames, re-offering whatever is not consumed)
+while a fake sink plays them back in real time, with an occasional stall.
+Reports delivery cost, how far ahead delivery stayed, the overrun and
+underrun counts, and memory use, which should not grow.
+
+Each frame holds its own number, so the sink checks that every frame comes
+out once and in order as the buffer wraps around; it exits non-zero if
+not, or if memory grew.
+
+    python bench_audio_buffer.py --seconds 10 --stall-ms 200
+"""
+import os
+import sys
+import time
+import array
+import threading
+import argparse
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from audio_buffer import BufferedAudioOutput
+
+RATE = 44100
+CHANNELS = 2
+FRAME_SIZE = 4
+
+
+def rss_kb():
+    with open( '/proc/self/status' ) as f:
+        for line in f:
+            if line.startswith( 'VmRSS:' ):
+                return int( line.split()[1] )
+    return 0
+
+
+class RealTimeSink( object ):
+    """Consumes frames no faster than real time, and stalls now and then."""
+
+    def __init__( self, stall_every, stall_secs ):
+        self.played = 0
+        self.started = None
+        self.stall_every = stall_every
+        self.stall_secs = stall_secs
+        self.next_stall = None
+        self.errors = []
+
+    def start( self ):
+        self.started = time.time()
+        self.next_stall = self.started + self.stall_every
+
+    def stop( self ):
+        pass
+
+    def end_of_track( self ):
+        pass
+
+    def music_delivery( self, session, frames, frame_size, num_frames, sample_type, sample_rate, channels ):
+        now = time.time()
+        if self.stall_every and now >= self.next_stall:
+            time.sleep( self.stall_secs )
+            self.next_stall = time.time() + self.stall_every
+        ahead = self.played / float( sample_rate ) - ( now - self.started )
+        if ahead > 0.05:
+            time.sleep( ahead - 0.05 )
+        got = array.array( 'I', frames[:num_frames * FRAME_SIZE] )
+        if got != array.array( 'I', xrange( self.played, self.played + num_frames ) ):
+            if len( self.errors ) < 10:
+                self.errors.append( "frames %d-%d out of order or corrupt" % ( self.played, self.played + num_frames ) )
+        self.played += num_frames
+        return num_frames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--seconds', type=float, default=10.0 )
+    parser.add_argument( '--batch', type=int, default=2048, help="frames per delivery" )
+    parser.add_argument( '--stall-every', type=float, default=2.0 )
+    parser.add_argument( '--stall-ms', type=float, default=200.0 )
+    parser.add_argument( '--max-rss-growth-kb', type=int, default=1024 )
+    args = parser.parse_args()
+
+    sink = RealTimeSink( args.stall_every, args.stall_ms / 1000.0 )
+    output = BufferedAudioOutput( sink )
+    output.start()
+
+    total_frames = int( args.seconds * RATE )
+    delivered = 0
+    delivery_secs = 0.0
+    calls = 0
+    t0 = time.time()
+    rss_start = rss_kb()
+    while delivered < total_frames:
+        # libspotify offers frames as fast as they are taken
+        batch = array.array( 'I', xrange( delivered, delivered + args.batch ) ).tostring()
+        t = time.time()
+        n = output.music_delivery( None, batch, FRAME_SIZE, args.batch, 0, RATE, CHANNELS )
+        delivery_secs += time.time() - t
+        calls += 1
+        delivered += n
+        if n < args.batch:
+            time.sleep( 0.01 )
+    output.end_of_track()
+    while sink.played < delivered:
+        time.sleep( 0.01 )
+    elapsed = time.time() - t0
+    output.finish()
+
+    buf = output.buffer
+    print "audio %.1f s played in %.1f s wall time" % ( sink.played / float( RATE ), elapsed )
+    print "delivery: %d calls, %.1f us per call, %.3f us per frame" % (
+        calls, delivery_secs / calls * 1e6, delivery_secs / delivered * 1e6 )
+    print "buffer: %d frames (%.1f s), %d KiB; overruns %d, underruns %d" % (
+        buf.capacity, buf.capacity / float( RATE ), buf.capacity * FRAME_SIZE / 1024,
+        buf.overruns, buf.underruns )
+    rss_end = rss_kb()
+    print "rss: %d KiB at start, %d KiB at end" % ( rss_start, rss_end )
+
+    failures = list( sink.errors )
+    if delivered <= buf.capacity:
+        failures.append( "the buffer never wrapped around; try more --seconds" )
+    if sink.played != delivered:
+        failures.append( "%d frames delivered but %d played" % ( delivered, sink.played ) )
+    if rss_end - rss_start > args.max_rss_growth_kb:
+        failures.append( "memory grew by %d KiB" % ( rss_end - rss_start ) )
+    for line in failures:
+        print "FAILED  " + line
+    sys.exit( 1 if failures else 0 )
@@ -0,0 +1,198 @@
+"""Benchmark for the audio cache: time to a track's first frame streamed
+from the (fake) session versus played from the cache, the cost of
+recording deliveries, hit rate and traffic saved under LRU eviction, and
+detection of damaged files.
+
+    python bench_audio_cache.py --load-secs 0.5 --tracks 10
+"""
+import os
+import sys
+import time
+import array
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from audio_cache import AudioCache, CachedTrackPlayer, BLOCK_FRAMES, HEADER
+from fake_spotify import FakeSession, FakeTrack, FakeArtist, RATE, FRAME_SIZE
+
+
+class Sink( object ):
+    """Takes every frame offered, noting when the first arrived and when
+    the track ended."""
+
+    def __init__( self ):
+        self.first_frame = threading.Event()
+        self.first_frame_at = None
+        self.ended = threading.Event()
+        self.frames = 0
+        self.recorder = None
+
+    def music_delivery( self, session, frames, frame_size, num_frames, sample_type, sample_rate, channels ):
+        if self.first_frame_at is None:
+            self.first_frame_at = time.time()
+            self.first_frame.set()
+        if self.recorder is not None:
+            self.recorder.write( frames, frame_size, num_frames, sample_type, sample_rate, channels )
+        self.frames += num_frames
+        return num_frames
+
+    def end_of_track( self, *args ):
+        self.ended.set()
+
+
+def stream( session, sink, track, cache ):
+    """Play a track on the session, recording it into the cache; returns
+    seconds to the first frame."""
+    sink.recorder = cache.recorder( track.uri, track.duration() )
+    t0 = time.time()
+    session.load( track )
+    session.play( 1 )
+    sink.first_frame.wait()
+    sink.ended.wait()
+    sink.recorder.commit()
+    return sink.first_frame_at - t0
+
+
+def play_cached( cache, uri, sink ):
+    """Play a track from the cache; returns seconds to the first frame, or
+    None on a miss."""
+    t0 = time.time()
+    cached = cache.open( uri )
+    if cached is None:
+        return None
+    corrupt = []
+    player = CachedTrackPlayer( cache, uri, cached, sink.music_delivery, sink.end_of_track,
+                                lambda ms: ( corrupt.append( ms ), sink.end_of_track() ) )
+    player.play( True )
+    sink.first_frame.wait()
+    sink.ended.wait()
+    sink.corrupt_at = corrupt[0] if corrupt else None
+    return sink.first_frame_at - t0
+
+
+def median( values ):
+    values = sorted( values )
+    return values[len( values ) // 2]
+
+
+def start_latency( directory, args ):
+    cache = AudioCache( directory, 1 << 30 )
+    session = FakeSession( latency=0.01, jitter=0, load_latency=args.load_secs )
+    artist = FakeArtist( 'Bench' )
+    tracks = [ FakeTrack( 'Track %d' % i, artist, 'Album', args.track_secs * 1000, uri='spotify:track:bench%d' % i )
+               for i in xrange( args.tracks ) ]
+    misses, hits = [], []
+    for track in tracks:
+        sink = Sink()
+        session.music_sink = sink
+        session.end_of_track_listeners = ( sink.end_of_track, )
+        misses.append( stream( session, sink, track, cache ) )
+    session.close()
+    t0 = time.time()
+    for track in tracks:
+        sink = Sink()
+        hits.append( play_cached( cache, track.uri, sink ) )
+    elapsed = time.time() - t0
+    print "Start of a %d s track: streamed %.1f ms, from the cache %.2f ms (median of %d)" % (
+        args.track_secs, median( misses ) * 1000, median( hits ) * 1000, args.tracks )
+    print "Cache playback, with checksums: %.0f MB/s" % (
+        args.tracks * args.track_secs * RATE * FRAME_SIZE / elapsed / 1e6 )
+
+    # Cost added to each delivery by recording it
+    recorder = cache.recorder( 'spotify:track:overhead', 600000 )
+    frames = array.array( 'I', [ 7 ] ) * 2048
+    data = frames.tostring()
+    n = 5000
+    t0 = time.time()
+    for i in xrange( n ):
+        recorder.write( data, FRAME_SIZE, 2048, 0, RATE, 2 )
+    per_call = ( time.time() - t0 ) / n
+    recorder.abort()
+    print "Recording: %.1f us per 2048-frame delivery (%.2f%% of the %.1f ms of audio it holds)" % (
+        per_call * 1e6, per_call / ( 2048.0 / RATE ) * 100, 2048000.0 / RATE )
+
+
+def add_track( cache, uri, secs ):
+    """Record a track straight into the cache, as streaming it would."""
+    recorder = cache.recorder( uri, secs * 1000 )
+    chunk = ( array.array( 'I', [ hash( uri ) & 0xffffffff ] ) * 2048 ).tostring()
+    remaining = secs * RATE
+    while remaining:
+        n = min( 2048, remaining )
+        recorder.write( chunk, FRAME_SIZE, n, 0, RATE, 2 )
+        remaining -= n
+    recorder.commit()
+
+
+def hit_rate( directory, args ):
+    """Plays drawn by popularity (Zipf) from a catalogue, with the cache
+    holding a share of it."""
+    track_bytes = args.sim_track_secs * RATE * FRAME_SIZE
+    rnd = random.Random( 1 )
+    weights = [ 1.0 / ( rank + 1 ) for rank in xrange( args.catalogue ) ]
+    total = sum( weights )
+    cumulative = []
+    acc = 0.0
+    for w in weights:
+        acc += w / total
+        cumulative.append( acc )
+    plays = []
+    for i in xrange( args.plays ):
+        x = rnd.random()
+        plays.append( next( ( t for t, c in enumerate( cumulative ) if c >= x ), args.catalogue - 1 ) )
+
+    for share in ( 0.1, 0.25, 0.5, 1.0 ):
+        sub = os.path.join( directory, 'share%d' % int( share * 100 ) )
+        cache = AudioCache( sub, int( share * args.catalogue * ( track_bytes + 4096 ) ) )
+        for t in plays:
+            uri = 'spotify:track:zipf%d' % t
+            if play_cached( cache, uri, Sink() ) is None:
+                add_track( cache, uri, args.sim_track_secs )
+        stats = cache.stats()
+        print "Cache of %3d%% of %d tracks: hit rate %.1f%%, %.1f MB played from disk, ~%.1f MB of streaming saved" % (
+            share * 100, args.catalogue, stats['hit_rate'] * 100, stats['bytes_served'] / 1e6,
+            stats['network_bytes_saved'] / 1e6 )
+        shutil.rmtree( sub )
+
+
+def integrity( directory ):
+    cache = AudioCache( os.path.join( directory, 'integrity' ) )
+    add_track( cache, 'spotify:track:damaged', 5 )
+    add_track( cache, 'spotify:track:truncated', 5 )
+    path = os.path.join( cache.directory, cache.file_name( 'spotify:track:damaged' ) )
+    with open( path, 'r+b' ) as f:
+        f.seek( HEADER.size + ( BLOCK_FRAMES + 10 ) * FRAME_SIZE )
+        f.write( '\xff' )
+    path = os.path.join( cache.directory, cache.file_name( 'spotify:track:truncated' ) )
+    with open( path, 'r+b' ) as f:
+        f.truncate( os.path.getsize( path ) - 100 )
+
+    sink = Sink()
+    play_cached( cache, 'spotify:track:damaged', sink )
+    print "Damaged block: %d frames played, then streaming from %d ms; still cached: %s" % (
+        sink.frames, sink.corrupt_at, cache.open( 'spotify:track:damaged' ) is not None )
+    print "Truncated file: cached %s" % ( cache.open( 'spotify:track:truncated' ) is not None )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--load-secs', type=float, default=0.5, help="session's track load latency" )
+    parser.add_argument( '--tracks', type=int, default=10 )
+    parser.add_argument( '--track-secs', type=int, default=20 )
+    parser.add_argument( '--catalogue', type=int, default=200 )
+    parser.add_argument( '--plays', type=int, default=2000 )
+    parser.add_argument( '--sim-track-secs', type=int, default=1 )
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        start_latency( os.path.join( tmp, 'latency' ), args )
+        hit_rate( tmp, args )
+        integrity( tmp )
+    finally:
+        shutil.rmtree( tmp )
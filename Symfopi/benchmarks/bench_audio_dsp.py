@@ -0,0 +1,166 @@
+"""Benchmark for the audio processing stage: CPU time per second of audio
+for volume ramps, loudness normalisation and crossfades, and checks that
+normalisation and crossfades do what they should.
+
+Frames are 16-bit stereo at 44.1 kHz, delivered 2048 at a time as
+libspotify does, into a BufferedAudioOutput with and without an
+AudioProcessor.
+
+    python bench_audio_dsp.py --seconds 120
+"""
+import os
+import sys
+import math
+import time
+import argparse
+import threading
+
+import numpy
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from audio_buffer import BufferedAudioOutput, PCMRingBuffer
+from audio_dsp import AudioProcessor
+
+RATE = 44100
+DELIVERY_FRAMES = 2048
+
+
+def tone( seconds, dbfs, freq=440.0, seed=1 ):
+    """A stereo tone with some noise, at about `dbfs` RMS, as int16 bytes."""
+    rnd = numpy.random.RandomState( seed )
+    t = numpy.arange( int( seconds * RATE ) ) / float( RATE )
+    mono = numpy.sin( 2 * math.pi * freq * t ) + 0.1 * rnd.standard_normal( len( t ) )
+    mono *= 32768 * 10 ** ( dbfs / 20.0 ) / numpy.sqrt( numpy.mean( mono ** 2 ) )
+    return numpy.repeat( mono, 2 ).astype( numpy.int16 ).tostring()
+
+
+def dbfs( data ):
+    s = numpy.frombuffer( data, dtype=numpy.int16 ).astype( numpy.float64 )
+    return 20 * math.log10( numpy.sqrt( numpy.mean( s ** 2 ) ) / 32768 )
+
+
+def deliveries( data ):
+    step = DELIVERY_FRAMES * 4
+    for i in xrange( 0, len( data ), step ):
+        chunk = data[i:i + step]
+        yield chunk, len( chunk ) // 4
+
+
+def cpu_per_second( seconds, processor ):
+    """CPU seconds to buffer (and process) a second of audio, with the
+    buffer drained in step on the same thread."""
+    data = tone( 10, -20 )
+    buf = PCMRingBuffer( RATE * 2 )
+    process = None
+    if processor is not None:
+        process = lambda first, last: processor.process( buf, first, last, 2, RATE )
+    chunks = list( deliveries( data ) )
+    done = 0
+    t0 = time.clock()
+    while done < seconds * RATE:
+        for chunk, n in chunks:
+            if processor is not None and done % ( RATE * 2 ) < n:
+                processor.set_volume( 0.5 if processor.volume == 1.0 else 1.0 )   # a ramp every 2 s
+            buf.write( chunk, n, process )
+            buf.advance( n )
+            done += n
+    return ( time.clock() - t0 ) / ( float( done ) / RATE )
+
+
+class CaptureSink( object ):
+    """Keeps what it is given, once opened."""
+
+    def __init__( self ):
+        self.open = threading.Event()
+        self.frames = []
+        self.ended = threading.Event()
+
+    def music_delivery( self, session, frames, frame_size, num_frames, sample_type, sample_rate, channels ):
+        if not self.open.is_set():
+            return 0
+        self.frames.append( frames )
+        return num_frames
+
+    def start( self ):
+        pass
+
+    def stop( self ):
+        pass
+
+    def end_of_track( self ):
+        self.ended.set()
+
+
+def play( output, data ):
+    for chunk, n in deliveries( data ):
+        while n:
+            taken = output.music_delivery( None, chunk, 4, n, 0, RATE, 2 )
+            chunk = chunk[taken * 4:]
+            n -= taken
+            if not taken:
+                time.sleep( 0.001 )
+
+
+def normalisation():
+    """Two tracks 20 dB apart; the level of each over its last seconds."""
+    sink = CaptureSink()
+    sink.open.set()
+    processor = AudioProcessor( normalise=True, target_dbfs=-18.0 )
+    output = BufferedAudioOutput( sink, processor=processor )
+    output.start()
+    for level in ( -30, -10 ):
+        output.new_track()
+        play( output, tone( 20, level ) )
+        output.end_of_track()
+        sink.ended.wait()
+        sink.ended.clear()
+        out = ''.join( sink.frames )
+        sink.frames = []
+        print "Track at %d dBFS: %.1f dBFS over its last 5 s (target -18)" % ( level, dbfs( out[-5 * RATE * 4:] ) )
+    output.finish()
+
+
+def crossfade( secs ):
+    """Track A, then B crossfading in from A's end; checks the overlap and
+    that there is no jump in level at either end of it."""
+    sink = CaptureSink()
+    processor = AudioProcessor( normalise=False, crossfade_secs=secs )
+    output = BufferedAudioOutput( sink, capacity_frames=RATE * ( int( math.ceil( secs ) ) + 1 ),
+                                  processor=processor )
+    output.start()
+    a, b = tone( secs + 0.5, -12, 440 ), tone( 5, -12, 660, seed=2 )
+    play( output, a )
+    output.new_track( crossfade=True )
+    # B's start goes over A's buffered end; the rest needs the sink playing
+    head = int( secs * RATE ) * 4
+    t0 = time.clock()
+    play( output, b[:head] )
+    mix_cpu = time.clock() - t0
+    sink.open.set()
+    play( output, b[head:] )
+    output.end_of_track()
+    sink.ended.wait()
+    out = ''.join( sink.frames )
+    output.finish()
+    overlap = ( len( a ) + len( b ) - len( out ) ) // 4
+    levels = [ dbfs( out[i:i + 4410 * 4] ) for i in xrange( 0, len( out ) - 4410 * 4, 4410 * 4 ) ]
+    steps = max( abs( x - y ) for x, y in zip( levels, levels[1:] ) )
+    print "Crossfade of %.1f s: overlapped %.2f s; largest level change between 0.1 s windows %.1f dB; " \
+          "%.1f ms CPU to mix it" % ( secs, float( overlap ) / RATE, steps, mix_cpu * 1000 )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--seconds', type=int, default=120, help="seconds of audio to time" )
+    parser.add_argument( '--crossfade', type=float, default=1.5 )
+    args = parser.parse_args()
+
+    base = cpu_per_second( args.seconds, None )
+    print "Buffering only:          %6.2f ms CPU per second of audio (%.2f%% of a core)" % ( base * 1000, base * 100 )
+    for label, processor in ( ( 'volume ramps', AudioProcessor( normalise=False ) ),
+                              ( 'ramps + normalisation', AudioProcessor( normalise=True ) ) ):
+        cpu = cpu_per_second( args.seconds, processor )
+        print "With %-21s%6.2f ms CPU per second of audio (%.2f%% of a core)" % ( label + ':', cpu * 1000, cpu * 100 )
+    normalisation()
+    crossfade( args.crossfade )
@@ -0,0 +1,116 @@
+"""Benchmark for album browsing: polling is_loaded() against callback-driven
+futures.
+
+Runs against the offline fake session, whose loads complete after a given
+latency. Reports the time to browse albums one at a time by each method,
+and to browse a batch with a bounded number of loads in flight.
+
+It also checks that every load completes with the right results, in order,
+that a batch never has more loads in flight than allowed, that a failed
+load fails its batch, that playlists complete from their state callbacks,
+and that nothing is left in flight; it exits non-zero if not.
+
+    python bench_browse.py --albums 40 --latency 0.03 --in-flight 8
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from fake_spotify import FakeSession
+from browse import BrowseLoader
+
+
+def browse_polling( session, album ):
+    # As SpotifyJukebox.browse() used to
+    browser = session.browse_album( album, None )
+    while not browser.is_loaded():
+        time.sleep( 0.1 )
+    return browser
+
+
+def report( label, elapsed, count ):
+    print "%-28s %7.3f s total   %7.1f ms per album" % ( label, elapsed, elapsed * 1000 / count )
+
+
+FAILURES = []
+
+
+def check( ok, message ):
+    if not ok:
+        FAILURES.append( message )
+
+
+def names( browsers ):
+    return [ b[0].name().rsplit( ' track ', 1 )[0] if len( b ) else None for b in browsers ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--albums', type=int, default=40 )
+    parser.add_argument( '--latency', type=float, default=0.03 )
+    parser.add_argument( '--in-flight', type=int, default=8 )
+    args = parser.parse_args()
+
+    session = FakeSession( latency=args.latency, jitter=args.latency / 3 )
+    loader = BrowseLoader( session, session.artist_browser, session.toplist_browser )
+    albums = [ session.make_album( 'album %d' % i ) for i in xrange( args.albums ) ]
+
+    t0 = time.time()
+    for album in albums:
+        check( len( browse_polling( session, album ) ) == 10, "polled browse of %s incomplete" % album.name() )
+    report( "polling, one at a time", time.time() - t0, len( albums ) )
+
+    t0 = time.time()
+    for album in albums:
+        check( len( loader.album( album ).result( 10 ) ) == 10, "browse of %s incomplete" % album.name() )
+    report( "futures, one at a time", time.time() - t0, len( albums ) )
+
+    # Count the loads outstanding at once
+    counts = { 'now': 0, 'peak': 0 }
+    counts_lock = threading.Lock()
+    def loaded( fut ):
+        with counts_lock:
+            counts['now'] -= 1
+    def counted_album( album ):
+        with counts_lock:
+            counts['now'] += 1
+            counts['peak'] = max( counts['peak'], counts['now'] )
+        fut = loader.album( album )
+        fut.add_done_callback( loaded )
+        return fut
+
+    t0 = time.time()
+    browsers = loader.load_many( counted_album, albums, max_in_flight=args.in_flight ).result( 30 )
+    report( "futures, batch of %d in flight" % args.in_flight, time.time() - t0, len( albums ) )
+    check( [ len( b ) for b in browsers ] == [ 10 ] * len( albums ), "batch browses incomplete" )
+    check( names( browsers ) == [ a.name() for a in albums ], "batch results out of order" )
+    check( counts['peak'] <= args.in_flight,
+           "%d loads in flight, more than the %d allowed" % ( counts['peak'], args.in_flight ) )
+
+    # One load failing fails the batch, once the rest have finished
+    def failing_album( album ):
+        if album is albums[len( albums ) // 2]:
+            raise RuntimeError( "load failed" )
+        return loader.album( album )
+    try:
+        loader.load_many( failing_album, albums, max_in_flight=args.in_flight ).result( 30 )
+        check( False, "batch with a failed load succeeded" )
+    except RuntimeError:
+        pass
+
+    # Playlists complete when the session says they have loaded
+    session.add_playlist_state_listener( loader.playlist_state_changed )
+    container = session.make_catalogue( playlists=5, tracks_per_playlist=3 )
+    playlists = loader.load_many( loader.playlist, list( container ) ).result( 10 )
+    check( all( p.is_loaded() for p in playlists ), "playlists completed before loading" )
+
+    print "Loads still in flight: %d" % loader.in_flight()
+    check( loader.in_flight() == 0, "%d loads left in flight" % loader.in_flight() )
+    session.close()
+    for line in FAILURES:
+        print "FAILED  " + line
+    sys.exit( 1 if FAILURES else 0 )
@@ -0,0 +1,280 @@
+"""Benchmark for running playback in its own process: audio timing jitter
+with the API under heavy load, with the audio path in the controller's
+process and in a playback process, and recovery from a crash.
+
+The audio path is the real BufferedAudioOutput, fed by the fake session,
+writing to a stand-in sound card that plays in real time from a small
+buffer of its own. Jitter is measured as the intervals between writes to
+the card, and the time the card ran dry. The load is clients in another
+process fetching a large JSON response as fast as they can.
+
+    python bench_isolation.py --seconds 15 --clients 4
+"""
+import os
+import sys
+import json
+import time
+import socket
+import httplib
+import argparse
+import tempfile
+import threading
+import subprocess
+
+BENCH_DIR = os.path.dirname( os.path.abspath( __file__ ) )
+sys.path.insert( 0, os.path.join( BENCH_DIR, '..', 'managers' ) )
+
+from fake_spotify import FakeSession, FakeTrack, FakeArtist, RATE
+from session_actor import SessionActor
+from audio_buffer import BufferedAudioOutput
+from workers import Future
+from api_server import EventLoopHTTPServer
+from playback_process import PlaybackHost
+
+
+class SoundCard( object ):
+    """Stands in for a sound card: plays frames in real time from a buffer
+    of `capacity_frames`, taking no more than fit. Records the intervals
+    between writes and the time spent with nothing to play."""
+
+    def __init__( self, capacity_frames=1024 ):
+        self.capacity = capacity_frames
+        self.origin = None             # time the card would have played frame 0
+        self.written = 0
+        self.last_write = None
+        self.intervals = []
+        self.dry_secs = 0.0
+        self.dry_spells = 0
+
+    def start( self ):
+        pass
+
+    def stop( self ):
+        pass
+
+    def end_of_track( self ):
+        pass
+
+    def music_delivery( self, session, frames, frame_size, num_frames, sample_type, sample_rate, channels ):
+        now = time.time()
+        if self.origin is None:
+            self.origin = now
+        fill = self.written - ( now - self.origin ) * RATE
+        if fill < 0:
+            # Ran dry; playing resumes from now
+            self.dry_secs += -fill / RATE
+            self.dry_spells += 1
+            self.origin = now - float( self.written ) / RATE
+            fill = 0
+        if self.last_write is not None:
+            self.intervals.append( now - self.last_write )
+        self.last_write = now
+        taken = int( min( num_frames, self.capacity - fill ) )
+        self.written += max( 0, taken )
+        return max( 0, taken )
+
+    def report( self ):
+        intervals = sorted( self.intervals )
+        pick = lambda q: intervals[min( len( intervals ) - 1, int( q * len( intervals ) ) )] * 1000
+        return { 'p50_ms': pick( 0.5 ), 'p99_ms': pick( 0.99 ), 'p999_ms': pick( 0.999 ),
+                 'max_ms': intervals[-1] * 1000 if intervals else 0,
+                 'dry_ms': self.dry_secs * 1000, 'dry_spells': self.dry_spells }
+
+
+class FakeJukebox( object ):
+    """Plays one long track on the fake session, over and over."""
+
+    def __init__( self, card_frames ):
+        self.card = SoundCard( card_frames )
+        self.audio = BufferedAudioOutput( self.card )
+        self.audio_cache = None
+        self.session = FakeSession( latency=0, jitter=0, load_latency=0 )
+        self.session.music_sink = self.audio
+        self.session.add_end_of_track_listener( lambda session: self.play() )
+        self.track = FakeTrack( 'Long', FakeArtist( 'Bench' ), 'Album', 600000, uri='spotify:track:long' )
+
+    def play( self ):
+        self.audio.start()
+        self.session.load( self.track )
+        self.session.play( 1 )
+
+    def add_track_change_listener( self, func ):
+        pass
+
+    def queue_status( self ):
+        return 0, 0
+
+    def search_tracks( self, query, limit=20 ):
+        fut = Future()
+        fut.set_result( [] )
+        return fut
+
+
+class FakePlaybackManager( object ):
+    """Enough of a PlaybackManager for the playback process."""
+
+    def __init__( self, config ):
+        self.zone = config['zones'][0]
+        self.config = config
+        self.actor = SessionActor()
+        self.jukebox = FakeJukebox( config['card_frames'] )
+        self.playing = False
+
+    def resume_playback( self ):
+        def resume():
+            self.playing = True
+            self.jukebox.play()
+        return self.actor.submit( resume )
+
+    def pause_playback( self ):
+        return self.actor.submit( lambda: None )
+
+    def is_playing( self ):
+        return self.playing
+
+    def state( self ):
+        return { 'zone': self.zone, 'playing': self.playing, 'logged_in': True }
+
+    def snapshot( self ):
+        return self.actor.submit( lambda: { 'playing': self.playing } )
+
+    def restore( self, state ):
+        if state.get( 'playing' ):
+            return self.resume_playback()
+        return self.actor.submit( lambda: None )
+
+    def finish( self ):
+        self.actor.stop()
+        self.jukebox.session.close()
+        self.jukebox.audio.finish()
+        if self.config.get( 'stats_path' ):
+            with open( self.config['stats_path'], 'w' ) as f:
+                json.dump( self.jukebox.card.report(), f )
+
+
+def fake_managers( config, catalogues ):
+    return [ FakePlaybackManager( config ) ]
+
+
+#
+# API load
+
+class Catalogue( object ):
+    """A handler with a large JSON response, encoded on the server's worker
+    threads."""
+
+    TRACKS = [ { 'uri': 'spotify:track:%022d' % i, 'name': 'Track %d' % i, 'artist': 'Artist %d' % ( i % 50 ),
+                 'album': 'Album %d' % ( i % 200 ), 'duration_ms': 200000 + i } for i in xrange( 1000 ) ]
+
+    def do_get_tracks( self, qargs_dict ):
+        return json.loads( json.dumps( self.TRACKS ) )
+
+
+def clients( port, seconds, threads ):
+    """Child: fetch /tracks from `threads` keep-alive connections."""
+    counts = []
+
+    def run():
+        conn = httplib.HTTPConnection( '127.0.0.1', port )
+        n = 0
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            conn.request( 'GET', '/tracks' )
+            conn.getresponse().read()
+            n += 1
+        counts.append( n )
+    workers = [ threading.Thread( target=run ) for i in xrange( threads ) ]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    print sum( counts )
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind( ('127.0.0.1', 0) )
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def run( isolated, loaded, args ):
+    stats_path = tempfile.mktemp( suffix='.json' )
+    config = { 'zones': [ 'default' ], 'factory': 'bench_isolation:fake_managers', 'factory_path': BENCH_DIR,
+               'card_frames': args.card_frames, 'stats_path': stats_path, 'log_level': 'WARNING' }
+    if isolated:
+        host = PlaybackHost( config )
+        host.start()
+        manager = host.manager( 'default' )
+    else:
+        manager = FakePlaybackManager( config )
+    manager.resume_playback()
+
+    requests = 0
+    if loaded:
+        port = free_port()
+        httpd = EventLoopHTTPServer( ('127.0.0.1', port), Catalogue() )
+        httpd.register_api_function( 'tracks', Catalogue().do_get_tracks, 'GET' )
+        server = threading.Thread( target=httpd.serve_forever )
+        server.start()
+        requests = int( subprocess.check_output( [ sys.executable, os.path.abspath( __file__ ), '--clients-child',
+                                                   str( port ), '--seconds', str( args.seconds ),
+                                                   '--clients', str( args.clients ) ] ) )
+        httpd.shutdown()
+        server.join()
+    else:
+        time.sleep( args.seconds )
+
+    manager.finish()
+    with open( stats_path ) as f:
+        report = json.load( f )
+    os.remove( stats_path )
+    report['requests_per_sec'] = requests / float( args.seconds )
+    return report
+
+
+def crash_recovery( args ):
+    """Kill the playback process while playing; time until it is playing
+    again, from the snapshot."""
+    config = { 'zones': [ 'default' ], 'factory': 'bench_isolation:fake_managers', 'factory_path': BENCH_DIR,
+               'card_frames': args.card_frames, 'log_level': 'CRITICAL' }
+    host = PlaybackHost( config )
+    host.start()
+    manager = host.manager( 'default' )
+    manager.resume_playback().wait()
+    manager.snapshot().wait()
+    time.sleep( 0.5 )
+    before = host.status()['updated']
+    t0 = time.time()
+    host.kill()
+    while host.restarts == 0 or host.status()['updated'] <= before or not host.status()['position_time']:
+        time.sleep( 0.005 )
+    recovered = time.time() - t0
+    playing = manager.is_playing()
+    host.finish()
+    return recovered, playing
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--seconds', type=int, default=15 )
+    parser.add_argument( '--clients', type=int, default=4 )
+    parser.add_argument( '--card-frames', type=int, default=1024, help="sound card buffer, in frames" )
+    parser.add_argument( '--clients-child', type=int, help=argparse.SUPPRESS )
+    args = parser.parse_args()
+
+    if args.clients_child:
+        clients( args.clients_child, args.seconds, args.clients )
+        sys.exit( 0 )
+
+    print "Sound card buffer %.0f ms; intervals between writes, and time it ran dry:" % ( args.card_frames * 1000.0 / RATE )
+    for loaded in ( False, True ):
+        for isolated in ( False, True ):
+            r = run( isolated, loaded, args )
+            print "%-11s %-13s p50 %5.1f ms  p99 %5.1f ms  p99.9 %6.1f ms  max %6.1f ms  dry %6.1f ms (%d times)%s" % (
+                'API load' if loaded else 'idle', 'isolated' if isolated else 'in-process',
+                r['p50_ms'], r['p99_ms'], r['p999_ms'], r['max_ms'], r['dry_ms'], r['dry_spells'],
+                '  %.0f req/s' % r['requests_per_sec'] if loaded else '' )
+    recovered, playing = crash_recovery( args )
+    print "Playback process killed: playing again after %.0f ms; zone playing: %s" % ( recovered * 1000, playing )
@@ -0,0 +1,80 @@
+"""Benchmark for logging from the hot paths: a synchronous write, as the
+managers' print statements made, against the queued logging in logs.py.
+
+The output goes to a stream whose writes stall for a while now and then,
+as a journal on an SD card does. Reports the time a logging thread spends
+in each call, and how many of a burst of playlist callbacks get through
+the rate limit.
+
+    python bench_logging.py --records 2000 --stall-ms 20 --stall-every 50
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from logs import get_logger, fields, setup_logging
+
+
+class StallingStream( object ):
+    """Discards what is written, stalling on every `every`th write."""
+
+    def __init__( self, stall_secs, every ):
+        self.stall_secs = stall_secs
+        self.every = every
+        self.writes = 0
+        self.lines = 0
+
+    def write( self, data ):
+        self.writes += 1
+        self.lines += data.count( '\n' )
+        if self.writes % self.every == 0:
+            time.sleep( self.stall_secs )
+
+    def flush( self ):
+        pass
+
+
+def percentile( samples, pct ):
+    samples = sorted( samples )
+    return samples[ min( len( samples ) - 1, int( len( samples ) * pct / 100.0 ) ) ]
+
+
+def report( label, samples ):
+    print "%-22s mean %7.1f us   p99 %8.1f us   max %8.1f us" % (
+        label, sum( samples ) / len( samples ) * 1e6, percentile( samples, 99 ) * 1e6, max( samples ) * 1e6 )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--records', type=int, default=2000 )
+    parser.add_argument( '--stall-ms', type=float, default=20.0 )
+    parser.add_argument( '--stall-every', type=int, default=50 )
+    args = parser.parse_args()
+
+    stream = StallingStream( args.stall_ms / 1000.0, args.stall_every )
+    samples = []
+    for i in xrange( args.records ):
+        t0 = time.time()
+        stream.write( "Loading %s from %s\n" % ( 'track %d' % i, 'playlist' ) )
+        samples.append( time.time() - t0 )
+    report( "synchronous write", samples )
+
+    stream = StallingStream( args.stall_ms / 1000.0, args.stall_every )
+    listener = setup_logging( 'INFO', stream=stream )
+    log = get_logger( 'playback' )
+    samples = []
+    for i in xrange( args.records ):
+        t0 = time.time()
+        log.info( "Loading track", extra=fields( track='track %d' % i, playlist='playlist' ) )
+        samples.append( time.time() - t0 )
+    report( "queued logging", samples )
+
+    playlist_log = get_logger( 'playlists' )
+    for i in xrange( args.records ):
+        playlist_log.info( "Tracks added to playlist", extra=fields( playlist='playlist', count=1 ) )
+    listener.stop()
+    # Every playback record was written, the queue being big enough
+    print "Burst of %d playlist callbacks: %d written" % ( args.records, stream.lines - args.records )
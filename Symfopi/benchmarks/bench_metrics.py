@@ -0,0 +1,104 @@
+"""Benchmark for the cost of recording metrics.
+
+Times a bare loop, then counter increments and histogram observations with
+the registry disabled and enabled, then API requests per second from
+keep-alive clients against the event-loop server with metrics disabled and
+enabled.
+
+    python bench_metrics.py --ops 200000 --clients 8 --duration 3
+"""
+import os
+import sys
+import time
+import threading
+import argparse
+import httplib
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from metrics import REGISTRY, MetricsRegistry
+from api_server import EventLoopHTTPServer
+
+
+def time_ops( func, ops ):
+    t0 = time.time()
+    for i in xrange( ops ):
+        func()
+    return ( time.time() - t0 ) / ops
+
+
+def report_ops( label, per_op, baseline ):
+    print "%-32s %7.3f us per op   %+7.3f us over a bare call" % (
+        label, per_op * 1e6, ( per_op - baseline ) * 1e6 )
+
+
+class Handlers( object ):
+
+    def do_ping( self, qargs_dict ):
+        return { 'ok': True }
+
+
+def client_loop( port, deadline, count ):
+    conn = httplib.HTTPConnection( '127.0.0.1', port, timeout=10 )
+    n = 0
+    while time.time() < deadline:
+        conn.request( 'GET', '/ping' )
+        conn.getresponse().read()
+        n += 1
+    conn.close()
+    count.append( n )
+
+
+def requests_per_sec( enabled, args ):
+    REGISTRY.enabled = enabled
+    handlers = Handlers()
+    httpd = EventLoopHTTPServer( ('127.0.0.1', 0), handlers )
+    httpd.register_api_function( 'ping', handlers.do_ping, 'GET', inline=True )
+    server_thread = threading.Thread( target=httpd.serve_forever )
+    server_thread.start()
+
+    count = []
+    deadline = time.time() + args.duration
+    clients = [ threading.Thread( target=client_loop, args=( httpd.server_address[1], deadline, count ) )
+                for i in xrange( args.clients ) ]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    httpd.shutdown()
+    server_thread.join()
+    return sum( count ) / args.duration
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--ops', type=int, default=200000 )
+    parser.add_argument( '--clients', type=int, default=8 )
+    parser.add_argument( '--duration', type=float, default=3.0 )
+    args = parser.parse_args()
+
+    registry = MetricsRegistry()
+    counter = registry.counter( 'bench_total', 'Increments.' )
+    labelled = registry.counter( 'bench_labelled_total', 'Increments.', labels=('route',) )
+    histogram = registry.histogram( 'bench_seconds', 'Observations.' )
+
+    def bare():
+        pass
+
+    baseline = time_ops( bare, args.ops )
+    print "%-32s %7.3f us per op" % ( "bare call", baseline * 1e6 )
+    for enabled in ( False, True ):
+        registry.enabled = enabled
+        state = "enabled" if enabled else "disabled"
+        report_ops( "counter inc, %s" % state, time_ops( counter.inc, args.ops ), baseline )
+        report_ops( "labelled counter inc, %s" % state,
+                    time_ops( lambda: labelled.labels( 'ping' ).inc(), args.ops ), baseline )
+        report_ops( "histogram observe, %s" % state,
+                    time_ops( lambda: histogram.observe( 0.003 ), args.ops ), baseline )
+
+    print
+    for enabled in ( False, True ):
+        print "API, metrics %-8s %8.0f requests/s" % (
+            "enabled" if enabled else "disabled", requests_per_sec( enabled, args ) )
+    print
+    print "Rendered %d lines of metrics" % len( REGISTRY.render().splitlines() )
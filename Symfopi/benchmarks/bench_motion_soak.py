@@ -0,0 +1,105 @@
+"""Soak test for the motion monitor.
+
+Feeds millions of raw motion readings (bursts of flickering readings,
+separated by gaps shorter and longer than the hold time) into a
+MotionMonitor, and reports memory use, thread count and the size of the
+scheduler's timer heap as it goes. All three should stay flat; it exits
+non-zero if they do not, or if starts and stops of motion do not pair up.
+
+    python bench_motion_soak.py --events 2000000
+"""
+import os
+import sys
+import time
+import random
+import threading
+import argparse
+import resource
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from scheduler import Scheduler
+from motion import MotionSensor, MotionMonitor
+
+
+def rss_kb():
+    try:
+        with open( '/proc/self/status' ) as f:
+            for line in f:
+                if line.startswith( 'VmRSS:' ):
+                    return int( line.split()[1] )
+    except IOError:
+        pass
+    return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+
+
+class DrivenSensor( MotionSensor ):
+    """A sensor whose readings are fed in by the benchmark."""
+
+    def start( self, report_motion ):
+        self.report_motion = report_motion
+
+    def stop( self ):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--events', type=int, default=2000000 )
+    parser.add_argument( '--report-every', type=int, default=250000 )
+    parser.add_argument( '--start-debounce', type=float, default=0.002 )
+    parser.add_argument( '--stop-hold', type=float, default=0.005 )
+    parser.add_argument( '--max-heap', type=int, default=1000, help="largest timer heap allowed" )
+    parser.add_argument( '--max-rss-growth-kb', type=int, default=4096,
+                         help="memory growth allowed after the first report" )
+    args = parser.parse_args()
+
+    transitions = [0, 0]
+    def started():
+        transitions[0] += 1
+    def stopped():
+        transitions[1] += 1
+
+    scheduler = Scheduler()
+    sensor = DrivenSensor()
+    monitor = MotionMonitor( sensor, scheduler, started, stopped,
+                             start_debounce=args.start_debounce, stop_hold=args.stop_hold )
+    monitor.start()
+
+    rnd = random.Random( 1 )
+    detected = False
+    samples = []     # ( rss_kb, threads, heap ) at each report
+    t0 = time.time()
+    print "%10s %10s %8s %8s %10s %10s" % ( 'events', 'rss_kb', 'threads', 'heap', 'started', 'stopped' )
+    for n in xrange( 1, args.events + 1 ):
+        # Mostly flicker; now and then hold a reading long enough to count
+        if rnd.random() < 0.3:
+            detected = not detected
+        sensor.report_motion( detected )
+        if n % 5000 == 0:
+            time.sleep( rnd.choice( ( 0.0, args.start_debounce / 2, args.stop_hold * 2 ) ) )
+        if n % args.report_every == 0:
+            samples.append( ( rss_kb(), threading.active_count(), scheduler.pending() ) )
+            print "%10d %10d %8d %8d %10d %10d" % ( ( n, ) + samples[-1] + tuple( transitions ) )
+    elapsed = time.time() - t0
+
+    monitor.stop()
+    scheduler.stop()
+    print "%.2f us per reading" % ( elapsed / args.events * 1e6 )
+
+    failures = []
+    if samples:
+        rss, threads, heap = zip( *samples )
+        if rss[-1] - rss[0] > args.max_rss_growth_kb:
+            failures.append( "memory grew by %d kB" % ( rss[-1] - rss[0] ) )
+        if max( threads ) != threads[0]:
+            failures.append( "threads went from %d to %d" % ( threads[0], max( threads ) ) )
+        if max( heap ) > args.max_heap:
+            failures.append( "timer heap reached %d entries" % max( heap ) )
+    if not transitions[0]:
+        failures.append( "motion never started" )
+    if transitions[0] - transitions[1] not in ( 0, 1 ):
+        failures.append( "%d starts but %d stops" % tuple( transitions ) )
+    for line in failures:
+        print "FAILED  " + line
+    sys.exit( 1 if failures else 0 )
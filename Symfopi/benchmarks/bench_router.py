@@ -0,0 +1,70 @@
+"""Microbenchmark for API request dispatch.
+
+Registers a few hundred functions, a mix of plain paths and paths with
+`{name}` parameters, and reports the cost per request of finding the
+function and building its argument dictionary.
+
+    python bench_router.py --routes 300 --requests 200000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from api_server import APIRequestDispatcher
+from router import RoutingError
+
+
+def noop( qargs_dict ):
+    return None
+
+
+def build_dispatcher( num_routes ):
+    dispatcher = APIRequestDispatcher()
+    request_paths = []
+    for i in xrange( num_routes ):
+        kind = i % 3
+        if kind == 0:
+            dispatcher.register_api_function( 'get_thing_%d' % i, noop, 'GET' )
+            request_paths.append( ( 'GET', '/get_thing_%d' % i ) )
+        elif kind == 1:
+            dispatcher.register_api_function( 'set_thing_%d' % i, noop, 'PUT' )
+            request_paths.append( ( 'PUT', '/set_thing_%d?flag=true' % i ) )
+        else:
+            dispatcher.register_api_function( 'collection_%d/{index}/tracks' % i, noop, 'GET' )
+            request_paths.append( ( 'GET', '/collection_%d/%d/tracks' % ( i, i * 7 ) ) )
+    return dispatcher, request_paths
+
+
+def time_requests( dispatcher, requests ):
+    resolve = dispatcher.resolve_api_function
+    t0 = time.time()
+    for method, path in requests:
+        try:
+            resolve( method, path )
+        except RoutingError:
+            pass
+    return ( time.time() - t0 ) / len( requests )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--routes', type=int, default=300 )
+    parser.add_argument( '--requests', type=int, default=200000 )
+    args = parser.parse_args()
+
+    dispatcher, request_paths = build_dispatcher( args.routes )
+    rnd = random.Random( 1 )
+
+    static = [ r for r in request_paths if '/tracks' not in r[1] ]
+    params = [ r for r in request_paths if '/tracks' in r[1] ]
+    misses = [ ( 'GET', '/no_such_thing_%d' % i ) for i in xrange( 100 ) ] + \
+             [ ( 'DELETE', r[1] ) for r in static[:100] ]
+
+    print "%d routes registered" % len( dispatcher.routes )
+    for label, pool in ( ('static', static), ('parameterised', params), ('404/405', misses) ):
+        requests = [ rnd.choice( pool ) for i in xrange( args.requests ) ]
+        print "%-14s %6.2f us/request" % ( label, time_requests( dispatcher, requests ) * 1e6 )
@@ -0,0 +1,600 @@
+"""Offline end-to-end scenarios, with the fake libspotify session in place of
+a real one, for CI: each reports its figures, and they can be saved as a
+baseline and later runs compared against it.
+
+    api     the controller's HTTP API under a mix of reads and commands from
+            several keep-alive clients: throughput and latency
+    motion  hours of people coming and going past the motion sensor, on a
+            VirtualClock: latency from motion to playback starting, and
+            from the last motion to it pausing, and false starts
+    gap     a run of short tracks played through the BufferedAudioOutput
+            into a sink paced in real time: silence heard between tracks
+
+Each scenario runs in a process of its own, which also reports its peak
+memory. The playback manager is a stand-in (SimPlayback) that plays from a
+PlayQueue on a SessionActor through the fake session's player, as the
+jukebox does; pyspotify is not loaded.
+
+Real scheduling delays are magnified by the VirtualClock's speed: at 1000x
+each hop between threads adds a tenth of a second or so to the motion
+latencies, and the odd stall of a few milliseconds reads as seconds, so
+they are given as the median and 90th percentile, and are only comparable
+between runs at the same speed.
+
+Whatever the baseline, a run exits 1 if a scenario breaks one of the
+INVARIANTS, such as a request failing or motion being missed.
+
+    python bench_scenarios.py --save-baseline baseline.json
+    python bench_scenarios.py --baseline baseline.json    # exits 1 if worse
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import struct
+import httplib
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from fake_spotify import FakeSession
+from scheduler import VirtualClock
+from session_actor import SessionActor
+from play_queue import PlayQueue
+from audio_buffer import BufferedAudioOutput
+from motion import MotionSensor
+from workers import Future
+from central_controller import CentralController
+
+SCENARIOS = ( 'api', 'motion', 'gap' )
+
+# Figures compared against a baseline: whether higher is better, and the
+# absolute change allowed on top of the relative tolerance, for figures
+# that are near zero
+METRICS = { 'api.requests_per_sec': ( True, 0.0 ),
+            'api.latency_p50_ms': ( False, 0.5 ),
+            'api.latency_p99_ms': ( False, 2.0 ),
+            'api.errors': ( False, 0 ),
+            'motion.start_latency_p50_s': ( False, 0.25 ),
+            'motion.start_latency_p90_s': ( False, 1.0 ),
+            'motion.stop_latency_p50_s': ( False, 0.25 ),
+            'motion.false_starts': ( False, 0 ),
+            'motion.missed_starts': ( False, 0 ),
+            'gap.gap_mean_ms': ( False, 5.0 ),
+            'gap.gap_max_ms': ( False, 10.0 ),
+            'gap.underruns': ( False, 0 ),
+            'api.max_rss_mb': ( False, 2.0 ),
+            'motion.max_rss_mb': ( False, 2.0 ),
+            'gap.max_rss_mb': ( False, 2.0 ) }
+
+# Figures that must be zero in any run
+INVARIANTS = ( 'api.errors', 'motion.false_starts', 'motion.missed_starts', 'gap.underruns' )
+
+
+def percentile( values, p ):
+    if not values:
+        return None
+    values = sorted( values )
+    return values[min( len( values ) - 1, int( p / 100.0 * len( values ) ) )]
+
+
+def max_rss_mb():
+    return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024.0
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind( ('127.0.0.1', 0) )
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class SimPlayback( object ):
+    """Stands in for a PlaybackManager, which needs pyspotify. Commands run
+    on a SessionActor and play from a PlayQueue through the fake session's
+    player and, if given, a BufferedAudioOutput, as the jukebox does: at
+    the end of a track the next starts straight away, following on from
+    the frames still buffered. Records the clock times playback started and
+    stopped."""
+
+    def __init__( self, session, actor, zone='default', output=None, owns_actor=False ):
+        self.session = session
+        self.actor = actor
+        self.zone = zone
+        self.output = output
+        self.owns_actor = owns_actor
+        self.clock = session.clock
+        self.queue = PlayQueue()
+        self._is_playing = False
+        self.__playlist = 0
+        self.__entry = None          # (playlist, track) loaded on the player
+        self.started = []
+        self.stopped = []
+        session.add_end_of_track_listener( lambda sess: self.actor.submit( self.__end_of_track ) )
+
+    def pause_playback( self ):
+        return self.actor.submit( self.__pause_playback, coalesce=( self.zone, 'playing' ) )
+
+    def resume_playback( self ):
+        return self.actor.submit( self.__resume_playback, coalesce=( self.zone, 'playing' ) )
+
+    def next_track( self ):
+        return self.actor.submit( self.__next_track )
+
+    def set_current_playlist( self, playlist_index ):
+        return self.actor.submit( self.__set_current_playlist, playlist_index )
+
+    def is_playing( self ):
+        return self._is_playing
+
+    def state( self ):
+        return { 'zone': self.zone,
+                 'playing': self._is_playing,
+                 'playlist_index': self.__playlist,
+                 'track': list( self.__entry ) if self.__entry is not None else None,
+                 'queue_length': len( self.queue ),
+                 'queue_position': self.queue.position,
+                 'logged_in': True }
+
+    def snapshot( self ):
+        return self.actor.submit( lambda: { 'playing': self._is_playing, 'playlist_index': self.__playlist,
+                                            'queue': self.queue.snapshot() } )
+
+    def restore( self, state ):
+        fut = Future()
+        fut.set_result( None )
+        return fut
+
+    def finish( self ):
+        if self.owns_actor:
+            self.actor.stop()
+
+    #
+    # Commands; run on the actor thread
+
+    def __pause_playback( self ):
+        if not self._is_playing:
+            return False
+        self._is_playing = False
+        self.session.play( False )
+        if self.output is not None:
+            self.output.stop()
+        self.stopped.append( self.clock() )
+        return True
+
+    def __resume_playback( self ):
+        if self._is_playing:
+            return False
+        if self.__entry is None:
+            self.__load_next()
+        if self.output is not None:
+            self.output.start()
+        self.session.play( True )
+        self._is_playing = True
+        self.started.append( self.clock() )
+        return True
+
+    def __next_track( self ):
+        if self.output is not None:
+            self.output.flush()
+        self.__load_next()
+        if self._is_playing:
+            self.session.play( True )
+
+    def __end_of_track( self ):
+        self.__load_next()
+        if self._is_playing:
+            self.session.play( True )
+
+    def __set_current_playlist( self, playlist_index ):
+        if not 0 <= playlist_index < len( self.session.container ):
+            raise IndexError( "Playlist index out of range: %d" % playlist_index )
+        changed = self.__playlist != playlist_index
+        self.__playlist = playlist_index
+        self.queue.clear()
+        return changed
+
+    def __load_next( self ):
+        if not len( self.queue ):
+            playlist = self.session.container[self.__playlist]
+            self.queue.append_range( self.__playlist, 0, len( playlist ) )
+        self.__entry = self.queue.popleft()
+        playlist, track = self.__entry
+        self.session.load( self.session.container[playlist][track] )
+
+
+class SimController( CentralController ):
+    """The controller, with SimPlayback managers on the fake session and a
+    throwaway metadata store, filled from the session's container once it
+    loads, as the jukebox fills it."""
+
+    def __init__( self, session, **kwargs ):
+        CentralController.__init__( self, **kwargs )
+        self.session = session
+        self.catalogue_loaded = threading.Event()
+
+    def start_metadata( self ):
+        from metadata_store import MetadataStore
+        from search_index import SearchIndex
+        self.metadata_store = MetadataStore( os.path.join( tempfile.mkdtemp(), 'symfopi.db' ) )
+        self.search_index = SearchIndex()
+        container = self.session.playlist_container()
+        container.add_loaded_callback( self.container_loaded )
+        if container.is_loaded():
+            self.container_loaded( container, None )
+
+    def container_loaded( self, container, userdata ):
+        playlists = [ ( ( p.uri, p.name() ),
+                        [ ( t.uri, t.name(), t.artists()[0].name(), t.album().name(), t.duration() ) for t in p ] )
+                      for p in container ]
+        for cat in ( self.metadata_store, self.search_index ):
+            cat.sync_container( playlists )
+        self.catalogue_loaded.set()
+
+    def start_playback( self ):
+        self.playback_manager = SimPlayback( self.session, SessionActor(), self.zone_names[0], owns_actor=True )
+
+    def start_zones( self ):
+        self.add_zone( self.zone_names[0], self.playback_manager )
+        for name in self.zone_names[1:]:
+            self.add_zone( name, SimPlayback( self.session, self.playback_manager.actor, name ) )
+        self.restore_state()
+
+
+#
+# api
+
+# (method, path, weight) of the requests the clients make
+API_MIX = ( ( 'GET', '/get_playback_state', 40 ),
+            ( 'GET', '/zones', 10 ),
+            ( 'GET', '/get_playlists', 20 ),
+            ( 'GET', '/search?q=track+1', 20 ),
+            ( 'PUT', '/zones/kitchen/next_track', 10 ) )
+
+
+def scenario_api( args ):
+    session = FakeSession( latency=0.05, jitter=0.02, login_latency=0.5, load_latency=0.01 )
+    session.make_catalogue( args.playlists, args.tracks_per_playlist )
+    port = free_port()
+    cc = SimController( session, api_address=( '127.0.0.1', port ), zone_names=( 'default', 'kitchen' ) )
+    server = threading.Thread( target=cc.start )
+    server.start()
+    while True:
+        try:
+            conn = httplib.HTTPConnection( '127.0.0.1', port, timeout=5 )
+            conn.request( 'GET', '/health' )
+            if json.loads( conn.getresponse().read() )['ready']:
+                break
+        except socket.error:
+            pass
+        time.sleep( 0.01 )
+    # Searches are all answered locally once the catalogue is in
+    cc.catalogue_loaded.wait()
+    cc.metadata_store.flush()
+
+    weighted = [ ( method, path ) for method, path, weight in API_MIX for i in xrange( weight ) ]
+    latencies = []
+    errors = [ 0 ]
+    lock = threading.Lock()
+    deadline = time.time() + args.api_seconds
+
+    def client( seed ):
+        rnd = random.Random( seed )
+        conn = httplib.HTTPConnection( '127.0.0.1', port, timeout=10 )
+        mine = []
+        failed = 0
+        while time.time() < deadline:
+            method, path = rnd.choice( weighted )
+            t0 = time.time()
+            conn.request( method, path, '' if method == 'PUT' else None )
+            resp = conn.getresponse()
+            resp.read()
+            mine.append( time.time() - t0 )
+            if resp.status >= 400:
+                failed += 1
+        conn.close()
+        with lock:
+            latencies.extend( mine )
+            errors[0] += failed
+
+    t0 = time.time()
+    clients = [ threading.Thread( target=client, args=( i, ) ) for i in xrange( args.clients ) ]
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    elapsed = time.time() - t0
+
+    cc.request_stop()
+    server.join()
+    session.close()
+    return { 'requests_per_sec': len( latencies ) / elapsed,
+             'latency_p50_ms': percentile( latencies, 50 ) * 1000,
+             'latency_p99_ms': percentile( latencies, 99 ) * 1000,
+             'errors': errors[0] }
+
+
+#
+# motion
+
+class ScriptedPresence( MotionSensor ):
+    """A motion sensor with someone coming and going: while present, for
+    a stay of `stay` seconds, motion is reported every second, as a PIR
+    sensor retriggers; when they leave, stillness is reported. While
+    nobody is there, a spurious reading comes now and then. Records the
+    clock times of arrivals, departures and spurious readings."""
+
+    def __init__( self, scheduler, rnd, stay=( 10.0, 600.0 ), away=( 30.0, 1800.0 ), spurious_per_hour=2.0 ):
+        self.scheduler = scheduler
+        self.rnd = rnd
+        self.stay = stay
+        self.away = away
+        self.spurious_per_hour = spurious_per_hour
+        self.arrivals = []
+        self.departures = []
+        self.spurious = []
+        self.__report = None
+        self.__present = False
+        self.__leave_at = None
+        self.__stopped = True
+
+    def start( self, report_motion ):
+        self.__report = report_motion
+        self.__stopped = False
+        self.scheduler.call_later( self.rnd.uniform( *self.away ), self.__arrive )
+        self.__schedule_spurious()
+
+    def stop( self ):
+        self.__stopped = True
+
+    def __arrive( self ):
+        if self.__stopped:
+            return
+        now = self.scheduler.clock()
+        self.arrivals.append( now )
+        self.__present = True
+        self.__leave_at = now + self.rnd.uniform( *self.stay )
+        self.__retrigger()
+
+    def __retrigger( self ):
+        if self.__stopped:
+            return
+        if self.scheduler.clock() >= self.__leave_at:
+            self.__present = False
+            self.departures.append( self.scheduler.clock() )
+            self.__report( False )
+            self.scheduler.call_later( self.rnd.uniform( *self.away ), self.__arrive )
+            return
+        self.__report( True )
+        self.scheduler.call_later( 1.0, self.__retrigger )
+
+    def __schedule_spurious( self ):
+        self.scheduler.call_later( self.rnd.expovariate( self.spurious_per_hour / 3600.0 ), self.__spurious )
+
+    def __spurious( self ):
+        if self.__stopped:
+            return
+        if not self.__present:
+            self.spurious.append( self.scheduler.clock() )
+            self.__report( True )
+            self.scheduler.call_later( 0.2, self.__spurious_end )
+        self.__schedule_spurious()
+
+    def __spurious_end( self ):
+        if not self.__stopped and not self.__present:
+            self.__report( False )
+
+
+def scenario_motion( args ):
+    clock = VirtualClock( args.speed )
+    session = FakeSession( latency=0.05, jitter=0.02, clock=clock, login_latency=1.0, load_latency=0.2 )
+    session.make_catalogue( 5, 50 )
+    sensors = []
+
+    def sensor_factory( scheduler ):
+        sensor = ScriptedPresence( scheduler, random.Random( 7 ) )
+        sensors.append( sensor )
+        return sensor
+
+    cc = SimController( session, clock=clock, sensor_factory=sensor_factory )
+    cc.start_managers()
+    zone = cc.zones.default()
+    sim_started = clock()
+    real_started = time.time()
+    zone.motion_manager.enable_motion_monitor()
+    clock.sleep( args.sim_hours * 3600 )
+    zone.motion_manager.disable_motion_monitor()
+    real_seconds = time.time() - real_started
+    sim_seconds = clock() - sim_started
+    cc.stop()
+    session.close()
+
+    sensor = sensors[0]
+    playback = zone.playback_manager
+    stays = zip( sensor.arrivals, sensor.departures + [ float( 'inf' ) ] )
+    start_latencies = []
+    stop_latencies = []
+    missed = 0
+    for i, ( arrived, departed ) in enumerate( stays ):
+        starts = [ t for t in playback.started if arrived <= t <= departed ]
+        if starts:
+            start_latencies.append( starts[0] - arrived )
+        elif not any( s <= arrived and ( i == 0 or s >= stays[i - 1][1] ) for s in playback.started ):
+            # Not started, nor still playing from the stay before
+            missed += 1
+        next_arrival = stays[i + 1][0] if i + 1 < len( stays ) else float( 'inf' )
+        stops = [ t for t in playback.stopped if departed <= t < next_arrival ]
+        if stops:
+            stop_latencies.append( stops[0] - departed )
+    false_starts = sum( 1 for t in playback.started
+                        if not any( arrived <= t <= departed for arrived, departed in stays ) )
+    return { 'sim_hours': sim_seconds / 3600.0,
+             'speed': sim_seconds / real_seconds,
+             'stays': len( sensor.arrivals ),
+             'spurious_readings': len( sensor.spurious ),
+             'start_latency_p50_s': percentile( start_latencies, 50 ),
+             'start_latency_p90_s': percentile( start_latencies, 90 ),
+             'stop_latency_p50_s': percentile( stop_latencies, 50 ),
+             'false_starts': false_starts,
+             'missed_starts': missed }
+
+
+#
+# gap
+
+class GapSink( object ):
+    """An audio device playing frames in real time, with room for
+    `device_frames` ahead. Records the silence heard between tracks, told
+    apart by the load number the fake session writes into each frame, and
+    mid-track underruns."""
+
+    def __init__( self, device_frames=4096 ):
+        self.device_frames = device_frames
+        self.dry_at = None          # time the frames given so far run out
+        self.track = None
+        self.tracks = 0
+        self.gaps = []
+        self.underruns = 0
+
+    def music_delivery( self, session, frames, frame_size, num_frames, sample_type, sample_rate, channels ):
+        now = time.time()
+        track = struct.unpack_from( 'I', frames )[0]
+        if self.dry_at is None or track != self.track:
+            if self.dry_at is not None:
+                self.gaps.append( max( 0.0, now - self.dry_at ) * 1000 )
+            self.track = track
+            self.tracks += 1
+        elif now > self.dry_at + 0.001:
+            self.underruns += 1
+        queued = max( 0.0, ( self.dry_at or now ) - now ) * sample_rate
+        n = max( 0, min( num_frames, int( self.device_frames - queued ) ) )
+        if n:
+            self.dry_at = max( now, self.dry_at or now ) + float( n ) / sample_rate
+        return n
+
+    def start( self ):
+        pass
+
+    def stop( self ):
+        pass
+
+    def end_of_track( self ):
+        pass
+
+
+def scenario_gap( args ):
+    session = FakeSession( latency=0.05, jitter=0.02, load_latency=args.load_latency, login_latency=0.0 )
+    container = session.make_catalogue( 1, args.tracks + 1, track_ms=( 1500, 2500 ) )
+    sink = GapSink()
+    output = BufferedAudioOutput( sink )
+    session.music_sink = output
+    actor = SessionActor()
+    playback = SimPlayback( session, actor, output=output )
+    while not container.is_loaded():
+        time.sleep( 0.01 )
+
+    playback.resume_playback()
+    deadline = time.time() + args.tracks * 5
+    while sink.tracks <= args.tracks and time.time() < deadline:
+        time.sleep( 0.05 )
+    playback.pause_playback().result()
+    output.finish()
+    actor.stop()
+    session.close()
+    return { 'transitions': len( sink.gaps ),
+             'gap_mean_ms': sum( sink.gaps ) / len( sink.gaps ) if sink.gaps else None,
+             'gap_max_ms': max( sink.gaps ) if sink.gaps else None,
+             'underruns': sink.underruns }
+
+
+#
+# Running and comparing
+
+def run_scenario( name, args ):
+    cmd = [ sys.executable, os.path.abspath( __file__ ), '--child', name ]
+    for opt in ( 'clients', 'api_seconds', 'playlists', 'tracks_per_playlist', 'speed', 'sim_hours',
+                 'tracks', 'load_latency' ):
+        cmd += [ '--' + opt.replace( '_', '-' ), str( getattr( args, opt ) ) ]
+    out = subprocess.check_output( cmd )
+    return json.loads( out.strip().splitlines()[-1] )
+
+
+def compare( results, baseline, tolerance ):
+    """Return a list of descriptions of the figures that are worse than the
+    baseline by more than is allowed."""
+    worse = []
+    for key, ( higher_better, slack ) in sorted( METRICS.iteritems() ):
+        scenario, metric = key.split( '.' )
+        new = results.get( scenario, {} ).get( metric )
+        old = baseline.get( scenario, {} ).get( metric )
+        if new is None or old is None:
+            continue
+        allowed = abs( old ) * tolerance + slack
+        if ( old - new if higher_better else new - old ) > allowed:
+            worse.append( "%s: %.3f, baseline %.3f" % ( key, new, old ) )
+    return worse
+
+
+def broken( results, args ):
+    """Lines describing each invariant the results break."""
+    lines = []
+    for key in INVARIANTS:
+        scenario, metric = key.split( '.' )
+        value = results.get( scenario, {} ).get( metric )
+        if value:
+            lines.append( "%s: %s" % ( key, value ) )
+    if 'gap' in results and results['gap']['transitions'] != args.tracks:
+        lines.append( "gap.transitions: %d of %d track changes" % ( results['gap']['transitions'], args.tracks ) )
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--scenarios', nargs='+', choices=SCENARIOS, default=list( SCENARIOS ) )
+    parser.add_argument( '--clients', type=int, default=8 )
+    parser.add_argument( '--api-seconds', type=float, default=5.0 )
+    parser.add_argument( '--playlists', type=int, default=50 )
+    parser.add_argument( '--tracks-per-playlist', type=int, default=200 )
+    parser.add_argument( '--speed', type=float, default=1000.0, help="speed of the motion scenario's clock" )
+    parser.add_argument( '--sim-hours', type=float, default=8.0 )
+    parser.add_argument( '--tracks', type=int, default=8, help="track changes in the gap scenario" )
+    parser.add_argument( '--load-latency', type=float, default=0.3 )
+    parser.add_argument( '--save-baseline', metavar='FILE' )
+    parser.add_argument( '--baseline', metavar='FILE' )
+    parser.add_argument( '--tolerance', type=float, default=0.25,
+                         help="relative worsening allowed against the baseline" )
+    parser.add_argument( '--child', help=argparse.SUPPRESS )
+    args = parser.parse_args()
+
+    if args.child:
+        result = globals()['scenario_' + args.child]( args )
+        result['max_rss_mb'] = max_rss_mb()
+        print json.dumps( result )
+        sys.exit( 0 )
+
+    results = {}
+    for name in args.scenarios:
+        results[name] = run_scenario( name, args )
+        print "%-7s %s" % ( name, '  '.join( '%s=%s' % ( k, '%.3f' % v if isinstance( v, float ) else v )
+                                             for k, v in sorted( results[name].iteritems() ) ) )
+
+    if args.save_baseline:
+        with open( args.save_baseline, 'w' ) as f:
+            json.dump( results, f, indent=2, sort_keys=True )
+    failures = broken( results, args )
+    for line in failures:
+        print "FAILED  " + line
+    if args.baseline:
+        with open( args.baseline ) as f:
+            worse = compare( results, json.load( f ), args.tolerance )
+        for line in worse:
+            print "WORSE THAN BASELINE  " + line
+        failures += worse
+    sys.exit( 1 if failures else 0 )
@@ -0,0 +1,108 @@
+"""Benchmark for the offline search index.
+
+Indexes a synthetic catalogue of playlists and tracks, with names drawn from
+a vocabulary of made-up words, then reports the latency of search-as-you-type
+queries (each prefix of a word, as it is typed), of multi-word queries and of
+incremental updates.
+
+    python bench_search_index.py --tracks 100000 --queries 20000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from search_index import SearchIndex
+
+SYLLABLES = [ 'ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'ba', 'do', 'fi',
+              'gu', 'ha', 'je', 'po', 'qui', 'wa', 'xe', 'yo', 'ar', 'el', 'in', 'ou' ]
+
+
+def make_words( rnd, count ):
+    words = set()
+    while len( words ) < count:
+        words.add( ''.join( rnd.choice( SYLLABLES ) for i in xrange( rnd.randint( 2, 4 ) ) ) )
+    return sorted( words )
+
+
+def make_catalogue( rnd, num_tracks, tracks_per_playlist, vocabulary ):
+    def name( n ):
+        return ' '.join( rnd.choice( vocabulary ) for i in xrange( rnd.randint( 1, n ) ) ).title()
+
+    artists = [ name( 2 ) for i in xrange( max( num_tracks // 50, 1 ) ) ]
+    albums = [ name( 3 ) for i in xrange( max( num_tracks // 12, 1 ) ) ]
+    playlists = []
+    for p in xrange( ( num_tracks + tracks_per_playlist - 1 ) // tracks_per_playlist ):
+        tracks = []
+        for i in xrange( p * tracks_per_playlist, min( ( p + 1 ) * tracks_per_playlist, num_tracks ) ):
+            tracks.append( ( 'spotify:track:%022d' % i, name( 4 ), rnd.choice( artists ),
+                             rnd.choice( albums ), rnd.randint( 90000, 400000 ) ) )
+        playlists.append( ( ( 'spotify:user:bench:playlist:%d' % p, name( 3 ) ), tracks ) )
+    return playlists
+
+
+def percentile( samples, pct ):
+    samples = sorted( samples )
+    return samples[min( int( len( samples ) * pct / 100.0 ), len( samples ) - 1 )]
+
+
+def time_queries( index, queries ):
+    latencies = []
+    for q in queries:
+        t0 = time.time()
+        index.search_tracks( q )
+        index.search_playlists( q )
+        latencies.append( ( time.time() - t0 ) * 1000 )
+    return latencies
+
+
+def report( label, latencies ):
+    print "%-24s %8d queries   mean %.3f ms   p50 %.3f ms   p99 %.3f ms   max %.3f ms" % (
+        label, len( latencies ), sum( latencies ) / len( latencies ),
+        percentile( latencies, 50 ), percentile( latencies, 99 ), max( latencies ) )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--tracks', type=int, default=100000 )
+    parser.add_argument( '--tracks-per-playlist', type=int, default=200 )
+    parser.add_argument( '--words', type=int, default=20000 )
+    parser.add_argument( '--queries', type=int, default=20000 )
+    args = parser.parse_args()
+
+    rnd = random.Random( 1 )
+    vocabulary = make_words( rnd, args.words )
+    playlists = make_catalogue( rnd, args.tracks, args.tracks_per_playlist, vocabulary )
+
+    index = SearchIndex()
+    t0 = time.time()
+    index.sync_container( playlists )
+    print "Indexed %d tracks in %d playlists in %.2f s" % ( len( index ), len( playlists ), time.time() - t0 )
+
+    typed = []
+    while len( typed ) < args.queries:
+        word = rnd.choice( vocabulary )
+        typed.extend( word[:n] for n in xrange( 1, len( word ) + 1 ) )
+    report( "search-as-you-type", time_queries( index, typed[:args.queries] ) )
+
+    multi = []
+    for i in xrange( args.queries ):
+        _, name, artist, album, _ = rnd.choice( rnd.choice( playlists )[1] )
+        words = ( name + ' ' + artist ).split()
+        rnd.shuffle( words )
+        last = words[1] if len( words ) > 1 else words[0]
+        multi.append( "%s %s" % ( words[0], last[:rnd.randint( 1, len( last ) )] ) )
+    report( "two-word", time_queries( index, multi ) )
+
+    updates = []
+    for i in xrange( min( args.queries, 2000 ) ):
+        ( uri, name ), tracks = rnd.choice( playlists )
+        new = ( 'spotify:track:new%019d' % i, ' '.join( rnd.sample( vocabulary, 3 ) ), 'Bench Artist',
+                'Bench Album', 200000 )
+        t0 = time.time()
+        index.tracks_added( uri, rnd.randint( 0, len( tracks ) ), [ new ] )
+        updates.append( ( time.time() - t0 ) * 1000 )
+    report( "tracks_added", updates )
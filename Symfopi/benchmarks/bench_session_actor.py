@@ -0,0 +1,174 @@
+"""Concurrency stress test for playback commands.
+
+Hammers the fake session's player with API requests (skip track,
+pause/resume) from many keep-alive clients while a motion sensor flips
+between motion and stillness as fast as it can, first calling the session
+directly from every thread, as PlaybackManager used to, then through a
+SessionActor. The fake session counts calls that overlap another call,
+which are races in the real libspotify session.
+
+It exits non-zero if any call overlaps another through the actor, if any
+command submitted to the actor was lost, if any request failed, or if
+calling directly found no races, which would mean the count is not
+catching them.
+
+    python bench_session_actor.py --clients 16 --duration 5
+"""
+import os
+import sys
+import time
+import threading
+import argparse
+import httplib
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from fake_spotify import FakeSession
+from api_server import EventLoopHTTPServer
+from motion import MotionMonitor, MotionSensor
+from scheduler import Scheduler
+from session_actor import SessionActor
+
+
+class StressPlayback( object ):
+    """The playback manager's command methods, either calling the session
+    straight away or going through a SessionActor as PlaybackManager does."""
+
+    def __init__( self, session, actor=None ):
+        self.session = session
+        self.actor = actor
+        self.tracks = session.make_album( 'Stress' ).tracks
+        self.loads = 0
+
+    def __run( self, func, coalesce=None ):
+        if self.actor is None:
+            func()
+        else:
+            # The API responds once the Future completes, as with the
+            # central controller
+            return self.actor.submit( func, coalesce=coalesce )
+
+    def __next( self ):
+        self.loads += 1
+        self.session.load( self.tracks[self.loads % len( self.tracks )] )
+        self.session.play( 1 )
+
+    def pause_playback( self ):
+        return self.__run( lambda: self.session.play( 0 ), coalesce='playing' )
+
+    def resume_playback( self ):
+        return self.__run( lambda: self.session.play( 1 ), coalesce='playing' )
+
+    def next_track( self ):
+        return self.__run( self.__next )
+
+    def do_next_track( self, qargs_dict ):
+        return self.next_track()
+
+    def do_set_playback_enabled( self, qargs_dict ):
+        if qargs_dict.get( 'flag', ['true'] )[0] == 'true':
+            return self.resume_playback()
+        else:
+            return self.pause_playback()
+
+
+class FlappingSensor( MotionSensor ):
+    """Reports motion and stillness alternately, as fast as it can."""
+
+    def start( self, report_motion ):
+        self.__stop = False
+        def run():
+            detected = True
+            while not self.__stop:
+                report_motion( detected )
+                detected = not detected
+                time.sleep( 0.0005 )
+        self.__thread = threading.Thread( target=run )
+        self.__thread.start()
+
+    def stop( self ):
+        self.__stop = True
+        self.__thread.join()
+
+
+def client_loop( port, deadline, count, failed ):
+    conn = httplib.HTTPConnection( '127.0.0.1', port, timeout=10 )
+    paths = [ '/next_track', '/set_playback_enabled?flag=false', '/set_playback_enabled?flag=true' ]
+    n = 0
+    while time.time() < deadline:
+        conn.request( 'PUT', paths[n % len( paths )] )
+        resp = conn.getresponse()
+        resp.read()
+        if resp.status != 200:
+            failed.append( resp.status )
+        n += 1
+    conn.close()
+    count.append( n )
+
+
+def run( mode, args ):
+    # Loading a track takes a little while, as it does in libspotify
+    session = FakeSession( latency=0, jitter=0, load_latency=args.call_ms / 1000.0 )
+    actor = SessionActor() if mode == 'actor' else None
+    playback = StressPlayback( session, actor )
+
+    httpd = EventLoopHTTPServer( ('127.0.0.1', 0), playback )
+    httpd.register_api_function( 'next_track', playback.do_next_track, 'PUT' )
+    httpd.register_api_function( 'set_playback_enabled', playback.do_set_playback_enabled, 'PUT' )
+    server_thread = threading.Thread( target=httpd.serve_forever )
+    server_thread.start()
+
+    scheduler = Scheduler()
+    monitor = MotionMonitor( FlappingSensor(), scheduler, playback.resume_playback, playback.pause_playback,
+                             start_debounce=0.0, stop_hold=0.0 )
+    monitor.start()
+
+    count, failed = [], []
+    deadline = time.time() + args.duration
+    clients = [ threading.Thread( target=client_loop, args=( httpd.server_address[1], deadline, count, failed ) )
+                for i in xrange( args.clients ) ]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+
+    monitor.stop()
+    scheduler.stop()
+    if actor is not None:
+        actor.stop()
+    httpd.shutdown()
+    server_thread.join()
+    session.close()
+
+    print "%-7s requests %6d  motion transitions %6d  session calls %6d  loads %5d  overlapping calls %5d" % (
+        mode, sum( count ), monitor.transitions, session.player_calls, playback.loads, session.overlapping_calls )
+    failures = []
+    if failed:
+        failures.append( "%s: %d requests failed" % ( mode, len( failed ) ) )
+    if actor is not None:
+        print "        commands submitted %d, executed %d, coalesced %d" % (
+            actor.submitted, actor.executed, actor.coalesced )
+        if session.overlapping_calls:
+            failures.append( "actor: %d calls overlapped another" % session.overlapping_calls )
+        if actor.executed + actor.coalesced != actor.submitted:
+            failures.append( "actor: %d commands submitted, but %d executed and %d coalesced" % (
+                actor.submitted, actor.executed, actor.coalesced ) )
+    elif not session.overlapping_calls:
+        failures.append( "direct: no calls overlapped, so overlaps are not being caught" )
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--clients', type=int, default=16 )
+    parser.add_argument( '--duration', type=float, default=5.0 )
+    parser.add_argument( '--call-ms', type=float, default=0.2,
+                         help="time taken to load a track" )
+    args = parser.parse_args()
+
+    failures = []
+    for mode in ( 'direct', 'actor' ):
+        failures += run( mode, args )
+    for line in failures:
+        print "FAILED  " + line
+    sys.exit( 1 if failures else 0 )
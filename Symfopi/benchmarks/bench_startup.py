@@ -0,0 +1,150 @@
+"""Benchmark for controller start-up: import time, and time from launch
+until the API is listening and until every manager is ready.
+
+Each start runs in a fresh process. 'eager' builds the managers and then
+binds the API, as the controller used to; 'lazy' is the controller as it
+is, listening first and building the managers in the background. pyspotify
+is not loaded: the playback manager is a stand-in taking --session-secs to
+build, for libspotify's session set-up and the audio sink.
+
+    python bench_startup.py --session-secs 2 --runs 3
+"""
+import os
+import sys
+import time
+import json
+import socket
+import httplib
+import argparse
+import tempfile
+import subprocess
+
+MANAGERS_DIR = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' )
+sys.path.insert( 0, MANAGERS_DIR )
+
+# Modules central_controller used to import at load, other than pyspotify's
+EAGER_MODULES = ( 'multiprocessing', 'api_server', 'scheduler', 'events', 'metadata_store', 'search_index',
+                  'spotify_API', 'motion', 'sync', 'zones', 'metrics', 'logs' )
+
+
+def import_times():
+    """Child: seconds to import central_controller, and then to import the
+    modules it used to import eagerly."""
+    t0 = time.time()
+    import central_controller
+    lazy = time.time() - t0
+    t0 = time.time()
+    for name in EAGER_MODULES:
+        __import__( name )
+    rest = time.time() - t0
+    print json.dumps( { 'lazy': lazy, 'eager': lazy + rest } )
+
+
+def controller( mode, port, session_secs ):
+    """Child: start a controller serving at `port`."""
+    from central_controller import CentralController
+    from zones import Zone
+    from motion import MotionManager
+
+    class StandInPlayback( object ):
+        def __init__( self, zone ):
+            self.zone = zone
+
+        def is_playing( self ):
+            return False
+
+        def finish( self ):
+            pass
+
+    class BenchController( CentralController ):
+        def start_metadata( self ):
+            from metadata_store import MetadataStore
+            from search_index import SearchIndex
+            self.metadata_store = MetadataStore( os.path.join( tempfile.mkdtemp(), 'symfopi.db' ) )
+            self.search_index = SearchIndex()
+
+        def start_playback( self ):
+            time.sleep( session_secs )
+            self.playback_manager = StandInPlayback( self.zone_names[0] )
+
+        def start_zones( self ):
+            for name in self.zone_names:
+                self.zones.add( Zone( name, StandInPlayback( name ),
+                                      MotionManager( lambda: None, lambda: None, scheduler=self.scheduler ) ) )
+
+        def start_managers( self ):
+            if mode == 'eager' and self.httpd is not None:
+                return      # built before listening; see below
+            CentralController.start_managers( self )
+
+    cc = BenchController( api_address=( '127.0.0.1', port ) )
+    if mode == 'eager':
+        for name in EAGER_MODULES:
+            __import__( name )
+        cc.start_managers()
+    cc.start()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind( ('127.0.0.1', 0) )
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def get_health( port ):
+    conn = httplib.HTTPConnection( '127.0.0.1', port, timeout=5 )
+    conn.request( 'GET', '/health' )
+    return json.loads( conn.getresponse().read() )
+
+
+def time_start( mode, session_secs ):
+    """Return seconds from launch to the API listening and to every manager
+    being ready."""
+    port = free_port()
+    t0 = time.time()
+    proc = subprocess.Popen( [ sys.executable, os.path.abspath( __file__ ), '--child', mode,
+                               '--port', str( port ), '--session-secs', str( session_secs ) ] )
+    listening = None
+    try:
+        while True:
+            try:
+                health = get_health( port )
+            except socket.error:
+                time.sleep( 0.005 )
+                continue
+            if listening is None:
+                listening = time.time() - t0
+            if health['ready']:
+                return listening, time.time() - t0
+            time.sleep( 0.005 )
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--session-secs', type=float, default=2.0 )
+    parser.add_argument( '--runs', type=int, default=3 )
+    parser.add_argument( '--child', help=argparse.SUPPRESS )
+    parser.add_argument( '--port', type=int, help=argparse.SUPPRESS )
+    args = parser.parse_args()
+
+    if args.child == 'imports':
+        import_times()
+        sys.exit( 0 )
+    elif args.child:
+        controller( args.child, args.port, args.session_secs )
+        sys.exit( 0 )
+
+    imports = [ json.loads( subprocess.check_output( [ sys.executable, os.path.abspath( __file__ ), '--child', 'imports' ] ) )
+                for i in xrange( args.runs ) ]
+    print "Import time: central_controller %.1f ms; with the managers' modules %.1f ms (best of %d)" % (
+        min( i['lazy'] for i in imports ) * 1000, min( i['eager'] for i in imports ) * 1000, args.runs )
+
+    for mode in ( 'eager', 'lazy' ):
+        times = [ time_start( mode, args.session_secs ) for i in xrange( args.runs ) ]
+        print "%-5s start: listening after %6.0f ms, every manager ready after %6.0f ms (best of %d)" % (
+            mode, min( t[0] for t in times ) * 1000, min( t[1] for t in times ) * 1000, args.runs )
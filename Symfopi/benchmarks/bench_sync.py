@@ -0,0 +1,172 @@
+"""Loopback test of synchronised playback across several controllers.
+
+Runs each follower as a separate local process, with its system clock set
+off by some tens of milliseconds and its audio clock running fast or slow
+by some hundreds of ppm, as different Pis' are. Each plays numbered frames
+through a BufferedAudioOutput into a sink paced by its audio clock, while
+this process leads: it estimates the followers' clock offsets, schedules
+the start and sends its position for drift correction. The skew of each
+follower against the leader, in ms, is measured from the frame each is
+playing at the same true time.
+
+    python bench_sync.py --followers 3 --duration 10
+"""
+import os
+import sys
+import json
+import time
+import array
+import random
+import argparse
+import threading
+import subprocess
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from audio_buffer import BufferedAudioOutput
+from sync import SyncLeader, SyncFollower, DriftCorrector, ClockEstimate
+
+RATE = 44100
+DEVICE_FRAMES = 1024       # frames the stand-in sound card holds
+SECRET = 'bench'           # the messages are signed, as they would be between Pis
+
+
+class PacedSink( object ):
+    """Takes frames at the rate of an audio clock `ppm` off true time, and
+    records the number of each frame taken."""
+
+    def __init__( self, ppm ):
+        self.speed = 1 + ppm * 1e-6
+        self.first = None
+        self.played = array.array( 'I' )
+
+    def music_delivery( self, session, frames, frame_size, num_frames, sample_type, sample_rate, channels ):
+        now = time.time()
+        if self.first is None:
+            self.first = now
+        room = int( ( now - self.first ) * RATE * self.speed ) + DEVICE_FRAMES - len( self.played )
+        n = max( 0, min( num_frames, room ) )
+        self.played.fromstring( frames[:n * frame_size] )
+        return n
+
+    def playing_at( self, t ):
+        """Number of the frame heard at true time `t`."""
+        i = int( ( t - self.first ) * RATE * self.speed )
+        return self.played[min( max( i, 0 ), len( self.played ) - 1 )]
+
+    def start( self ):
+        pass
+
+    def stop( self ):
+        pass
+
+    def end_of_track( self ):
+        pass
+
+
+def follower( args ):
+    base = time.time()
+    offset = args.offset_ms / 1000.0
+    clock_speed = 1 + args.clock_ppm * 1e-6
+    clock = lambda: base + ( time.time() - base ) * clock_speed + offset
+
+    sink = PacedSink( args.audio_ppm )
+    output = BufferedAudioOutput( sink, clock=clock )
+    started = threading.Event()
+
+    def feed():
+        # As libspotify, delivers from when the track is started
+        started.wait( 30 )
+        n = 0
+        while not stop.is_set():
+            frames = array.array( 'I', xrange( n, n + 1024 ) ).tostring()
+            taken = output.music_delivery( None, frames, 4, 1024, 0, RATE, 2 )
+            n += taken
+            if taken < 1024:
+                time.sleep( 0.005 )
+
+    def on_start( uri, when ):
+        output.start_at( when )
+        output.start()
+        started.set()
+
+    corrector = DriftCorrector( output )
+    on_position = corrector.position if args.mode == 'full' else lambda when, frames: None
+    sync = SyncFollower( on_start, on_position, '127.0.0.1', port=0, host='127.0.0.1', clock=clock, secret=SECRET )
+    sync.start()
+    stop = threading.Event()
+    feeder = threading.Thread( target=feed )
+    feeder.start()
+    print sync.address[1]
+    sys.stdout.flush()
+
+    started.wait( 30 )
+    time.sleep( args.duration + 1.0 )
+    stop.set()
+    feeder.join()
+    sync.stop()
+    output.finish()
+    # Frame heard every 10 ms of true time
+    t = sink.first
+    samples = []
+    while sink.first is not None and t < sink.first + args.duration:
+        samples.append( ( t, sink.playing_at( t ) ) )
+        t += 0.01
+    print json.dumps( { 'samples': samples } )
+
+
+def run( mode, args ):
+    rnd = random.Random( 7 )
+    procs = []
+    for i in xrange( args.followers ):
+        cmd = [ sys.executable, os.path.abspath( __file__ ), '--follower', '--mode', mode,
+                '--offset-ms', str( rnd.uniform( -50, 50 ) ), '--clock-ppm', str( rnd.uniform( -50, 50 ) ),
+                '--audio-ppm', str( rnd.uniform( -args.max_ppm, args.max_ppm ) ),
+                '--duration', str( args.duration ) ]
+        procs.append( subprocess.Popen( cmd, stdout=subprocess.PIPE ) )
+    followers = [ ( '127.0.0.1', int( p.stdout.readline() ) ) for p in procs ]
+
+    leader = SyncLeader( followers, secret=SECRET )
+    if mode == 'naive':
+        # Assume every clock agrees with ours
+        for addr in followers:
+            leader.estimates[addr] = ClockEstimate( 0.0, 0.0 )
+    else:
+        leader.measure_all()
+    start = leader.schedule_start( 'spotify:track:bench', lead=0.5 )
+    if mode == 'full':
+        # The position handed to the sound card, as position_at() gives it,
+        # is a device's worth of frames ahead of what is heard
+        leader.start( lambda now: ( now - start ) * RATE + DEVICE_FRAMES if now >= start else None, interval=0.5 )
+
+    results = [ json.loads( p.communicate()[0].strip().splitlines()[-1] ) for p in procs ]
+    leader.stop()
+
+    skews = []      # per follower, ms ahead of the leader at each sample
+    for res in results:
+        skews.append( [ ( frame - ( t - start ) * RATE ) * 1000.0 / RATE for t, frame in res['samples'] ] )
+    first = [ s[0] for s in skews ]
+    late = [ abs( v ) for s in skews for v in s[len( s ) // 2:] ]
+    end = [ s[-1] for s in skews ]
+    print "%-7s start skew %s ms   end skew %s ms   max |skew| over 2nd half %6.2f ms" % (
+        mode, ' '.join( '%+6.2f' % v for v in first ), ' '.join( '%+6.2f' % v for v in end ), max( late ) )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--followers', type=int, default=3 )
+    parser.add_argument( '--duration', type=float, default=10.0 )
+    parser.add_argument( '--max-ppm', type=float, default=500.0,
+                         help="largest audio clock error of a follower" )
+    parser.add_argument( '--follower', action='store_true', help=argparse.SUPPRESS )
+    parser.add_argument( '--mode', default='full', help=argparse.SUPPRESS )
+    parser.add_argument( '--offset-ms', type=float, default=0.0, help=argparse.SUPPRESS )
+    parser.add_argument( '--clock-ppm', type=float, default=0.0, help=argparse.SUPPRESS )
+    parser.add_argument( '--audio-ppm', type=float, default=0.0, help=argparse.SUPPRESS )
+    args = parser.parse_args()
+
+    if args.follower:
+        follower( args )
+    else:
+        for mode in ( 'naive', 'offset', 'full' ):
+            run( mode, args )
@@ -0,0 +1,164 @@
+"""Benchmark for restarting the controller: time to the first API response,
+with and without a playback state snapshot to resume from.
+
+Each start runs in a fresh process. A cold start logs in (a stand-in
+session that takes --login-secs) and loads the catalogue before serving,
+as the controller did; a warm start restores the playback state saved in
+symfopi.db, serves it straight away and logs in in the background. Also
+reports the cost of saving a snapshot as the state changes.
+
+    python bench_warm_start.py --login-secs 3 --runs 3
+"""
+import os
+import sys
+import time
+import json
+import socket
+import shutil
+import httplib
+import argparse
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from metadata_store import MetadataStore
+from play_queue import PlayQueue
+
+
+def make_store( db_path, playlists=50, tracks_per_playlist=200 ):
+    store = MetadataStore( db_path )
+    store.sync_container( [ ( ( 'spotify:user:bench:playlist:%d' % p, 'Playlist %d' % p ),
+                              [ ( 'spotify:track:%022d' % ( p * 1000 + i ), 'Track %d' % i, 'Artist', 'Album', 200000 )
+                                for i in xrange( tracks_per_playlist ) ] )
+                            for p in xrange( playlists ) ] )
+    return store
+
+
+def make_state():
+    queue = PlayQueue()
+    for p in xrange( 5 ):
+        queue.append_range( p, 0, 200 )
+    for i in xrange( 37 ):
+        queue.popleft()
+    queue.shuffle( 42 )
+    return { 'playing': True, 'playlist_index': 3, 'queue': queue.snapshot(),
+             'track': [ 0, 36 ], 'position_ms': 81250, 'motion_control': True }
+
+
+class ZoneState( object ):
+    """The parts of the controller the restarted process needs: the
+    playback state, restored or built once logged in, and the API call
+    that reads it."""
+
+    def __init__( self ):
+        self.queue = PlayQueue()
+        self.state = None
+        self.logged_in = False
+
+    def do_get_playback_state( self, qargs_dict ):
+        state = dict( self.state or {} )
+        state.update( queue_length=len( self.queue ), logged_in=self.logged_in )
+        return state
+
+
+def child( mode, db_path, port, login_secs ):
+    from api_server import EventLoopHTTPServer
+
+    zone = ZoneState()
+
+    def log_in():
+        # Stands in for the libspotify login and container load
+        time.sleep( login_secs )
+        store.playlists()
+        zone.logged_in = True
+
+    store = MetadataStore( db_path )
+    if mode == 'cold':
+        log_in()
+        zone.state = { 'playing': False }
+    else:
+        state = store.playback_state( 'default' )
+        zone.queue.restore( state['queue'] )
+        zone.state = state
+        threading.Thread( target=log_in ).start()
+
+    httpd = EventLoopHTTPServer( ('127.0.0.1', port), zone )
+    httpd.register_api_function( 'get_playback_state', zone.do_get_playback_state, 'GET', inline=True )
+    threading.Thread( target=httpd.serve_forever ).start()
+    sys.stdin.read()      # until the parent is done
+    httpd.shutdown()
+    store.close()
+    os._exit( 0 )
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind( ('127.0.0.1', 0) )
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def time_to_first_response( mode, db_path, login_secs ):
+    port = free_port()
+    t0 = time.time()
+    proc = subprocess.Popen( [ sys.executable, os.path.abspath( __file__ ), '--child', mode, '--db', db_path,
+                               '--port', str( port ), '--login-secs', str( login_secs ) ],
+                             stdin=subprocess.PIPE )
+    while True:
+        try:
+            conn = httplib.HTTPConnection( '127.0.0.1', port, timeout=5 )
+            conn.request( 'GET', '/get_playback_state' )
+            resp = conn.getresponse()
+            body = json.loads( resp.read() )
+            if resp.status == 200:
+                break
+        except socket.error:
+            time.sleep( 0.005 )
+    elapsed = time.time() - t0
+    proc.communicate( '' )
+    return elapsed, body
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--login-secs', type=float, default=3.0 )
+    parser.add_argument( '--runs', type=int, default=3 )
+    parser.add_argument( '--child', help=argparse.SUPPRESS )
+    parser.add_argument( '--db', help=argparse.SUPPRESS )
+    parser.add_argument( '--port', type=int, help=argparse.SUPPRESS )
+    args = parser.parse_args()
+
+    if args.child:
+        child( args.child, args.db, args.port, args.login_secs )
+
+    tmp = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join( tmp, 'symfopi.db' )
+        store = make_store( db_path )
+        state = make_state()
+
+        # Snapshot writes, as made on each state change
+        n = 2000
+        t0 = time.time()
+        for i in xrange( n ):
+            state['position_ms'] = i
+            store.save_playback_state( 'default', state )
+        queued = time.time() - t0
+        store.flush()
+        total = time.time() - t0
+        print "Snapshot of %d bytes: %.1f us per save call, %.1f ms for %d saves to reach disk" % (
+            len( json.dumps( state ) ), queued / n * 1e6, total * 1000, n )
+        store.close()
+
+        for mode in ( 'cold', 'warm' ):
+            times = []
+            for i in xrange( args.runs ):
+                elapsed, body = time_to_first_response( mode, db_path, args.login_secs )
+                times.append( elapsed )
+            print "%s start: first API response after %6.0f ms (best of %d); queue %d, logged in %s" % (
+                mode, min( times ) * 1000, args.runs, body['queue_length'], body['logged_in'] )
+    finally:
+        shutil.rmtree( tmp )
@@ -0,0 +1,138 @@
+"""Benchmark for the memory taken by serving several rooms: one controller
+process per room, against one process hosting every room as a zone.
+
+Each measurement runs in a fresh child process, which builds what a
+controller holds (scheduler, event broker, session actor, offline session,
+metadata store and search index over a catalogue, API server) and then one
+or more zones, each with a play queue, playback state and an enabled motion
+manager, and reports its resident set size. libspotify is not loaded, so the
+per-process figures leave out its own memory and cache, which one process
+per room would also repeat, along with a login per room.
+
+    python bench_zones.py --zones 1 5 10 20 --tracks 20000
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+
+def rss_kb():
+    with open( '/proc/self/status' ) as f:
+        for line in f:
+            if line.startswith( 'VmRSS:' ):
+                return int( line.split()[1] )
+    raise RuntimeError( "No VmRSS in /proc/self/status" )
+
+
+class ZonePlayback( object ):
+    """What a zone's PlaybackManager holds of its own when it shares the
+    session: its zone name, queue and playback state. (playback.py needs
+    pyspotify to import.)"""
+
+    def __init__( self, zone, actor ):
+        from play_queue import PlayQueue
+        self.zone = zone
+        self.actor = actor
+        self.queue = PlayQueue()
+        self._is_playing = False
+
+    def is_playing( self ):
+        return self._is_playing
+
+    def finish( self ):
+        pass
+
+
+def child( num_zones, tracks, checkpoints ):
+    from api_server import EventLoopHTTPServer
+    from events import EventBroker
+    from fake_spotify import FakeSession
+    from browse import BrowseLoader
+    from metadata_store import MetadataStore
+    from motion import MotionManager
+    from scheduler import Scheduler
+    from search_index import SearchIndex
+    from session_actor import SessionActor
+    from zones import Zone, ZoneRegistry
+
+    results = { 'interpreter': rss_kb() }
+
+    scheduler = Scheduler()
+    events = EventBroker( scheduler )
+    actor = SessionActor()
+    session = FakeSession( latency=0.0, jitter=0.0 )
+    loader = BrowseLoader( session, session.artist_browser, session.toplist_browser )
+    db_dir = tempfile.mkdtemp()
+    store = MetadataStore( os.path.join( db_dir, 'symfopi.db' ) )
+    index = SearchIndex()
+    rnd = random.Random( 1 )
+    playlists = []
+    for p in xrange( tracks // 200 ):
+        playlists.append( ( ( 'spotify:user:bench:playlist:%d' % p, 'Playlist %d' % p ),
+                            [ ( 'spotify:track:%022d' % ( p * 200 + i ), 'Track %d %d' % ( p, rnd.randint( 0, 99999 ) ),
+                                'Artist %d' % rnd.randint( 0, 999 ), 'Album %d' % rnd.randint( 0, 4999 ), 200000 )
+                              for i in xrange( 200 ) ] ) )
+    for cat in ( store, index ):
+        cat.sync_container( playlists )
+    store.flush()
+    httpd = EventLoopHTTPServer( ('127.0.0.1', 0), None )
+    results['shared'] = rss_kb()
+
+    registry = ZoneRegistry()
+    for n in xrange( 1, num_zones + 1 ):
+        name = 'zone%d' % n
+        playback = ZonePlayback( name, actor )
+        playback.queue.append_range( n % len( playlists ), 0, 200 )
+        motion = MotionManager( lambda: None, lambda: None, scheduler=scheduler )
+        motion.enable_motion_monitor()
+        registry.add( Zone( name, playback, motion ) )
+        if n in checkpoints:
+            results[n] = rss_kb()
+
+    registry.finish()
+    httpd.server_close()
+    store.close()
+    actor.stop()
+    session.close()
+    scheduler.stop()
+    print json.dumps( results )
+
+
+def run_child( num_zones, tracks, checkpoints ):
+    out = subprocess.check_output( [ sys.executable, os.path.abspath( __file__ ), '--child', str( num_zones ),
+                                     '--tracks', str( tracks ),
+                                     '--checkpoints', ','.join( str( c ) for c in checkpoints ) ] )
+    return json.loads( out.strip().splitlines()[-1] )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=__doc__.splitlines()[0] )
+    parser.add_argument( '--zones', type=int, nargs='+', default=[ 1, 5, 10, 20 ] )
+    parser.add_argument( '--tracks', type=int, default=20000 )
+    parser.add_argument( '--child', type=int, help=argparse.SUPPRESS )
+    parser.add_argument( '--checkpoints', help=argparse.SUPPRESS )
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child( args.child, args.tracks, set( int( c ) for c in args.checkpoints.split( ',' ) ) )
+        sys.exit( 0 )
+
+    one = run_child( 1, args.tracks, [ 1 ] )
+    per_process_mb = one['1'] / 1024.0
+    print "One room per process: %.1f MB each (interpreter %.1f MB, shared state %.1f MB, zone %.2f MB)" % (
+        per_process_mb, one['interpreter'] / 1024.0, ( one['shared'] - one['interpreter'] ) / 1024.0,
+        ( one['1'] - one['shared'] ) / 1024.0 )
+
+    many = run_child( max( args.zones ), args.tracks, args.zones )
+    print
+    print "%6s %18s %18s %16s" % ( "zones", "processes (MB)", "one process (MB)", "per zone (MB)" )
+    for n in sorted( args.zones ):
+        one_process = many[str( n )] / 1024.0
+        print "%6d %18.1f %18.1f %16.3f" % ( n, n * per_process_mb, one_process,
+                                             ( many[str( n )] - many['shared'] ) / 1024.0 / n )
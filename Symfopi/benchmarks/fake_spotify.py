@@ -0,0 +1,341 @@
+"""A stand-in for the parts of a libspotify session that the managers use,
+so that they can be exercised offline, without an account or network.
+
+Loads complete after a configurable latency, with their callbacks called on
+a single thread standing in for libspotify's session thread. Times are in
+the session's clock, which may be a VirtualClock.
+"""
+import os
+import sys
+import array
+import random
+import threading
+import contextlib
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'managers' ) )
+
+from scheduler import Scheduler, SYSTEM_CLOCK
+
+RATE = 44100
+FRAME_SIZE = 4          # 16-bit stereo
+
+
+class FakeItem( object ):
+    def __init__( self, name ):
+        self.__name = name
+
+    def name( self ):
+        return self.__name
+
+    def is_loaded( self ):
+        return True
+
+
+class FakeArtist( FakeItem ):
+    pass
+
+
+class FakeAlbum( FakeItem ):
+    def __init__( self, name, artist, tracks ):
+        FakeItem.__init__( self, name )
+        self.__artist = artist
+        self.tracks = tracks
+
+    def artist( self ):
+        return self.__artist
+
+
+class FakeTrack( FakeItem ):
+    def __init__( self, name, artist, album_name, duration, uri=None ):
+        FakeItem.__init__( self, name )
+        self.uri = uri
+        self.__artists = [ artist ]
+        self.__album = FakeItem( album_name )
+        self.__duration = duration
+
+    def artists( self ):
+        return self.__artists
+
+    def album( self ):
+        return self.__album
+
+    def duration( self ):
+        return self.__duration
+
+
+class FakeBrowser( object ):
+    """A browser whose results arrive after the session's latency."""
+
+    def __init__( self, session, items, callback ):
+        self.__items = items
+        self.__loaded = False
+        self.__callback = callback
+        session.after_latency( self.__load )
+
+    def __load( self ):
+        self.__loaded = True
+        if self.__callback is not None:
+            self.__callback( self, None )
+
+    def is_loaded( self ):
+        return self.__loaded
+
+    def __len__( self ):
+        return len( self.__items ) if self.__loaded else 0
+
+    def __getitem__( self, i ):
+        return self.__items[i]
+
+    def __iter__( self ):
+        return iter( self.__items if self.__loaded else () )
+
+
+class FakePlaylist( FakeItem ):
+    """A playlist that loads after the session's latency, then tells the
+    session's playlist state listeners."""
+
+    def __init__( self, session, name, tracks, uri=None ):
+        FakeItem.__init__( self, name )
+        self.uri = uri
+        self.__tracks = tracks
+        self.__loaded = False
+        session.after_latency( self.__load, session )
+
+    def __load( self, session ):
+        self.__loaded = True
+        for func in session.playlist_state_listeners:
+            func( self )
+
+    def is_loaded( self ):
+        return self.__loaded
+
+    def __len__( self ):
+        return len( self.__tracks )
+
+    def __getitem__( self, i ):
+        return self.__tracks[i]
+
+    def __iter__( self ):
+        return iter( self.__tracks )
+
+
+class FakeContainer( object ):
+    """The user's playlist container, which loads after the session's
+    latency and then calls its loaded callbacks, as pyspotify's does."""
+
+    def __init__( self, session, playlists ):
+        self.__playlists = playlists
+        self.__loaded = False
+        self.__loaded_callbacks = []
+        session.after_latency( self.__load )
+
+    def add_loaded_callback( self, func, userdata=None ):
+        self.__loaded_callbacks.append( ( func, userdata ) )
+
+    def __load( self ):
+        self.__loaded = True
+        for func, userdata in self.__loaded_callbacks:
+            func( self, userdata )
+
+    def is_loaded( self ):
+        return self.__loaded
+
+    def __len__( self ):
+        return len( self.__playlists )
+
+    def __getitem__( self, i ):
+        return self.__playlists[i]
+
+    def __iter__( self ):
+        return iter( self.__playlists )
+
+
+class FakeSession( object ):
+    """The session: `browse_album`, plus `artist_browser` and
+    `toplist_browser` to pass to a BrowseLoader in place of pyspotify's
+    classes; a login and a playlist container, built by `make_catalogue`;
+    and a player.
+
+    The player's `load()` blocks for `load_latency`, as libspotify's does.
+    Once playing, a track's frames go to the `music_delivery` of
+    `music_sink`, at whatever pace it takes them, with each frame holding
+    the number of the load it came from; without a sink, the track simply
+    ends after its duration. Either way, `end_of_track_listeners` are then
+    called on the session thread.
+
+    Calls into the player are counted in `player_calls`, and those made
+    while another is still in progress, which would be races in libspotify,
+    in `overlapping_calls`.
+    """
+
+    playlist_state_listeners = ()
+    end_of_track_listeners = ()
+
+    # Frames offered per delivery, and the wait before offering frames again
+    # when the sink took none
+    DELIVERY_FRAMES = 2048
+    RETRY_SECS = 0.01
+
+    def __init__( self, latency=0.05, jitter=0.02, seed=1, clock=SYSTEM_CLOCK, login_latency=1.0,
+                  load_latency=None ):
+        self.latency = latency
+        self.jitter = jitter
+        self.clock = clock
+        self.login_latency = login_latency
+        self.load_latency = latency if load_latency is None else load_latency
+        self.loads = 0
+        self.player_calls = 0
+        self.overlapping_calls = 0
+        self.__in_call = threading.Lock()
+        self.music_sink = None
+        self.container = None
+        self.__random = random.Random( seed )
+        self.__thread = Scheduler( name='fake-session', clock=clock )
+        # Player state, touched on the session thread only
+        self.__track = None
+        self.__track_number = 0        # loads so far, written into the frames
+        self.__frames_total = 0
+        self.__frames_done = 0
+        self.__playing_since = None    # (clock time, frames done) without a sink
+        self.__next_call = None
+
+    def after_latency( self, func, *args ):
+        self.loads += 1
+        self.__thread.call_later( self.__delay( self.latency ), func, *args )
+
+    def __delay( self, latency ):
+        return max( 0.0, latency + self.__random.uniform( -self.jitter, self.jitter ) )
+
+    def add_end_of_track_listener( self, func ):
+        self.end_of_track_listeners = self.end_of_track_listeners + (func,)
+
+    #
+    # Login and catalogue
+
+    def login( self, logged_in ):
+        """Call `logged_in( session, error )` once logged in."""
+        self.__thread.call_later( self.login_latency, logged_in, self, None )
+
+    def make_catalogue( self, playlists=20, tracks_per_playlist=100, seed=1, track_ms=( 120000, 360000 ) ):
+        """Make the user's playlist container, of `playlists` playlists of
+        tracks lasting between the `track_ms` bounds, two to six minutes by
+        default. Returns the container."""
+        rnd = random.Random( seed )
+        artists = [ FakeArtist( 'Artist %d' % i ) for i in xrange( max( 1, playlists * tracks_per_playlist // 20 ) ) ]
+        lists = []
+        for p in xrange( playlists ):
+            tracks = []
+            for i in xrange( tracks_per_playlist ):
+                artist = rnd.choice( artists )
+                tracks.append( FakeTrack( 'Track %d %d' % ( p, rnd.randint( 0, 99999 ) ), artist,
+                                          '%s album %d' % ( artist.name(), rnd.randint( 0, 9 ) ),
+                                          rnd.randint( *track_ms ),
+                                          uri='spotify:track:%022d' % ( p * tracks_per_playlist + i ) ) )
+            lists.append( FakePlaylist( self, 'Playlist %d' % p, tracks, uri='spotify:user:fake:playlist:%d' % p ) )
+        self.container = FakeContainer( self, lists )
+        return self.container
+
+    def playlist_container( self ):
+        return self.container
+
+    #
+    # Player
+
+    @contextlib.contextmanager
+    def __player_call( self ):
+        entered = self.__in_call.acquire( False )
+        self.player_calls += 1
+        if not entered:
+            self.overlapping_calls += 1
+        try:
+            yield
+        finally:
+            if entered:
+                self.__in_call.release()
+
+    def load( self, track ):
+        """Load a track for playing, from the start."""
+        with self.__player_call():
+            self.clock.sleep( self.__delay( self.load_latency ) )
+            self.__thread.call_later( 0, self.__load, track )
+
+    def seek( self, ms ):
+        with self.__player_call():
+            self.__thread.call_later( 0, self.__seek, ms )
+
+    def play( self, flag ):
+        with self.__player_call():
+            self.__thread.call_later( 0, self.__play, flag )
+
+    def unload( self ):
+        with self.__player_call():
+            self.__thread.call_later( 0, self.__load, None )
+
+    def __load( self, track ):
+        self.__stop_player()
+        self.__track = track
+        self.__track_number += 1
+        self.__frames_total = track.duration() * RATE // 1000 if track is not None else 0
+        self.__frames_done = 0
+
+    def __seek( self, ms ):
+        self.__frames_done = min( ms * RATE // 1000, self.__frames_total )
+
+    def __play( self, flag ):
+        self.__stop_player()
+        if not flag or self.__track is None:
+            return
+        if self.music_sink is not None:
+            self.__next_call = self.__thread.call_later( 0, self.__deliver )
+        else:
+            self.__playing_since = ( self.clock(), self.__frames_done )
+            remaining = float( self.__frames_total - self.__frames_done ) / RATE
+            self.__next_call = self.__thread.call_later( remaining, self.__end_of_track )
+
+    def __stop_player( self ):
+        if self.__next_call is not None:
+            self.__thread.cancel( self.__next_call )
+            self.__next_call = None
+        if self.__playing_since is not None:
+            since, frames = self.__playing_since
+            self.__frames_done = min( self.__frames_total, frames + int( ( self.clock() - since ) * RATE ) )
+            self.__playing_since = None
+
+    def __deliver( self ):
+        num_frames = min( self.DELIVERY_FRAMES, self.__frames_total - self.__frames_done )
+        frames = array.array( 'I', [ self.__track_number ] ) * num_frames
+        taken = self.music_sink.music_delivery( self, frames.tostring(), FRAME_SIZE, num_frames, 0, RATE, 2 )
+        self.__frames_done += taken
+        if self.__frames_done >= self.__frames_total:
+            self.__end_of_track()
+        else:
+            self.__next_call = self.__thread.call_later( 0 if taken else self.RETRY_SECS, self.__deliver )
+
+    def __end_of_track( self ):
+        self.__next_call = None
+        self.__playing_since = None
+        self.__frames_done = self.__frames_total
+        for func in self.end_of_track_listeners:
+            func( self )
+
+    def add_playlist_state_listener( self, func ):
+        self.playlist_state_listeners = self.playlist_state_listeners + (func,)
+
+    def browse_album( self, album, callback=None ):
+        return FakeBrowser( self, album.tracks, callback )
+
+    def artist_browser( self, artist, callback=None ):
+        return FakeBrowser( self, [ FakeAlbum( '%s album %d' % ( artist.name(), i ), artist, [] )
+                                    for i in xrange( 3 ) ], callback )
+
+    def toplist_browser( self, tl_type, tl_region, callback=None ):
+        return FakeBrowser( self, [ FakeItem( '%s %s %d' % ( tl_type, tl_region, i ) )
+                                    for i in xrange( 10 ) ], callback )
+
+    def make_album( self, name, num_tracks=10 ):
+        artist = FakeArtist( name + ' artist' )
+        return FakeAlbum( name, artist, [ FakeTrack( '%s track %d' % ( name, i ), artist, name, 180000 )
+                                          for i in xrange( num_tracks ) ] )
+
+    def close( self ):
+        self.__thread.stop()
@@ -0,0 +1,958 @@
+import collections
+import math
+import time
+import logging
+import os
+import errno
+import fcntl
+import select
+import socket
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import threading
+import json
+import urlparse
+
+from workers import Future, WorkerPool, WorkerPoolFull
+from router import RouteTable, RoutingError
+from response_cache import ResponseCache
+from rate_limit import RateLimiter
+from metrics import REGISTRY
+from logs import get_logger
+
+log = get_logger( 'api' )
+
+REQUEST_SECONDS = REGISTRY.histogram( 'symfopi_api_request_seconds',
+                                      'Time from reading an API request to sending the response.',
+                                      labels=('route',) )
+RESPONSES = REGISTRY.counter( 'symfopi_api_responses_total', 'API responses sent.',
+                              labels=('route', 'status') )
+SHED = REGISTRY.counter( 'symfopi_api_requests_shed_total',
+                         'API requests refused by admission control, by priority class and reason.',
+                         labels=('priority', 'reason') )
+
+
+class ArgumentError( RuntimeError ):
+    pass
+
+
+class ServiceUnavailable( RuntimeError ):
+    """Raised by a "do_" function that cannot be served for now, such as
+    one whose manager is still starting; answered with a 503, and a
+    Retry-After header if `retry_after` seconds are given."""
+
+    status = 503
+
+    def __init__( self, message, retry_after=None ):
+        RuntimeError.__init__( self, message )
+        self.retry_after = retry_after
+
+    def response( self ):
+        """Return the `(http_status, payload, headers)` to send back."""
+        headers = ( ('Retry-After', str( self.retry_after )), ) if self.retry_after is not None else ()
+        return self.status, self.message, headers
+
+
+class TooManyRequests( ServiceUnavailable ):
+    """A client has gone over its rate limit; answered with a 429, and a
+    Retry-After header."""
+
+    status = 429
+
+
+class TextResponse( str ):
+    """Returned by a "do_" function to send a plain-text payload as it is,
+    rather than encoded as JSON."""
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class APIRequestDispatcher( object ):
+    """The registry of API functions and the logic for calling them, shared by
+    the HTTP servers that represent the central controller API.
+
+    == CONVENTIONS FOR 'DO' FUNCTIONS ==
+
+    All HTTP query arguments are translated to a dictionary and passed on
+    to the "do_" function call as a single argument. Path parameters (see
+    RouteTable) are added to the same dictionary, in the same form as query
+    arguments: a list holding one string.
+
+    A "do_" function is expected to return either a JSON-able object or
+    None. If None, then the HTTP handler will return an empty payload
+    (empty string).
+    If not None, the object returned by the do function is translated to
+    JSON and returned.
+
+    The do function is responsible for handling the HTTP arguments in the
+    passed-in dictionary. The function should check for unexpected
+    query arguments and raise an ArgumentError as appropriate.
+    When such an error is encountered, the HTTP request handler
+    will send back a 400 HTTP error and the error's message as the HTTP
+    payload. A function that cannot be served yet, e.g. while the manager
+    it uses starts up, raises ServiceUnavailable instead, for a 503.
+
+    == CACHEABLE FUNCTIONS ==
+
+    A function registered with a `cache_version` callable only runs when
+    that callable returns something different from the last time the
+    function ran with the same arguments; otherwise the JSON encoded last
+    time is sent again. Responses of cacheable functions carry an ETag, and
+    a request whose If-None-Match names the current ETag is answered with a
+    304 and no payload.
+
+    == DEFERRED RESPONSES ==
+
+    A "do_" function that has to wait for something, such as a long-poll for
+    events, may return a Future instead of blocking. The response is sent
+    once the Future completes, with its result treated as the function's
+    return value. Cacheable functions may not return Futures.
+
+    == COMMANDS AND BATCHES ==
+
+    Functions registered for methods other than GET are commands: they run
+    one at a time, holding `command_lock`. A batch endpoint (see
+    `register_batch_function`) runs a list of them in order under a single
+    acquisition of the lock, so that no other command can come between them,
+    and answers with the result of each.
+
+    == PRIORITY CLASSES ==
+
+    Each function is registered in a priority class, which has a lane of
+    its own: a few worker threads and a bounded backlog of requests
+    waiting for them (`lane_sizes`).
+
+        control: commands that must take effect at once, such as pausing
+    playback; its lane is kept for them alone, so they never wait behind
+    other requests for a thread
+        interactive: what a UI shows and asks for; the default
+        bulk: slow catalogue requests, such as listing playlists, which
+    get few threads so that they cannot take over
+
+    When a lane's backlog is full, further requests in its class are shed
+    with a 503 and a Retry-After header. Inline functions run where the
+    request is read and take no lane, but do count towards rate limits.
+
+    With `set_rate_limits()`, each client address also has a limit on its
+    rate of requests in each class; requests over it are answered with a
+    429 and a Retry-After header.
+
+    Commands still run one at a time under `command_lock`, whatever their
+    class, so a command that has to wait should return a Future rather
+    than block.
+    """
+
+    max_batch_operations = 32
+
+    PRIORITIES = ( 'control', 'interactive', 'bulk' )
+
+    # (worker threads, backlog) of each priority class's lane
+    lane_sizes = { 'control': ( 2, 16 ), 'interactive': ( 4, 64 ), 'bulk': ( 2, 16 ) }
+
+    # Seconds a client is asked to wait before retrying a shed request
+    busy_retry_after = 1
+
+    def __init__( self, lane_sizes=None ):
+        """
+        lane_sizes:
+            `lane_sizes` for this dispatcher, if not the class's
+        """
+        self.registered_funcs = { 'GET':{}, 'PUT':{}, 'POST':{}  }
+        self.route_names = {}
+        self.inline_funcs = set()
+        self.command_funcs = set()
+        self.body_funcs = set()
+        self.routes = RouteTable()
+        self.cache_versions = {}
+        self.response_cache = ResponseCache()
+        self.command_lock = threading.RLock()
+        self.priorities = {}
+        self.rate_limiters = {}
+        self.rate_limit_exempt = frozenset()
+        if lane_sizes is not None:
+            self.lane_sizes = dict( self.lane_sizes, **lane_sizes )
+        self.lanes = dict( ( priority, WorkerPool( num_workers, max_backlog, name='api-%s' % priority ) )
+                           for priority, ( num_workers, max_backlog ) in self.lane_sizes.iteritems() )
+
+    def register_api_function( self, pathname, func, http_method, inline=False, cache_version=None,
+                               priority='interactive' ):
+        """Add a function that the server will respond to.
+
+        pathname:
+            matched to the URL path to indicate that the function should be
+        called; may contain `{name}` parameter segments
+        func:
+            function handle that will be called
+        http_method:
+            the HTTP method that the function must be called with (e.g., GET)
+        inline:
+            the function is quick and never blocks, so a server that
+        multiplexes connections on one thread may call it directly instead
+        of handing it to a worker thread
+        cache_version:
+            for a function whose response only changes when the controller's
+        state does, a callable returning the current version of that state;
+        the response is cached until the version changes
+        priority:
+            the function's priority class: 'control', 'interactive' or 'bulk'
+        """
+        if priority not in self.PRIORITIES:
+            raise ValueError( "Unknown priority class '%s'" % priority )
+        if http_method not in self.registered_funcs:
+            self.registered_funcs[http_method] = {}
+
+        self.registered_funcs[http_method][pathname] = func
+        self.route_names[func] = pathname
+        self.routes.add( pathname, http_method, func )
+        if inline:
+            self.inline_funcs.add( func )
+        if http_method != 'GET':
+            self.command_funcs.add( func )
+        if cache_version is not None:
+            self.cache_versions[func] = cache_version
+        self.priorities[func] = priority
+
+    def register_alias( self, pathname, target ):
+        """Serve the functions registered at `target` at `pathname` as well,
+        for every HTTP method, with the same options. `pathname` may have
+        parameter segments, which are passed as arguments; responses are
+        counted in the metrics under `target`."""
+        methods = [ m for m, funcs in self.registered_funcs.iteritems() if target in funcs ]
+        if not methods:
+            raise KeyError( "No function registered at '%s'" % target )
+        for http_method in methods:
+            func = self.registered_funcs[http_method][target]
+            self.registered_funcs[http_method][pathname] = func
+            self.routes.add( pathname, http_method, func )
+
+    def register_batch_function( self, pathname='batch', priority='control' ):
+        """Add a POST endpoint that runs several registered functions in one
+        request.
+
+        The request body is a JSON array of operations, each an object with:
+            path: the function's path, as in a URL, optionally with a query
+            method (optional): the HTTP method it is registered for; default PUT
+            args (optional): object of further arguments, whose values are
+        strings or lists of strings (other JSON values are passed as JSON)
+
+        The operations run in order, holding `command_lock` throughout; a
+        failing operation does not stop the rest. The response is a JSON
+        array with an object per operation: `{ status, result }` for
+        success, `{ status, error }` otherwise, with the status an operation
+        would have had as a request of its own. The batch as a whole is in
+        the `priority` class.
+        """
+        self.routes.add( pathname, 'POST', self.__call_batch )
+        self.registered_funcs['POST'][pathname] = self.__call_batch
+        self.route_names[self.__call_batch] = pathname
+        self.body_funcs.add( self.__call_batch )
+        self.priorities[self.__call_batch] = priority
+
+    def set_rate_limits( self, limits, exempt=( '127.0.0.1', '::1' ) ):
+        """Limit each client address's requests in each priority class.
+
+        limits:
+            dict of priority class to `(requests per second, burst)`; classes
+        left out are not limited
+        exempt:
+            addresses not limited, by default those of this host, where a
+        proxy in front of the API would make every user one client
+        """
+        self.rate_limiters = dict( ( priority, RateLimiter( rate, burst ) )
+                                   for priority, ( rate, burst ) in limits.iteritems() )
+        self.rate_limit_exempt = frozenset( exempt )
+
+    def resolve_api_function( self, http_req_method, req_url_endpath ):
+        """Find the function registered for a request.
+
+        Returns a `(func_handle, qargs_dict)` tuple. Raises RoutingError if no
+        function is registered for the path, or for the method.
+        """
+        #
+        # Split off the query component (?...); clients do not send fragments
+        path_str, _, query_str = req_url_endpath.partition( '?' )
+
+        func_handle, path_params = self.routes.match( http_req_method, path_str )
+
+        #
+        # Prepare HTTP arguments for calling
+        if query_str:
+            qargs_dict = urlparse.parse_qs( query_str, keep_blank_values=True )
+        else:
+            qargs_dict = {}
+        for name, value in path_params.iteritems():
+            qargs_dict[name] = [value]
+
+        return func_handle, qargs_dict
+
+    def dispatch( self, func_handle, qargs_dict, client, if_none_match=None, body="" ):
+        """Admit a request and run its function: an inline function
+        straight away, on the calling thread, others on the lane of their
+        priority class.
+
+        Returns the `(http_status, payload, headers)` to send back, or a
+        Future of it; the Future's result may itself be a Future, for a
+        deferred response. Requests refused are answered with a 429 or 503.
+
+        client:
+            the client's address, for its rate limit
+        """
+        priority = self.priorities.get( func_handle, 'interactive' )
+        limiter = self.rate_limiters.get( priority )
+        if limiter is not None and client not in self.rate_limit_exempt:
+            wait = limiter.acquire( client )
+            if wait:
+                SHED.labels( priority, 'rate_limited' ).inc()
+                return TooManyRequests( "Too many requests", int( math.ceil( wait ) ) ).response()
+
+        if func_handle in self.inline_funcs:
+            return self.call_api_function( func_handle, qargs_dict, if_none_match, body )
+        try:
+            return self.lanes[priority].submit( self.call_api_function, func_handle, qargs_dict,
+                                                if_none_match, body )
+        except WorkerPoolFull:
+            SHED.labels( priority, 'lane_full' ).inc()
+            return ServiceUnavailable( "Too busy", self.busy_retry_after ).response()
+
+    def shutdown_lanes( self ):
+        for lane in self.lanes.itervalues():
+            lane.shutdown()
+
+    def call_api_function( self, func_handle, qargs_dict, if_none_match=None, body="" ):
+        """Run a "do_" function, returning the `(http_status, payload,
+        headers)` to send back.
+
+        if_none_match:
+            the request's If-None-Match header, if any
+        body:
+            the request body; only passed on to batch functions
+        """
+        version_func = self.cache_versions.get( func_handle )
+        if version_func is None:
+            try:
+                if func_handle in self.body_funcs:
+                    ret = func_handle( qargs_dict, body )
+                elif func_handle in self.command_funcs:
+                    with self.command_lock:
+                        ret = func_handle( qargs_dict )
+                else:
+                    ret = func_handle( qargs_dict )
+            except (ArgumentError,) as ex:
+                errmsg = ex.message
+                return 400, errmsg, ()  # 400: bad request, do not retry w/o correction
+            except ServiceUnavailable as ex:
+                return ex.response()
+            if isinstance( ret, Future ):
+                return self.__deferred_response( ret )
+            if isinstance( ret, TextResponse ):
+                return 200, str( ret ), ( ('Content-Type', ret.content_type), )
+            return 200, self.encode_response( ret ), ()
+
+        #
+        # Cacheable: only run the function if the state has moved on. The
+        # version is read first, so a change made while the function runs
+        # makes the stored response out of date rather than wrongly current.
+        try:
+            version = version_func()
+        except ServiceUnavailable as ex:
+            return ex.response()
+        key = self.response_cache.make_key( func_handle, qargs_dict )
+        entry = self.response_cache.lookup( key, version )
+        if entry is None:
+            try:
+                ret = func_handle( qargs_dict )
+            except (ArgumentError,) as ex:
+                return 400, ex.message, ()
+            except ServiceUnavailable as ex:
+                return ex.response()
+            entry = self.response_cache.store( key, version, self.encode_response( ret ) )
+
+        headers = ( ('ETag', entry.etag), )
+        if entry.matches( if_none_match ):
+            return 304, "", headers
+        return 200, entry.payload, headers
+
+    def __deferred_response( self, ret_future ):
+        """Return a Future of the `(http_status, payload, headers)` for a
+        Future returned by a "do_" function."""
+        resp_future = Future()
+        def done_cb( f ):
+            ex = f.exception()
+            if isinstance( ex, ArgumentError ):
+                resp_future.set_result( ( 400, ex.message, () ) )
+            elif isinstance( ex, ServiceUnavailable ):
+                resp_future.set_result( ex.response() )
+            elif ex is not None:
+                resp_future.set_exception( ex )
+            else:
+                resp_future.set_result( ( 200, self.encode_response( f.result() ), () ) )
+        ret_future.add_done_callback( done_cb )
+        return resp_future
+
+    def __call_batch( self, qargs_dict, body ):
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        try:
+            operations = json.loads( body )
+        except ValueError:
+            raise ArgumentError( "Request body is not valid JSON" )
+        if not isinstance( operations, list ):
+            raise ArgumentError( "Request body must be a JSON array of operations" )
+        if len( operations ) > self.max_batch_operations:
+            raise ArgumentError( "At most %d operations may be batched" % self.max_batch_operations )
+
+        results = [ None ] * len( operations )
+        deferred = []
+        with self.command_lock:
+            for i, op in enumerate( operations ):
+                try:
+                    func_handle, op_qargs = self.__resolve_operation( op )
+                    ret = func_handle( op_qargs )
+                except ArgumentError as ex:
+                    results[i] = { 'status': 400, 'error': ex.message }
+                except ServiceUnavailable as ex:
+                    results[i] = { 'status': 503, 'error': ex.message }
+                except RoutingError as ex:
+                    results[i] = { 'status': ex.status, 'error': ex.message }
+                except Exception:
+                    log.exception( "Error in batched API operation" )
+                    results[i] = { 'status': 500, 'error': "Internal error" }
+                else:
+                    if isinstance( ret, Future ):
+                        deferred.append( ( i, ret ) )
+                    else:
+                        results[i] = { 'status': 200, 'result': ret }
+
+        if not deferred:
+            return results
+
+        # Some operations deferred their results: respond once they are in,
+        # without holding the lock meanwhile
+        batch_future = Future()
+        remaining = [ len( deferred ) ]
+        lock = threading.Lock()
+        def done_cb( i, f ):
+            ex = f.exception()
+            if isinstance( ex, ArgumentError ):
+                results[i] = { 'status': 400, 'error': ex.message }
+            elif isinstance( ex, ServiceUnavailable ):
+                results[i] = { 'status': 503, 'error': ex.message }
+            elif ex is not None:
+                log.error( "Error in batched API operation: %r", ex )
+                results[i] = { 'status': 500, 'error': "Internal error" }
+            else:
+                results[i] = { 'status': 200, 'result': f.result() }
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                batch_future.set_result( results )
+        for i, fut in deferred:
+            fut.add_done_callback( lambda f, i=i: done_cb( i, f ) )
+        return batch_future
+
+    def __resolve_operation( self, op ):
+        """Return the `(func_handle, qargs_dict)` for a batched operation."""
+        if not isinstance( op, dict ) or not isinstance( op.get( 'path' ), basestring ):
+            raise ArgumentError( "Each operation must be an object with a 'path'" )
+        method = op.get( 'method', 'PUT' )
+        args = op.get( 'args', {} )
+        if not isinstance( method, basestring ) or not isinstance( args, dict ):
+            raise ArgumentError( "Bad 'method' or 'args' in operation" )
+
+        func_handle, qargs_dict = self.resolve_api_function( method.upper().encode( 'ascii', 'replace' ),
+                                                             op['path'].encode( 'utf-8' ) )
+        if func_handle in self.body_funcs:
+            raise ArgumentError( "Batches cannot be nested" )
+        for name, value in args.iteritems():
+            values = value if isinstance( value, list ) else [ value ]
+            qargs_dict[name.encode( 'utf-8' )] = [ v.encode( 'utf-8' ) if isinstance( v, basestring )
+                                                   else json.dumps( v ) for v in values ]
+        return func_handle, qargs_dict
+
+    def record_response( self, func_handle, status, started ):
+        """Count a response, and its latency since `started`, under the
+        function's route; `func_handle` is None for an unmatched path."""
+        if REGISTRY.enabled:
+            route = self.route_names.get( func_handle, 'unmatched' )
+            REQUEST_SECONDS.labels( route ).observe_since( started )
+            RESPONSES.labels( route, str( status ) ).inc()
+
+    @staticmethod
+    def encode_response( ret ):
+        if ret is not None:
+            return json.dumps( ret )
+        else:
+            return ""
+
+
+class ThreadedHTTPServer( ThreadingMixIn, APIRequestDispatcher, HTTPServer ):
+    """Extension to BaseHTTPServer's HTTPServer with threaded connections,
+    enabling asynchronous behaviour.
+
+    Clearly, this enables usual race condition issues."""
+    # Superb reference for Python's Base HTTP Server:
+    #   http://www.doughellmann.com/PyMOTW/BaseHTTPServer/index.html#module-BaseHTTPServer
+    # Also includes advice on automatic multi-threading.
+    # Future:
+    #   Consider refactor to replace homebrew code with some established
+    #   minimalist web framework for the HTTP server and API. E.g., CherryPy?
+
+    daemon_threads = True
+    max_request_size = 64 * 1024  # bytes of request body
+
+    def __init__( self, server_addr, req_handler_class, central_controller ):
+        """
+        central_controller:
+            the central controller object whose methods (functions) will be
+            called to fullfil HTTP requests
+        """
+        HTTPServer.__init__( self, server_addr, req_handler_class )
+        APIRequestDispatcher.__init__( self )
+
+        self.c_controller = central_controller
+
+    def server_close( self ):
+        HTTPServer.server_close( self )
+        self.shutdown_lanes()
+
+    class HTTPRequestHandler( BaseHTTPRequestHandler ):
+        """Class for objects representing a specific case of hanlding a
+        HTTP request.
+
+        Responds by calling the appropriate CentralController object's
+        function, as specified by the request. First checks if the function
+        being requested is permitted beforehand, using the HTTPServer's
+        route table. See APIRequestDispatcher for the conventions
+        that the "do_" functions follow.
+        """
+
+        def __init__( self, *oargs, **kwargs ):
+            BaseHTTPRequestHandler.__init__( self, *oargs, **kwargs )
+
+        def log_message( self, format, *args ):
+            # Overrides the parent's synchronous write to stderr for every
+            # request, and its reverse DNS lookup of the client
+            log.debug( "%s " + format, self.client_address[0], *args )
+
+        def do_GET( self ):
+            self.unified_handler( 'GET' )
+
+        def do_POST( self ):
+            self.unified_handler( 'POST' )
+
+        def do_PUT( self ):
+            self.unified_handler( 'PUT' )
+
+        def do_DELETE( self ):
+            self.unified_handler( 'DELETE' )
+
+        def unified_handler( self, http_req_method ):
+            """Unified place to handle HTTP requests sent over various methods."""
+
+            # self.
+            #    'client_address',
+            #    'server',     the server object
+            #    'command',
+            #    'path',
+            #    'request_version',
+            #    'headers',
+            #    'server_version',
+            #    'sys_version',
+            #    'error_message_format',
+            #    'error_content_type',
+            #    'protocol_version',
+            #    'responses'
+
+            started = time.time()
+            # A body of unknown length leaves the connection out of step, so
+            # close it
+            try:
+                body_len = int( self.headers.getheader( 'Content-Length' ) or 0 )
+            except ValueError:
+                body_len = -1
+            if body_len < 0 or body_len > self.server.max_request_size:
+                self.close_connection = 1
+                self.send_error( 400 if body_len < 0 else 413 )
+                return
+
+            try:
+                func_handle, qargs_dict = self.server.resolve_api_function( http_req_method, self.path )
+            except RoutingError as ex:
+                self.rfile.read( body_len )
+                self.send_response( ex.status )
+                if ex.allow:
+                    self.send_header( 'Allow', ', '.join( ex.allow ) )
+                self.end_headers()
+                self.wfile.write( ex.message )
+                self.server.record_response( None, ex.status, started )
+                return
+
+            body = self.rfile.read( body_len ) if body_len > 0 else ""
+
+            #
+            # Run the function and handle sending back the headers and response
+            response = self.server.dispatch( func_handle, qargs_dict, self.client_address[0],
+                                             self.headers.getheader( 'If-None-Match' ), body )
+            while isinstance( response, Future ):
+                response = response.result()
+            status, payload, headers = response
+            self.send_response( status )
+            for name, value in headers:
+                self.send_header( name, value )
+            self.end_headers()
+            self.wfile.write( payload )
+            self.server.record_response( func_handle, status, started )
+
+
+class EventLoopHTTPServer( APIRequestDispatcher ):
+    """An HTTP/1.1 server for the central controller API that multiplexes all
+    of its connections on a single thread with `poll`.
+
+    Keep-alive connections stay open between requests, so polling clients do
+    not cost a new thread (or a new TCP connection) per request. Registered
+    functions run on the worker threads of their priority class's lane,
+    except those registered as `inline`, which are called directly on the
+    loop. When a lane's backlog is full, requests are refused with a 503.
+
+    `shutdown()` only writes to a pipe, so it may be called from another
+    thread or from a signal handler; `serve_forever()` returns promptly.
+    """
+
+    request_queue_size = 128
+    idle_timeout = 60.0           # seconds before an idle keep-alive connection is closed
+    max_request_size = 64 * 1024  # bytes of request head plus body
+
+    def __init__( self, server_addr, central_controller, num_workers=4, max_backlog=64 ):
+        """
+        central_controller:
+            the central controller object whose methods (functions) will be
+            called to fullfil HTTP requests
+        num_workers:
+            number of threads that run the registered functions of the
+            'interactive' priority class
+        max_backlog:
+            number of those requests that may wait for a worker before new
+            ones are refused
+        """
+        APIRequestDispatcher.__init__( self, { 'interactive': ( num_workers, max_backlog ) } )
+        self.c_controller = central_controller
+
+        self.socket = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        self.socket.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+        self.socket.bind( server_addr )
+        self.socket.listen( self.request_queue_size )
+        self.socket.setblocking( 0 )
+        self.server_address = self.socket.getsockname()
+
+        self.__wake_r, self.__wake_w = os.pipe()
+        for fd in (self.__wake_r, self.__wake_w):
+            flags = fcntl.fcntl( fd, fcntl.F_GETFL )
+            fcntl.fcntl( fd, fcntl.F_SETFL, flags | os.O_NONBLOCK )
+
+        self.__completed = collections.deque()
+        self.__conns = {}
+        self.__poller = select.poll()
+        self.__stop_requested = False
+
+    #
+    #
+    # Loop control
+    #
+    def shutdown( self ):
+        """Ask `serve_forever` to return. Safe to call from a signal handler."""
+        self.__stop_requested = True
+        self.__wake()
+
+    def serve_forever( self, poll_interval=0.5 ):
+        """Handle requests until `shutdown()` is called, then close the
+        server."""
+        listen_fd = self.socket.fileno()
+        self.__poller.register( listen_fd, select.POLLIN )
+        self.__poller.register( self.__wake_r, select.POLLIN )
+        last_reap = time.time()
+
+        try:
+            while not self.__stop_requested:
+                try:
+                    events = self.__poller.poll( poll_interval * 1000 )
+                except select.error as ex:
+                    if ex.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                for fd, ev in events:
+                    if fd == listen_fd:
+                        self.__accept()
+                    elif fd == self.__wake_r:
+                        self.__drain_wake_pipe()
+                    else:
+                        conn = self.__conns.get( fd )
+                        if conn is None:
+                            continue
+                        if ev & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                            self.__on_readable( conn )
+                        if ev & select.POLLOUT and not conn.closed:
+                            self.__on_writable( conn )
+
+                self.__finish_completed()
+
+                now = time.time()
+                if now - last_reap >= 1.0:
+                    self.__close_idle( now )
+                    last_reap = now
+        finally:
+            self.server_close()
+
+    def server_close( self ):
+        for conn in self.__conns.values():
+            self.__close( conn )
+        self.socket.close()
+        os.close( self.__wake_r )
+        os.close( self.__wake_w )
+        self.shutdown_lanes()
+
+    def __wake( self ):
+        try:
+            os.write( self.__wake_w, 'x' )
+        except OSError as ex:
+            if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def __drain_wake_pipe( self ):
+        try:
+            while os.read( self.__wake_r, 4096 ):
+                pass
+        except OSError as ex:
+            if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    #
+    #
+    # Connections
+    #
+    def __accept( self ):
+        while True:
+            try:
+                sock, addr = self.socket.accept()
+            except socket.error as ex:
+                if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            sock.setblocking( 0 )
+            sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+            conn = _Connection( sock, addr )
+            self.__conns[conn.fd] = conn
+            self.__poller.register( conn.fd, select.POLLIN )
+
+    def __close( self, conn ):
+        if conn.closed:
+            return
+        conn.closed = True
+        self.__conns.pop( conn.fd, None )
+        try:
+            self.__poller.unregister( conn.fd )
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+    def __close_idle( self, now ):
+        for conn in self.__conns.values():
+            if not conn.busy and now - conn.last_active > self.idle_timeout:
+                self.__close( conn )
+
+    def __on_readable( self, conn ):
+        try:
+            data = conn.sock.recv( 65536 )
+        except socket.error as ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.__close( conn )
+            return
+        if not data:
+            # Client hung up; any response still being worked on is dropped
+            self.__close( conn )
+            return
+
+        conn.last_active = time.time()
+        conn.inbuf += data
+        self.__process_requests( conn )
+
+    def __on_writable( self, conn ):
+        try:
+            sent = conn.sock.send( conn.outbuf )
+        except socket.error as ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.__close( conn )
+            return
+        conn.outbuf = conn.outbuf[sent:]
+        if not conn.outbuf:
+            if conn.closing:
+                self.__close( conn )
+            else:
+                self.__poller.modify( conn.fd, select.POLLIN )
+
+    #
+    #
+    # Requests and responses
+    #
+    def __process_requests( self, conn ):
+        """Handle each complete request in the connection's input buffer, one
+        at a time so that pipelined responses keep their order."""
+        while not conn.busy and not conn.closing and not conn.closed:
+            req = conn.parse_request( self.max_request_size )
+            if req is None:
+                if len( conn.inbuf ) > self.max_request_size:
+                    self.__respond( conn, 413, "", False )
+                return
+            if req is _Connection.TOO_LARGE:
+                self.__respond( conn, 413, "", False )
+                return
+            if req is _Connection.MALFORMED:
+                self.__respond( conn, 400, "", False )
+                return
+            self.__handle_request( conn, *req )
+
+    def __handle_request( self, conn, http_req_method, path, headers, keep_alive, body ):
+        started = time.time()
+        try:
+            func_handle, qargs_dict = self.resolve_api_function( http_req_method, path )
+        except RoutingError as ex:
+            allow = ( ('Allow', ', '.join( ex.allow )), ) if ex.allow else ()
+            self.__respond( conn, ex.status, ex.message, keep_alive, allow, ( None, started ) )
+            return
+        timing = ( func_handle, started )
+
+        try:
+            response = self.dispatch( func_handle, qargs_dict, conn.addr[0], headers.get( 'if-none-match' ), body )
+        except Exception:
+            # Only an inline function runs here, on the loop
+            log.exception( "Error handling API request" )
+            self.__respond( conn, 500, "", False, (), timing )
+            return
+        if isinstance( response, Future ):
+            self.__await_response( conn, keep_alive, response, timing )
+        else:
+            self.__respond( conn, response[0], response[1], keep_alive, response[2], timing )
+
+    def __await_response( self, conn, keep_alive, fut, timing ):
+        """Send the response held by `fut` once it completes; the connection
+        handles no further requests meanwhile."""
+        conn.busy = True
+
+        def done_cb( f ):
+            self.__completed.append( (conn, keep_alive, f, timing) )
+            self.__wake()
+        fut.add_done_callback( done_cb )
+
+    def __finish_completed( self ):
+        while self.__completed:
+            conn, keep_alive, fut, timing = self.__completed.popleft()
+            conn.busy = False
+            if conn.closed:
+                continue
+            ex = fut.exception()
+            if ex is not None:
+                log.error( "Error handling API request: %r", ex )
+                self.__respond( conn, 500, "", False, (), timing )
+                continue
+            response = fut.result()
+            if isinstance( response, Future ):
+                # A worker ran a function that deferred its response
+                self.__await_response( conn, keep_alive, response, timing )
+                continue
+            status, payload, resp_headers = response
+            self.__respond( conn, status, payload, keep_alive, resp_headers, timing )
+            self.__process_requests( conn )
+
+    def __respond( self, conn, status, payload, keep_alive, headers=(), timing=None ):
+        """Send a response.
+
+        timing:
+            `(func_handle, started)` of the request, to record the response
+            in the metrics
+        """
+        if timing is not None:
+            self.record_response( timing[0], status, timing[1] )
+        reason = BaseHTTPRequestHandler.responses.get( status, ('',) )[0]
+        head = "HTTP/1.1 %d %s\r\nContent-Length: %d\r\nConnection: %s\r\n" % (
+            status, reason, len( payload ), 'keep-alive' if keep_alive else 'close' )
+        for name, value in headers:
+            head += "%s: %s\r\n" % ( name, value )
+        conn.outbuf += head + "\r\n" + payload
+        conn.closing = not keep_alive
+        conn.last_active = time.time()
+
+        # Most responses fit in the socket buffer, so try sending straight away
+        # and only poll for writability if something is left over
+        self.__on_writable( conn )
+        if conn.outbuf and not conn.closed:
+            self.__poller.modify( conn.fd, select.POLLIN | select.POLLOUT )
+
+
+class _Connection( object ):
+    """State for one client connection of the EventLoopHTTPServer."""
+
+    MALFORMED = object()
+    TOO_LARGE = object()
+
+    __slots__ = ( 'sock', 'fd', 'addr', 'inbuf', 'outbuf', 'busy', 'closing',
+                  'closed', 'last_active' )
+
+    def __init__( self, sock, addr ):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.addr = addr
+        self.inbuf = ""
+        self.outbuf = ""
+        self.busy = False       # a request is being worked on
+        self.closing = False    # close once the output buffer is flushed
+        self.closed = False
+        self.last_active = time.time()
+
+    def parse_request( self, max_size ):
+        """Take one complete request off the input buffer.
+
+        Returns `(method, path, headers, keep_alive, body)`, with header
+        names in lower case; None if the request is not yet complete;
+        MALFORMED; or TOO_LARGE, without waiting for the body, if its head
+        and body would come to more than `max_size` bytes.
+        """
+        end = self.inbuf.find( "\r\n\r\n" )
+        if end < 0:
+            return None
+
+        lines = self.inbuf[:end].split( "\r\n" )
+        words = lines[0].split()
+        if len( words ) != 3:
+            return _Connection.MALFORMED
+        method, path, version = words
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition( ":" )
+            if not sep:
+                return _Connection.MALFORMED
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            body_len = int( headers.get( 'content-length', 0 ) )
+        except ValueError:
+            return _Connection.MALFORMED
+        if body_len < 0:
+            return _Connection.MALFORMED
+        req_end = end + 4 + body_len
+        if req_end > max_size:
+            return _Connection.TOO_LARGE
+        if len( self.inbuf ) < req_end:
+            return None
+        body = self.inbuf[end + 4:req_end]
+        self.inbuf = self.inbuf[req_end:]
+
+        conn_hdr = headers.get( 'connection', '' ).lower()
+        if version == 'HTTP/1.1':
+            keep_alive = conn_hdr != 'close'
+        else:
+            keep_alive = conn_hdr == 'keep-alive'
+
+        return method, path, headers, keep_alive, body
@@ -0,0 +1,361 @@
+import collections
+import time
+import logging
+import threading
+
+from logs import get_logger, fields
+
+log = get_logger( 'audio' )
+
+
+class PCMRingBuffer( object ):
+    """A fixed-size ring buffer of PCM audio frames.
+
+    The storage is one bytearray allocated up front; writes copy straight
+    into it through a memoryview and reads hand out memoryviews onto it, so
+    nothing is allocated per frame. Meant for exactly one writing thread and
+    one reading thread: the writer only moves the write position and the
+    reader only moves the read position, so no lock is needed.
+
+    Positions are counted in frames and only ever increase; the offset into
+    the storage is the position modulo the capacity.
+    """
+
+    def __init__( self, capacity_frames, frame_size=4 ):
+        """
+        frame_size:
+            bytes per frame, i.e. channels * bytes per sample (4 for 16-bit
+            stereo)
+        """
+        self.capacity = capacity_frames
+        self.frame_size = frame_size
+        self.__buf = bytearray( capacity_frames * frame_size )
+        self.__view = memoryview( self.__buf )
+        self.__read_pos = 0
+        self.__write_pos = 0
+
+        self.overruns = 0   # writes that could not take every frame offered
+        self.underruns = 0  # times the reader ran out of frames mid-stream
+
+    def __len__( self ):
+        """Number of frames waiting to be read."""
+        return self.__write_pos - self.__read_pos
+
+    def free( self ):
+        return self.capacity - ( self.__write_pos - self.__read_pos )
+
+    def fill_level( self ):
+        """Fraction of the buffer holding unread frames."""
+        return float( self.__write_pos - self.__read_pos ) / self.capacity
+
+    def write( self, frames, num_frames, process=None ):
+        """Copy up to `num_frames` frames from `frames` (a str or any object
+        supporting the buffer protocol) into the buffer. If given,
+        `process( first, last )` is called with the positions of the frames
+        copied, to work on them in `storage` before the reader can see them.
+
+        Returns the number of frames taken, which is less than `num_frames`
+        if the buffer is too full for all of them.
+        """
+        n = min( num_frames, self.free() )
+        if n < num_frames:
+            self.overruns += 1
+        if n <= 0:
+            return 0
+
+        fs = self.frame_size
+        src = memoryview( frames )
+        start = self.__write_pos % self.capacity
+        first = min( n, self.capacity - start )
+        self.__view[start * fs:(start + first) * fs] = src[:first * fs]
+        if first < n:
+            self.__view[:(n - first) * fs] = src[first * fs:n * fs]
+
+        if process is not None:
+            process( self.__write_pos, self.__write_pos + n )
+        self.__write_pos += n
+        return n
+
+    def peek( self, max_frames ):
+        """Return a memoryview of up to `max_frames` unread frames, without
+        consuming them. The view is contiguous, so it may hold fewer frames
+        than are waiting if they wrap around the end of the storage. The view
+        is only valid until `advance()` is called."""
+        available = self.__write_pos - self.__read_pos
+        if available <= 0:
+            return self.__view[0:0]
+        start = self.__read_pos % self.capacity
+        n = min( max_frames, available, self.capacity - start )
+        return self.__view[start * self.frame_size:(start + n) * self.frame_size]
+
+    def advance( self, num_frames ):
+        """Mark `num_frames` frames as read."""
+        self.__read_pos += min( num_frames, self.__write_pos - self.__read_pos )
+
+    def mark( self ):
+        """Return the current write position, for `discard_until()`."""
+        return self.__write_pos
+
+    def read_position( self ):
+        """Return the position of the next frame to be read."""
+        return self.__read_pos
+
+    @property
+    def storage( self ):
+        """The bytearray the frames are kept in; frame position `p` is at
+        offset `p % capacity` frames. For processing unread frames in place."""
+        return self.__buf
+
+    def discard_until( self, mark ):
+        """Drop the unread frames written before `mark` was taken. Only the
+        reading thread may call this."""
+        self.__read_pos = max( self.__read_pos, min( mark, self.__write_pos ) )
+
+
+class BufferedAudioOutput( object ):
+    """Sits between libspotify's music delivery and an audio sink, so that a
+    stall in the sink does not stall the session thread.
+
+    `music_delivery` only copies frames into a PCMRingBuffer and returns how
+    many it took; libspotify delivers whatever was not taken again later,
+    which is the backpressure. A separate thread feeds the buffered frames to
+    the sink in chunks.
+
+    Presents the same methods as the audio sinks (music_delivery, start,
+    stop, end_of_track), so the jukebox can use it in place of one.
+
+    An AudioProcessor, if given, works on the frames as they are buffered,
+    and crossfades from one track into the next; see `new_track()`.
+
+    For playback synchronised with other players, `start_at()` holds the
+    frames back until a given time, `position_at()` tells how far playback
+    has got, and `correct_drift()` brings it back in line a little at a
+    time, by dropping frames or playing some twice.
+    """
+
+    def __init__( self, sink, capacity_frames=44100 * 2, chunk_frames=2048, clock=time.time, processor=None ):
+        """
+        sink:
+            the audio sink that plays the frames
+        capacity_frames:
+            size of the buffer; the default holds two seconds of 44.1 kHz
+            audio, which is also the most a crossfade can overlap
+        clock:
+            time function that `start_at()` and `position_at()` times are in
+        processor:
+            AudioProcessor for the frames, or None to pass them on as they are
+        """
+        self.sink = sink
+        self.processor = processor
+        self.chunk_frames = chunk_frames
+        self.capacity_frames = capacity_frames
+        self.buffer = PCMRingBuffer( capacity_frames )
+        self.clock = clock
+        # Most frames dropped or repeated per chunk, about 0.5% of the rate
+        self.max_correction = max( 1, chunk_frames // 200 )
+
+        self.__format = None           # (frame_size, sample_type, sample_rate, channels)
+        self.__new_track = None        # whether to crossfade into the next frames delivered, if a new track
+        self.__crossfade = None        # Crossfade under way
+        self.__session = None
+        self.__data_ready = threading.Event()
+        self.__end_of_track = False
+        self.__discard = None          # (buffer, mark) of frames to drop
+        self.__stop_requested = False
+        self.__playing = False
+        self.__start_at = None         # clock time to hold frames back until
+        self.__correction = 0          # frames to repeat (> 0) or drop (< 0)
+        self.__position = ( None, 0 )  # (clock time, frames played since start_at())
+
+        self.__thread = threading.Thread( target=self.__drain, name='audio-drain' )
+        self.__thread.setDaemon( True )
+        self.__thread.start()
+
+    #
+    # Delivery side; called on the libspotify session thread
+
+    def music_delivery( self, session, frames, frame_size, num_frames, sample_type, sample_rate, channels ):
+        """Buffer frames for the sink. Returns the number of frames taken."""
+        fmt = ( frame_size, sample_type, sample_rate, channels )
+        if fmt != self.__format:
+            if len( self.buffer ):
+                # Let the frames in the old format play out first
+                return 0
+            self.__format = fmt
+            self.buffer = PCMRingBuffer( self.capacity_frames, frame_size )
+            self.__crossfade = None
+
+        self.__session = session
+        buf = self.buffer
+        processor = self.processor
+        if processor is not None and not processor.accepts( sample_type ):
+            processor = None
+        if processor is not None:
+            new_track, self.__new_track = self.__new_track, None
+            if new_track is not None:
+                processor.new_track()
+                if new_track and processor.crossfade_secs:
+                    self.__start_crossfade( buf, sample_rate, channels )
+            crossfade = self.__crossfade
+            if crossfade is not None:
+                # Frames the reader may already have are not mixed into
+                taken = crossfade.mix( frames, num_frames, buf.read_position() + 2 * self.chunk_frames )
+                if crossfade.done:
+                    self.__crossfade = None
+                    if crossfade.dropped:
+                        log.debug( "Crossfade fell behind playback", extra=fields( dropped=crossfade.dropped ) )
+                return taken
+
+        process = None
+        if processor is not None:
+            process = lambda first, last: processor.process( buf, first, last, channels, sample_rate )
+        consumed = buf.write( frames, num_frames, process )
+        if consumed:
+            self.__data_ready.set()
+        return consumed
+
+    def __start_crossfade( self, buf, sample_rate, channels ):
+        """Fade out the end of the last track still buffered, leaving out
+        what the reader may be about to play, for the new one to be mixed
+        over."""
+        last = buf.mark()
+        first = max( last - int( self.processor.crossfade_secs * sample_rate ),
+                     buf.read_position() + 2 * self.chunk_frames )
+        if first < last:
+            self.__crossfade = self.processor.crossfade( buf, first, last, channels, sample_rate )
+
+    def new_track( self, crossfade=False ):
+        """Tell the processor that the next frames delivered start a new
+        track; with `crossfade`, they are mixed over the end of the last one
+        still buffered. Only for a track that follows straight on, not after
+        `flush()`."""
+        self.__new_track = crossfade
+
+    def end_of_track( self ):
+        """Tell the sink the track has ended, once the frames already
+        buffered have been played."""
+        self.__end_of_track = True
+        self.__data_ready.set()
+
+    @property
+    def sample_rate( self ):
+        """Sample rate of the frames being buffered, or None before any."""
+        return self.__format[2] if self.__format is not None else None
+
+    def start( self ):
+        self.__playing = True
+        self.sink.start()
+
+    def flush( self ):
+        """Drop anything buffered so far, leaving the sink running. Frames
+        delivered after the call are kept."""
+        self.__crossfade = None
+        buf = self.buffer
+        self.__discard = ( buf, buf.mark() )
+        self.__data_ready.set()
+
+    def stop( self ):
+        """Stop the sink and drop anything still buffered."""
+        self.__playing = False
+        self.flush()
+        self.sink.stop()
+
+    def start_at( self, when ):
+        """Hold back the frames delivered from now on until clock time
+        `when`, and count the playback position from then."""
+        self.__correction = 0
+        self.__position = ( None, 0 )
+        self.__start_at = when
+        self.__data_ready.set()
+
+    def position_at( self, when ):
+        """Return the number of frames that will have been played since the
+        last `start_at()` by clock time `when`, estimated from the last
+        delivery to the sink; None if nothing has been played yet."""
+        at, frames = self.__position
+        if at is None or self.sample_rate is None:
+            return None
+        return frames + ( when - at ) * self.sample_rate
+
+    def correct_drift( self, frames ):
+        """Slow playback down by `frames` frames, playing some twice, or if
+        negative, speed it up by dropping frames. The correction is spread
+        over the following chunks, at most `max_correction` frames each.
+        Replaces any correction not yet made."""
+        self.__correction = int( frames )
+
+    def finish( self ):
+        self.__stop_requested = True
+        self.__data_ready.set()
+        self.__thread.join()
+
+    #
+    # Sink side; the drain thread
+
+    def __drain( self ):
+        delivering = False
+        while not self.__stop_requested:
+            buf = self.buffer
+            discard = self.__discard
+            if discard is not None:
+                self.__discard = None
+                discard[0].discard_until( discard[1] )
+                delivering = False
+
+            if not len( buf ):
+                if delivering and self.__playing and not self.__end_of_track:
+                    # Ran dry mid-track: the sink will have a gap
+                    buf.underruns += 1
+                delivering = False
+                if self.__end_of_track:
+                    self.__end_of_track = False
+                    self.sink.end_of_track()
+                self.__data_ready.clear()
+                # Re-check in case frames arrived between the test and clear()
+                if not len( buf ) and not self.__end_of_track and self.__discard is None:
+                    self.__data_ready.wait( 0.5 )
+                continue
+
+            start_at = self.__start_at
+            if start_at is not None:
+                wait = start_at - self.clock()
+                if wait > 0:
+                    # A plain sleep; Event.wait() with a timeout polls, and
+                    # can wake tens of ms late
+                    time.sleep( min( wait, 0.05 ) )
+                    continue
+                self.__start_at = None
+                self.__position = ( start_at, 0 )
+
+            frame_size, sample_type, sample_rate, channels = self.__format
+            played = 0
+            correction = self.__correction
+            if correction < 0:
+                # Behind: skip a few frames
+                dropped = min( -correction, self.max_correction, len( buf ) - 1 )
+                if dropped > 0:
+                    buf.advance( dropped )
+                    played += dropped
+                    self.__correction = correction + dropped
+            elif correction > 0:
+                # Ahead: play the next few frames twice
+                chunk = buf.peek( min( correction, self.max_correction ) )
+                repeated = self.sink.music_delivery( self.__session, chunk.tobytes(), frame_size,
+                                                     len( chunk ) // frame_size, sample_type, sample_rate, channels )
+                del chunk
+                self.__correction = correction - repeated
+
+            chunk = buf.peek( self.chunk_frames )
+            num_frames = len( chunk ) // frame_size
+            consumed = self.sink.music_delivery( self.__session, chunk.tobytes(), frame_size,
+                                                 num_frames, sample_type, sample_rate, channels )
+            del chunk
+            played += consumed
+            if played:
+                self.__position = ( self.clock(), self.__position[1] + played )
+            if consumed:
+                buf.advance( consumed )
+                delivering = True
+            else:
+                # The sink is full; give it a moment
+                time.sleep( 0.005 )
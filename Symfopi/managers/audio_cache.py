@@ -0,0 +1,378 @@
+import collections
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from metrics import REGISTRY
+from logs import get_logger, fields
+
+log = get_logger( 'audio_cache' )
+
+CACHE_LOOKUPS = REGISTRY.counter( 'symfopi_audio_cache_lookups_total', 'Tracks looked up in the audio cache.',
+                                  labels=('result',) )
+CACHE_BYTES_SERVED = REGISTRY.counter( 'symfopi_audio_cache_served_bytes_total',
+                                       'Bytes of audio played from the audio cache rather than streamed.' )
+CACHE_EVICTIONS = REGISTRY.counter( 'symfopi_audio_cache_evictions_total',
+                                    'Tracks dropped from the audio cache.', labels=('reason',) )
+
+# File layout: a header, the track's frames, then a CRC-32 of each block of
+# BLOCK_FRAMES frames, checked as the block is first played
+HEADER = struct.Struct( '<4sHHHHIQI' )   # magic, version, frame size, sample type, channels,
+                                         # sample rate, frames, frames per block
+MAGIC = 'SFPC'
+VERSION = 1
+BLOCK_FRAMES = 65536
+
+
+class CorruptCacheFile( IOError ):
+    pass
+
+
+class CachedTrack( object ):
+    """A track's audio in the cache, memory-mapped for reading."""
+
+    def __init__( self, path ):
+        with open( path, 'rb' ) as f:
+            self.__map = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+        try:
+            if len( self.__map ) < HEADER.size:
+                raise CorruptCacheFile( "Truncated header" )
+            ( magic, version, self.frame_size, self.sample_type, self.channels,
+              self.sample_rate, self.num_frames, self.block_frames ) = HEADER.unpack_from( self.__map )
+            if magic != MAGIC or version != VERSION or not self.frame_size or not self.block_frames:
+                raise CorruptCacheFile( "Bad header" )
+            num_blocks = -( -self.num_frames // self.block_frames )
+            self.__crc_offset = HEADER.size + self.num_frames * self.frame_size
+            if len( self.__map ) != self.__crc_offset + num_blocks * 4:
+                raise CorruptCacheFile( "Wrong size" )
+        except Exception:
+            self.__map.close()
+            raise
+        self.__verified = set()
+
+    def read( self, first_frame, num_frames ):
+        """Return up to `num_frames` frames from `first_frame` on, checking
+        the blocks they come from the first time each is read. Raises
+        CorruptCacheFile if a block does not match its checksum."""
+        num_frames = max( 0, min( num_frames, self.num_frames - first_frame ) )
+        block = first_frame // self.block_frames
+        # Do not run over into a block not yet checked
+        num_frames = min( num_frames, ( block + 1 ) * self.block_frames - first_frame )
+        if block not in self.__verified:
+            self.__verify( block )
+        start = HEADER.size + first_frame * self.frame_size
+        return self.__map[start:start + num_frames * self.frame_size]
+
+    def __verify( self, block ):
+        start = HEADER.size + block * self.block_frames * self.frame_size
+        end = min( start + self.block_frames * self.frame_size, self.__crc_offset )
+        expected, = struct.unpack_from( '<I', self.__map, self.__crc_offset + block * 4 )
+        if zlib.crc32( self.__map[start:end] ) & 0xffffffff != expected:
+            raise CorruptCacheFile( "Checksum mismatch in block %d" % block )
+        self.__verified.add( block )
+
+    def close( self ):
+        self.__map.close()
+
+
+class CacheRecorder( object ):
+    """Writes the frames of a track as libspotify delivers them, to be
+    added to the cache if the whole track arrives in order. Written to a
+    ".part" file, which is renamed into place on `commit()`.
+
+    `write()` is called on libspotify's thread, and `commit()` and `abort()`
+    on the session actor's."""
+
+    def __init__( self, cache, uri, path, duration_ms ):
+        self.cache = cache
+        self.uri = uri
+        self.path = path
+        self.duration_ms = duration_ms
+        self.format = None
+        self.num_frames = 0
+        self.__lock = threading.Lock()
+        self.__file = open( path + '.part', 'wb', 1 << 20 )
+        self.__file.write( '\0' * HEADER.size )
+        self.__crcs = []
+        self.__block_crc = 0
+        self.__block_fill = 0
+
+    def write( self, frames, frame_size, num_frames, sample_type, sample_rate, channels ):
+        """Add frames; `frames` holds at least `num_frames` of them."""
+        with self.__lock:
+            if self.__file is not None:
+                self.__write( frames, frame_size, num_frames, sample_type, sample_rate, channels )
+
+    def __write( self, frames, frame_size, num_frames, sample_type, sample_rate, channels ):
+        fmt = ( frame_size, sample_type, sample_rate, channels )
+        if self.format is None:
+            self.format = fmt
+        elif fmt != self.format:
+            self.__abort()
+            return
+        data = frames[:num_frames * frame_size]
+        self.__file.write( data )
+        self.num_frames += num_frames
+        # Checksum per block, with deliveries split at block boundaries
+        pos = 0
+        while pos < num_frames:
+            n = min( num_frames - pos, BLOCK_FRAMES - self.__block_fill )
+            self.__block_crc = zlib.crc32( data[pos * frame_size:( pos + n ) * frame_size], self.__block_crc )
+            self.__block_fill += n
+            pos += n
+            if self.__block_fill == BLOCK_FRAMES:
+                self.__crcs.append( self.__block_crc & 0xffffffff )
+                self.__block_crc = 0
+                self.__block_fill = 0
+
+    def complete( self ):
+        """Whether the frames written make up the whole track, give or take
+        a second; libspotify's durations are not exact."""
+        if self.format is None or not self.duration_ms:
+            return False
+        expected = self.duration_ms * self.format[2] // 1000
+        return abs( self.num_frames - expected ) <= self.format[2]
+
+    def commit( self ):
+        """Finish the file and add it to the cache, if the whole track was
+        written; otherwise, drop it."""
+        with self.__lock:
+            if self.__file is None:
+                return
+            if not self.complete():
+                log.debug( "Not caching incomplete track", extra=fields( uri=self.uri, frames=self.num_frames ) )
+                self.__abort()
+                return
+            f = self.__file
+            self.__file = None
+        if self.__block_fill:
+            self.__crcs.append( self.__block_crc & 0xffffffff )
+        frame_size, sample_type, sample_rate, channels = self.format
+        f.write( struct.pack( '<%dI' % len( self.__crcs ), *self.__crcs ) )
+        f.seek( 0 )
+        f.write( HEADER.pack( MAGIC, VERSION, frame_size, sample_type, channels, sample_rate,
+                              self.num_frames, BLOCK_FRAMES ) )
+        f.close()
+        os.rename( self.path + '.part', self.path )
+        self.cache.added( self )
+
+    def abort( self ):
+        """Drop the recording, e.g. as the track was skipped or sought in."""
+        with self.__lock:
+            self.__abort()
+
+    def __abort( self ):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+            try:
+                os.remove( self.path + '.part' )
+            except OSError:
+                pass
+
+
+class AudioCache( object ):
+    """Decoded audio of whole tracks, kept in files in `directory` by track
+    URI, so that tracks played again start straight from local disk.
+
+    Tracks are recorded as libspotify delivers them (see `recorder()`), and
+    added once complete. When the files come to more than `max_bytes`, the
+    least recently played are deleted. The order of use survives restarts,
+    as each file's modification time is set as it is played.
+    """
+
+    # Bit rate of the stream a cached track stands in for, to estimate the
+    # network traffic saved
+    STREAM_BITRATE = 320000
+
+    def __init__( self, directory, max_bytes=2 * 1024 ** 3 ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__files = collections.OrderedDict()    # file name -> size, least recently used first
+        self.__bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.seconds_served = 0.0
+
+        if not os.path.isdir( directory ):
+            os.makedirs( directory )
+        found = []
+        for name in os.listdir( directory ):
+            path = os.path.join( directory, name )
+            if name.endswith( '.part' ):
+                # Left by a recording cut short
+                os.remove( path )
+            elif name.endswith( '.pcm' ):
+                st = os.stat( path )
+                found.append( ( st.st_mtime, name, st.st_size ) )
+        for mtime, name, size in sorted( found ):
+            self.__files[name] = size
+            self.__bytes += size
+        with self.__lock:
+            self.__evict( 0 )
+        log.info( "Audio cache opened", extra=fields( tracks=len( self.__files ), mb=self.__bytes // ( 1 << 20 ) ) )
+
+    @staticmethod
+    def file_name( uri ):
+        return hashlib.sha1( uri ).hexdigest() + '.pcm'
+
+    def open( self, uri ):
+        """Return the CachedTrack for a track URI, or None if it is not
+        cached, or its file is damaged, in which case it is dropped."""
+        name = self.file_name( uri )
+        with self.__lock:
+            if name not in self.__files:
+                self.misses += 1
+                CACHE_LOOKUPS.labels( 'miss' ).inc()
+                return None
+            self.__files[name] = self.__files.pop( name )   # most recently used
+        path = os.path.join( self.directory, name )
+        try:
+            track = CachedTrack( path )
+            os.utime( path, None )
+        except ( IOError, OSError, ValueError ) as ex:
+            log.warning( "Dropping damaged cache file", extra=fields( uri=uri, error=str( ex ) ) )
+            self.discard( uri, 'corrupt' )
+            with self.__lock:
+                self.misses += 1
+            CACHE_LOOKUPS.labels( 'miss' ).inc()
+            return None
+        with self.__lock:
+            self.hits += 1
+        CACHE_LOOKUPS.labels( 'hit' ).inc()
+        return track
+
+    def recorder( self, uri, duration_ms ):
+        """Return a CacheRecorder for a track about to be streamed."""
+        return CacheRecorder( self, uri, os.path.join( self.directory, self.file_name( uri ) ), duration_ms )
+
+    def added( self, recorder ):
+        """Called by a CacheRecorder whose file is complete."""
+        name = os.path.basename( recorder.path )
+        size = os.path.getsize( recorder.path )
+        with self.__lock:
+            self.__bytes -= self.__files.pop( name, 0 )
+            self.__files[name] = size
+            self.__bytes += size
+            self.__evict( 0 )
+        log.debug( "Cached track", extra=fields( uri=recorder.uri, mb=round( size / 1048576.0, 1 ) ) )
+
+    def discard( self, uri, reason='corrupt' ):
+        """Drop a track from the cache."""
+        name = self.file_name( uri )
+        with self.__lock:
+            if name in self.__files:
+                self.__remove( name, reason )
+
+    def served( self, num_bytes, seconds ):
+        """Count audio played from the cache."""
+        with self.__lock:
+            self.bytes_served += num_bytes
+            self.seconds_served += seconds
+        CACHE_BYTES_SERVED.inc( num_bytes )
+
+    def __evict( self, room ):
+        """Drop the least recently used files until `room` more bytes fit."""
+        while self.__files and self.__bytes + room > self.max_bytes:
+            self.__remove( next( iter( self.__files ) ), 'size' )
+
+    def __remove( self, name, reason ):
+        self.__bytes -= self.__files.pop( name )
+        CACHE_EVICTIONS.labels( reason ).inc()
+        try:
+            os.remove( os.path.join( self.directory, name ) )
+        except OSError:
+            pass
+
+    def stats( self ):
+        """Return a JSON-able dict of the cache's size and use."""
+        with self.__lock:
+            lookups = self.hits + self.misses
+            return { 'tracks': len( self.__files ),
+                     'bytes': self.__bytes,
+                     'max_bytes': self.max_bytes,
+                     'hits': self.hits,
+                     'misses': self.misses,
+                     'hit_rate': float( self.hits ) / lookups if lookups else None,
+                     'bytes_served': self.bytes_served,
+                     'network_bytes_saved': int( self.seconds_served * self.STREAM_BITRATE / 8 ) }
+
+
+class CachedTrackPlayer( object ):
+    """Plays a CachedTrack in place of libspotify's player: a thread offers
+    its frames to `deliver`, a music_delivery function, at whatever pace
+    it takes them, and calls `end_of_track()` after the last frame. If a
+    block of the file turns out damaged, `on_corrupt( position_ms )` is
+    called instead, for the rest of the track to be streamed."""
+
+    # Frames offered per delivery, and the wait before offering frames again
+    # when none were taken, as libspotify does
+    DELIVERY_FRAMES = 2048
+    RETRY_SECS = 0.01
+
+    def __init__( self, cache, uri, track, deliver, end_of_track, on_corrupt ):
+        self.cache = cache
+        self.uri = uri
+        self.track = track
+        self.deliver = deliver
+        self.end_of_track = end_of_track
+        self.on_corrupt = on_corrupt
+        self.position = 0              # next frame to deliver
+        self.__playing = threading.Event()
+        self.__unloaded = False
+        self.__thread = None
+
+    def seek( self, ms ):
+        self.position = min( ms * self.track.sample_rate // 1000, self.track.num_frames )
+
+    def play( self, flag ):
+        if flag:
+            if self.__thread is None:
+                self.__thread = threading.Thread( target=self.__run, name='cache-player' )
+                self.__thread.setDaemon( True )
+                self.__thread.start()
+            self.__playing.set()
+        else:
+            self.__playing.clear()
+
+    def unload( self ):
+        """Stop delivering, for good."""
+        self.__unloaded = True
+        self.__playing.set()
+
+    def __run( self ):
+        t = self.track
+        served = 0
+        try:
+            while True:
+                self.__playing.wait()
+                if self.__unloaded:
+                    return
+                if self.position >= t.num_frames:
+                    break
+                try:
+                    frames = t.read( self.position, self.DELIVERY_FRAMES )
+                except CorruptCacheFile as ex:
+                    log.warning( "Damaged cache file; streaming the rest", extra=fields( uri=self.uri,
+                                                                                      error=str( ex ) ) )
+                    self.cache.discard( self.uri, 'corrupt' )
+                    self.on_corrupt( self.position * 1000 // t.sample_rate )
+                    return
+                num_frames = len( frames ) // t.frame_size
+                taken = self.deliver( None, frames, t.frame_size, num_frames, t.sample_type,
+                                      t.sample_rate, t.channels )
+                self.position += taken
+                served += taken
+                if not taken:
+                    time.sleep( self.RETRY_SECS )
+        finally:
+            self.cache.served( served * t.frame_size, float( served ) / t.sample_rate )
+            t.close()
+        if not self.__unloaded:
+            self.end_of_track()
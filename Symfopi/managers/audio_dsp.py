@@ -0,0 +1,214 @@
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from logs import get_logger, fields
+
+log = get_logger( 'audio' )
+
+# libspotify's sample type for native-endian signed 16-bit samples, the
+# only one processed; others pass through untouched
+SAMPLE_INT16 = 0
+
+
+def _ring_segments( buffer, first, last ):
+    """Yield (frame position, frame offset, number of frames) of the
+    contiguous pieces of a PCMRingBuffer's storage holding frame positions
+    `first` to `last`."""
+    capacity = buffer.capacity
+    while first < last:
+        offset = first % capacity
+        n = min( last - first, capacity - offset )
+        yield first, offset, n
+        first += n
+
+
+class AudioProcessor( object ):
+    """The processing stage of a BufferedAudioOutput: volume, loudness
+    normalisation and crossfades, done with NumPy on whole blocks of 16-bit
+    frames rather than frame by frame.
+
+    Frames are processed in the output's ring buffer as they are delivered,
+    on libspotify's thread; only `set_volume()` may be called from others.
+    Gain changes, whether from the volume or from normalisation, ramp
+    across a block, so there are no steps to hear.
+
+    Normalisation brings each track towards `target_dbfs`, by a gain worked
+    out from a running RMS estimate of the track's level over about
+    `window_secs`, between `-max_gain_db` and `max_gain_db`, changing by
+    at most `slew_db_per_sec`.
+
+    With `crossfade_secs`, a track that follows on from another at its end
+    is mixed over the end of that one still buffered; see `crossfade()`.
+
+    Raises RuntimeError if NumPy is not installed.
+    """
+
+    # Mean square below which a block counts as silence, and is left out of
+    # the loudness estimate (about -60 dBFS)
+    SILENCE_MS = ( 32768 * 0.001 ) ** 2
+
+    def __init__( self, volume=1.0, normalise=True, target_dbfs=-18.0, max_gain_db=12.0,
+                  window_secs=3.0, slew_db_per_sec=6.0, crossfade_secs=0.0 ):
+        if numpy is None:
+            raise RuntimeError( "Audio processing needs NumPy" )
+        # To make another like it, as in the playback process
+        self.options = dict( volume=volume, normalise=normalise, target_dbfs=target_dbfs, max_gain_db=max_gain_db,
+                             window_secs=window_secs, slew_db_per_sec=slew_db_per_sec,
+                             crossfade_secs=crossfade_secs )
+        self.normalise = normalise
+        self.target_ms = ( 32768 * 10 ** ( target_dbfs / 20.0 ) ) ** 2
+        self.max_gain = 10 ** ( max_gain_db / 20.0 )
+        self.window_secs = window_secs
+        self.slew = 10 ** ( slew_db_per_sec / 20.0 )
+        self.crossfade_secs = crossfade_secs
+        self.volume = volume
+
+        self.__gain = volume           # gain applied at the end of the last block
+        self.__norm_gain = 1.0
+        self.__level_ms = None         # running mean square of the current track
+        self.__storage = None          # (bytearray, int16 array over it)
+
+    def accepts( self, sample_type ):
+        return sample_type == SAMPLE_INT16
+
+    def set_volume( self, volume ):
+        """Set the volume, from 0 to 1; the change ramps in over the next
+        block delivered."""
+        self.volume = max( 0.0, min( 1.0, volume ) )
+
+    def new_track( self ):
+        """Start estimating the loudness of a new track; called as its first
+        frames are delivered."""
+        self.__level_ms = None
+
+    def __samples( self, buffer ):
+        """Return an int16 array over a ring buffer's storage."""
+        storage = buffer.storage
+        if self.__storage is None or self.__storage[0] is not storage:
+            self.__storage = ( storage, numpy.frombuffer( storage, dtype=numpy.int16 ) )
+        return self.__storage[1]
+
+    def __apply_gain( self, f, channels, sample_rate ):
+        """Scale a block of float32 samples in place, by the gain ramping
+        from the last block's to the one the volume and loudness call for
+        now, and update the loudness estimate."""
+        num_frames = len( f ) // channels
+        secs = float( num_frames ) / sample_rate
+        if self.normalise:
+            ms = float( numpy.dot( f, f ) ) / len( f )
+            if ms > self.SILENCE_MS:
+                if self.__level_ms is None:
+                    self.__level_ms = ms
+                else:
+                    self.__level_ms += min( 1.0, secs / self.window_secs ) * ( ms - self.__level_ms )
+            if self.__level_ms is not None:
+                wanted = math.sqrt( self.target_ms / self.__level_ms )
+                wanted = max( 1.0 / self.max_gain, min( self.max_gain, wanted ) )
+                step = self.slew ** secs
+                self.__norm_gain = max( self.__norm_gain / step, min( self.__norm_gain * step, wanted ) )
+        start, end = self.__gain, self.volume * self.__norm_gain
+        self.__gain = end
+        if start == end:
+            if end != 1.0:
+                f *= end
+        else:
+            frames = f.reshape( num_frames, channels )
+            frames *= numpy.linspace( start, end, num_frames, endpoint=False, dtype=numpy.float32 )[:, None]
+
+    def process( self, buffer, first, last, channels, sample_rate ):
+        """Process frame positions `first` to `last` of a PCMRingBuffer in
+        place."""
+        samples = self.__samples( buffer )
+        for pos, offset, n in _ring_segments( buffer, first, last ):
+            block = samples[offset * channels:( offset + n ) * channels]
+            f = block.astype( numpy.float32 )
+            self.__apply_gain( f, channels, sample_rate )
+            numpy.clip( f, -32768, 32767, out=f )
+            block[:] = f
+
+    def crossfade( self, buffer, first, last, channels, sample_rate ):
+        """Fade out frame positions `first` to `last` of a PCMRingBuffer,
+        the end of a track, and return a Crossfade to mix the next track's
+        first frames over them."""
+        crossfade = Crossfade( self, buffer, first, last, channels, sample_rate )
+        samples = self.__samples( buffer )
+        for pos, offset, n in _ring_segments( buffer, first, last ):
+            block = samples[offset * channels:( offset + n ) * channels]
+            f = block.astype( numpy.float32 )
+            f.reshape( n, channels )[:] *= crossfade.fade_out( pos, pos + n )[:, None]
+            block[:] = f
+        log.debug( "Crossfading", extra=fields( ms=( last - first ) * 1000 // sample_rate ) )
+        return crossfade
+
+    def mix( self, buffer, first, frames, skip, num_frames, channels, sample_rate, fade ):
+        """Process `num_frames` frames from `frames`, after the first
+        `skip`, and add them to the frames from position `first` of a
+        PCMRingBuffer, scaled by the `fade` function of frame position."""
+        samples = self.__samples( buffer )
+        incoming = numpy.frombuffer( frames, dtype=numpy.int16, count=num_frames * channels,
+                                     offset=skip * channels * 2 )
+        f = incoming.astype( numpy.float32 )
+        self.__apply_gain( f, channels, sample_rate )
+        f.reshape( num_frames, channels )[:] *= fade( first, first + num_frames )[:, None]
+        done = 0
+        for pos, offset, n in _ring_segments( buffer, first, first + num_frames ):
+            block = samples[offset * channels:( offset + n ) * channels]
+            mixed = f[done * channels:( done + n ) * channels]
+            mixed += block
+            numpy.clip( mixed, -32768, 32767, out=mixed )
+            block[:] = mixed
+            done += n
+
+
+class Crossfade( object ):
+    """Mixes the first frames of a track over the faded-out end of the
+    last one, still in the ring buffer, with equal-power fades. Made by
+    `AudioProcessor.crossfade()`.
+
+    The fade region only ever holds unread frames when the crossfade
+    starts; if the reader catches up with the mixing, the incoming frames
+    it has passed are dropped.
+    """
+
+    def __init__( self, processor, buffer, first, last, channels, sample_rate ):
+        self.processor = processor
+        self.buffer = buffer
+        self.first = first
+        self.last = last
+        self.cursor = first            # next position to mix into
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.dropped = 0
+
+    def __angle( self, start, end ):
+        return ( numpy.arange( start, end, dtype=numpy.float32 ) - self.first ) * (
+            math.pi / 2 / ( self.last - self.first ) )
+
+    def fade_out( self, start, end ):
+        return numpy.cos( self.__angle( start, end ) )
+
+    def fade_in( self, start, end ):
+        return numpy.sin( self.__angle( start, end ) )
+
+    @property
+    def done( self ):
+        return self.cursor >= self.last
+
+    def mix( self, frames, num_frames, safe_from ):
+        """Mix up to `num_frames` frames from `frames` in, at no position
+        before `safe_from`, the first the reader may not yet have reached.
+        Returns the number of frames taken."""
+        n = min( num_frames, self.last - self.cursor )
+        skip = max( 0, min( n, safe_from - self.cursor ) )
+        if skip:
+            self.dropped += skip
+            self.cursor += skip
+        if n > skip:
+            self.processor.mix( self.buffer, self.cursor, frames, skip, n - skip,
+                                self.channels, self.sample_rate, self.fade_in )
+            self.cursor += n - skip
+        return n
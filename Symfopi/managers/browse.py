@@ -0,0 +1,171 @@
+import collections
+import threading
+import time
+
+from workers import Future
+from metrics import REGISTRY
+
+BROWSE_SECONDS = REGISTRY.histogram( 'symfopi_browse_seconds', 'Time for libspotify to load a browse.',
+                                     labels=('kind',) )
+
+
+class BrowseLoader( object ):
+    """Loads albums, artists, toplists and playlists from libspotify.
+
+    Each load returns a Future, completed from libspotify's own load
+    callback (on the session thread) rather than by polling `is_loaded()`,
+    so nothing waits on a sleep and no thread is tied up while a load is in
+    flight. Browser objects are kept referenced until their callback fires,
+    as libspotify requires.
+    """
+
+    def __init__( self, session, artist_browser=None, toplist_browser=None ):
+        """
+        session:
+            the logged-in libspotify session
+        artist_browser, toplist_browser:
+            the browser classes; default to pyspotify's ArtistBrowser and
+            ToplistBrowser. A fake session passes its own, to run offline.
+        """
+        if artist_browser is None or toplist_browser is None:
+            from spotify import ArtistBrowser, ToplistBrowser
+            artist_browser = artist_browser or ArtistBrowser
+            toplist_browser = toplist_browser or ToplistBrowser
+        self.session = session
+        self.__artist_browser = artist_browser
+        self.__toplist_browser = toplist_browser
+
+        self.__lock = threading.Lock()
+        self.__inflight = {}           # future -> browser awaiting its callback
+        self.__playlists = []          # (playlist, future) awaiting loading
+
+    def __start( self, kind, make_browser ):
+        fut = Future()
+        started = time.time()
+
+        def callback( browser, userdata=None ):
+            if not fut.done():
+                BROWSE_SECONDS.labels( kind ).observe_since( started )
+            fut.set_result( browser )
+            with self.__lock:
+                self.__inflight.pop( fut, None )
+
+        browser = make_browser( callback )
+        if browser.is_loaded():
+            # Already cached by libspotify; the callback may not come
+            BROWSE_SECONDS.labels( kind ).observe_since( started )
+            fut.set_result( browser )
+        else:
+            with self.__lock:
+                if not fut.done():
+                    self.__inflight[fut] = browser
+        return fut
+
+    def album( self, album ):
+        """Return a Future of the loaded AlbumBrowser for `album`."""
+        return self.__start( 'album', lambda cb: self.session.browse_album( album, cb ) )
+
+    def artist( self, artist ):
+        """Return a Future of the loaded ArtistBrowser for `artist`."""
+        return self.__start( 'artist', lambda cb: self.__artist_browser( artist, callback=cb ) )
+
+    def toplist( self, tl_type, tl_region ):
+        """Return a Future of the loaded ToplistBrowser."""
+        return self.__start( 'toplist', lambda cb: self.__toplist_browser( tl_type, tl_region, cb ) )
+
+    def playlist( self, playlist ):
+        """Return a Future of `playlist`, completed once it has loaded. The
+        playlist has to be watched by a playlist manager that passes its
+        state changes to `playlist_state_changed()`."""
+        fut = Future()
+        if playlist.is_loaded():
+            fut.set_result( playlist )
+            return fut
+        with self.__lock:
+            self.__playlists.append( ( playlist, fut ) )
+        # It may have loaded before it was added to the list
+        self.playlist_state_changed( playlist )
+        return fut
+
+    def playlist_state_changed( self, playlist ):
+        """Complete the Futures of any playlists that have now loaded."""
+        loaded, waiting = [], []
+        with self.__lock:
+            for entry in self.__playlists:
+                ( loaded if entry[0].is_loaded() else waiting ).append( entry )
+            self.__playlists = waiting
+        for p, fut in loaded:
+            fut.set_result( p )
+
+    def in_flight( self ):
+        """Number of loads awaiting a callback."""
+        return len( self.__inflight ) + len( self.__playlists )
+
+    def load_many( self, load, items, max_in_flight=8 ):
+        """Load each of `items` with `load` (such as `self.album`), with at
+        most `max_in_flight` loads outstanding at once. Returns a Future of
+        the list of results, in the order of `items`. If any load fails, the
+        Future fails with the first exception, once the rest have finished.
+        """
+        items = list( items )
+        done = Future()
+        results = [ None ] * len( items )
+        if not items:
+            done.set_result( results )
+            return done
+
+        lock = threading.Lock()
+        pending = collections.deque( enumerate( items ) )
+        state = { 'remaining': len( items ), 'slots': max( max_in_flight, 1 ),
+                  'error': None, 'starting': False }
+
+        def start( i, item ):
+            try:
+                fut = load( item )
+            except Exception as ex:
+                fut = Future()
+                fut.set_exception( ex )
+            fut.add_done_callback( lambda f: finished( i, f ) )
+
+        def start_more():
+            # Loads that complete straight away (already cached) call back
+            # into here; loop rather than recurse, one thread at a time
+            with lock:
+                if state['starting']:
+                    return
+                state['starting'] = True
+            while True:
+                with lock:
+                    if not pending or not state['slots']:
+                        state['starting'] = False
+                        return
+                    state['slots'] -= 1
+                    i, item = pending.popleft()
+                start( i, item )
+
+        def finished( i, fut ):
+            ex = fut.exception()
+            with lock:
+                if ex is not None:
+                    state['error'] = state['error'] or ex
+                else:
+                    results[i] = fut.result()
+                state['remaining'] -= 1
+                state['slots'] += 1
+                last = state['remaining'] == 0
+            if last:
+                if state['error'] is not None:
+                    done.set_exception( state['error'] )
+                else:
+                    done.set_result( results )
+            else:
+                start_more()
+
+        start_more()
+        return done
+
+    def albums( self, albums, max_in_flight=8 ):
+        return self.load_many( self.album, albums, max_in_flight )
+
+    def artists( self, artists, max_in_flight=8 ):
+        return self.load_many( self.artist, artists, max_in_flight )
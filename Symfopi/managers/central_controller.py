@@ -1,195 +1,303 @@
-from multiprocessing import Process, Queue, Pipe
 import collections
 import time
 import signal
-from datetime import datetime as dt
 import logging
-from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-from SocketServer import ThreadingMixIn
 import threading
-import json
-import urlparse
+import itertools
+import sys
 
-from spotify.manager import SpotifySessionManager, SpotifyPlaylistManager, SpotifyContainerManager
+# Only what is needed to start serving the API is imported here. The
+# managers' modules, playback's above all (pyspotify, libspotify and the
+# audio sink), are imported as the managers are built, once the API is up.
+from api_server import ThreadedHTTPServer, EventLoopHTTPServer, ArgumentError, TextResponse
+from scheduler import Scheduler, SYSTEM_CLOCK
+from events import EventBroker
+from workers import Future
+from zones import Zone, ZoneRegistry
+from readiness import Readiness
+from sync import DEFAULT_SYNC_PORT
+from metrics import REGISTRY
+from logs import get_logger, setup_logging, fields
 
-from playback import PlaybackManager
-from spotify_API import SpotifyAPIManager
-from motion import MotionManager
+log = get_logger( 'controller' )
     
    
-class ThreadedHTTPServer( ThreadingMixIn, HTTPServer ):
-    """Extension to BaseHTTPServer's HTTPServer with threaded connections,
-    enabling asynchronous behaviour.
+class CentralController( object ):
+    """
+    A central controller that handles the supporting managers.
+    """
+    
+    SERVER_MODES = ( 'eventloop', 'threaded' )
+    
+    TRACK_FIELDS = ( 'uri', 'name', 'artist', 'album', 'duration_ms' )
+    REMOTE_SEARCH_TIMEOUT = 10.0
+    
+    # Functions that act on one zone; served at "<name>" and
+    # "zones/{zone}/<name>", or with a "zone" argument
+    ZONE_FUNCTIONS = ( 'get_current_playlist', 'get_playback_state', 'set_playback_enabled',
+                       'set_motion_control_enabled', 'next_track', 'set_current_playlist' )
+    
+    # Seconds between snapshots of the playback state while playing, to
+    # keep the saved track position fresh; state changes are saved as
+    # they happen
+    STATE_SAVE_INTERVAL = 15.0
     
-    Clearly, this enables usual race condition issues."""
-    # Superb reference for Python's Base HTTP Server:
-    #   http://www.doughellmann.com/PyMOTW/BaseHTTPServer/index.html#module-BaseHTTPServer
-    # Also includes advice on automatic multi-threading.
-    # Future:
-    #   Consider refactor to replace homebrew code with some established 
-    #   minimalist web framework for the HTTP server and API. E.g., CherryPy?
+    # Requests per second, and burst, that each client address may make in
+    # each priority class of the API; see APIRequestDispatcher
+    RATE_LIMITS = { 'control': ( 10, 20 ), 'interactive': ( 20, 40 ), 'bulk': ( 2, 5 ) }
     
-    def __init__( self, server_addr, req_handler_class, central_controller ):
+    # Managers built in the background once the API is serving, in order,
+    # and those each needs first; see `start_managers()`
+    MANAGERS = ( ( 'metadata', () ),
+                 ( 'api', ( 'metadata', ) ),
+                 ( 'playback', ( 'metadata', ) ),
+                 ( 'zones', ( 'playback', ) ),
+                 ( 'sync', ( 'playback', ) ) )
+    
+    def __init__( self, server_mode='eventloop', metrics_enabled=True, zone_names=( 'default', ),
+                  sync_followers=None, sync_port=None, sync_leader=None, sync_secret=None,
+                  api_address=( '', 8000 ), clock=SYSTEM_CLOCK, sensor_factory=None, audio_cache=None, audio_processor=None, isolate_playback=False ):
         """
-        central_controller:
-            the central controller object whose methods (functions) will be 
-            called to fullfil HTTP requests
+        server_mode:
+            'eventloop' serves the API from a single-threaded EventLoopHTTPServer;
+            'threaded' uses the older thread-per-request ThreadedHTTPServer
+        metrics_enabled:
+            whether the managers record metrics for the /metrics endpoint
+        zone_names:
+            the rooms to serve, each with its own playback and motion
+            control but sharing one Spotify session; the first is the
+            default zone
+        sync_followers:
+            (host, port) addresses of other controllers to keep in step
+            with this one, as their sync leader
+        sync_port:
+            UDP port to follow a sync leader on
+        sync_leader:
+            host of the sync leader to follow; messages from others are
+            ignored
+        sync_secret:
+            key shared by the sync leader and its followers to sign their
+            messages with, if any
+        api_address:
+            (host, port) to serve the API on
+        clock:
+            SystemClock that the controller's timers and the managers' waits
+            are in; a VirtualClock runs them faster, for simulations
+        sensor_factory:
+            makes each zone's MotionSensor; see MotionManager
+        audio_cache:
+            AudioCache to play tracks from without streaming them, if any
+        audio_processor:
+            AudioProcessor for volume, loudness normalisation and
+            crossfades, if any
+        isolate_playback:
+            run the Spotify session and audio output in a child process,
+            restarted if it dies; see PlaybackHost
         """
-        HTTPServer.__init__( self, server_addr, req_handler_class )
+        if server_mode not in self.SERVER_MODES:
+            raise ValueError( "Unknown server mode '%s'" % server_mode )
+        if not zone_names:
+            raise ValueError( "At least one zone is needed" )
+        if sync_port is not None and not sync_leader:
+            raise ValueError( "A sync follower needs its leader's address" )
+        self.server_mode = server_mode
+        self.zone_names = tuple( zone_names )
+        self.zones = ZoneRegistry()
+        self.sync_followers = sync_followers
+        self.sync_port = sync_port
+        self.sync_leader_host = sync_leader
+        self.sync_secret = sync_secret
+        self.api_address = api_address
+        self.sync_leader = None
+        self.sync_follower = None
+        self.metadata_store = None
+        self.search_index = None
+        self.api_manager = None
+        self.playback_manager = None
+        self.__state_save = None     # ScheduledCall of the next playback state snapshot
+        REGISTRY.enabled = metrics_enabled
+        self.httpd = None
         
-        self.c_controller = central_controller
-        self.registered_funcs = { 'GET':{}, 'PUT':{}, 'POST':{}  }  
-    
-    def register_api_function( self, pathname, func, http_method ):
-        """Add a function that the server will respond to. 
+        with_sync = bool( sync_followers ) or sync_port is not None
+        self.readiness = Readiness( [ name for name, needs in self.MANAGERS if name != 'sync' or with_sync ] )
+        self.__startup = None
+        self.__stop_requested = False
         
-        pathname: 
-            matched to the URL path to indicate that the function should be
-        called
-        func: 
-            function handle that will be called
-        http_method: 
-            the HTTP method that the function must be called with (e.g., GET)
-        """
-        if http_method not in self.registered_funcs:
-            self.registered_funcs[http_method] = {}
+        self.__state_versions = itertools.count( 1 )
+        self.state_version = next( self.__state_versions )
         
-        self.registered_funcs[http_method][pathname] = func
+        self.clock = clock
+        self.sensor_factory = sensor_factory
+        self.audio_cache = audio_cache
+        self.audio_processor = audio_processor
+        self.isolate_playback = isolate_playback
+        self.playback_host = None    # PlaybackHost, with isolate_playback
+        self.scheduler = Scheduler( clock=clock )
+        self.events = EventBroker( self.scheduler )
     
-    class HTTPRequestHandler( BaseHTTPRequestHandler ):
-        """Class for objects representing a specific case of hanlding a 
-        HTTP request. 
-        
-        Responds by calling the appropriate CentralController object's
-        function, as specified by the request. First checks if the function
-        being requested is permitted beforehand, using the HTTPServer's
-        `c_funcs` dict.
-        
-        == CONVENTIONS FOR 'DO' FUNCTIONS ==
-        
-        All HTTP query arguments are translated to a dictionary and passed on 
-        to the "do_" function call as a single argument.
-        
-        A "do_" function is expected to return either a JSON-able object or
-        None. If None, then the HTTP handler will return an empty payload
-        (empty string).
-        If not None, the object returned by the do function is translated to 
-        JSON and returned.
+    def state_changed( self, kind, data=None ):
+        """Record that the controller's state (playback, playlist, motion
+        control) has changed, so that cached API responses are refreshed,
+        and tell subscribers to the event stream.
         
-        The do function is responsible for handling the HTTP arguments in the
-        passed-in dictionary. The function should check for unexpected
-        query arguments and raise an ArgumentError as appropriate.
-        When such an error is encountered, the HTTP request handler
-        will send back a 400 HTTP error and the error's message as the HTTP 
-        payload.
+        kind:
+            what changed: 'playback', 'track', 'playlist', 'motion',
+            'motion_control' or 'volume'
+        data:
+            JSON-able dict describing the new state
         """
-        
-        def __init__( self, *oargs, **kwargs ):
-            BaseHTTPRequestHandler.__init__( self, *oargs, **kwargs )
-        
-        def do_GET( self ):
-            self.unified_handler( 'GET' )
-        
-        def do_POST( self ):
-            self.unified_handler( 'POST' )
-            
-        def do_PUT( self ):
-            self.unified_handler( 'PUT' )
-        
-        def unified_handler( self, http_req_method ):
-            """Unified place to handle HTTP requests sent over various methods."""
-            
-            # self.
-            #    'client_address',
-            #    'server',     the server object
-            #    'command',
-            #    'path',
-            #    'request_version',
-            #    'headers',
-            #    'server_version',
-            #    'sys_version',
-            #    'error_message_format',
-            #    'error_content_type',
-            #    'protocol_version',
-            #    'responses' 
-            
-            #
-            # Parse the request
-            req_url_endpath = self.path
-            parse = urlparse.urlparse( req_url_endpath )
-            # parse.scheme
-            # parse.netloc
-            # parse.path        path (/.../)
-            # parse.params      params for last path element
-            # parse.query       query component (?...)
-            # parse.fragment
-            
-            path_str = parse.path
-            query_str = parse.query 
-            
-            #
-            # Parse and validate the path to get the function name
-            if http_req_method not in self.server.registered_funcs:
-                # The acceptable methods dictionary did not mention
-                # this type of HTTP request method
-                print "no such HTTP request method"
+        self.state_version = next( self.__state_versions )
+        self.events.publish( kind, data )
+        self.schedule_state_save( 0.5 )
+    
+    def schedule_state_save( self, delay ):
+        """Snapshot every zone's playback state into the metadata store in
+        `delay` seconds, unless a snapshot is already due sooner, so that a
+        burst of changes is saved once."""
+        if self.metadata_store is None:
+            return
+        pending = self.__state_save
+        if pending is not None and not pending.cancelled:
+            if pending.when <= self.clock() + delay:
                 return
-            
-            func_name = path_str.strip('/')
-            
-            if not func_name in self.server.registered_funcs[http_req_method]:
-                print "function does not exist or not permitted for the given HTTP method"
-                return 
-            
-            func_handle = self.server.registered_funcs[http_req_method][func_name]
-                        
-            #
-            # Prepare HTTP arguments for calling
-            # Save as JSON
-            qargs_dict = urlparse.parse_qs( query_str, keep_blank_values=True )
-            
-            #
-            # Run the function and handle sending back the headers and response
-            try:
-                ret = func_handle( qargs_dict )
-            except (ArgumentError,) as ex:
-                errmsg = ex.message
-                self.send_response( 400 )  # 400: bad request, do not retry w/o correction
-                self.end_headers()
-                self.wfile.write( errmsg )
-            else:
-                if ret is not None:
-                    response_str = json.dumps( ret )
-                else:
-                    response_str = ""
-            
-                self.send_response( 200 )
-                self.end_headers()
-                self.wfile.write( response_str )
-                
-            
-class ArgumentError( RuntimeError ):
-    pass
+            self.scheduler.cancel( pending )
+        self.__state_save = self.scheduler.call_later( delay, self.save_state )
     
-
-class CentralController( object ):
-    """
-    A central controller that handles the supporting managers.
-    """
+    def save_state( self, wait=False ):
+        """Snapshot every zone's playback state into the metadata store.
+        
+        wait:
+            whether to wait for the snapshots to be taken, as when stopping
+        """
+        self.__state_save = None
+        playing = False
+        for zone in self.zones:
+            def save( fut, zone=zone ):
+                if fut.exception() is None:
+                    state = fut.result()
+                    state['motion_control'] = zone.motion_manager.is_enabled()
+                    self.metadata_store.save_playback_state( zone.name, state )
+            fut = zone.playback_manager.snapshot()
+            fut.add_done_callback( save )
+            if wait:
+                fut.exception()
+            playing = playing or zone.playback_manager.is_playing()
+        if playing and not wait:
+            self.schedule_state_save( self.STATE_SAVE_INTERVAL )
     
-    def __init__( self ):
-        """ """
+    def restore_state( self ):
+        """Take up each zone's playback state as saved before a restart."""
+        for zone in self.zones:
+            state = self.metadata_store.playback_state( zone.name )
+            if state is None:
+                continue
+            zone.playback_manager.restore( state )
+            if state.get( 'motion_control' ):
+                zone.motion_manager.enable_motion_monitor()
     
     #
     #
     # Top-level API functions
     #
+    def zone_for( self, qargs_dict ):
+        """Pop the "zone" argument and return that zone, or the default zone
+        if there is no such argument."""
+        self.readiness.require( 'zones' )
+        name = qargs_dict.pop( 'zone', [None] )[0]
+        try:
+            return self.zones.get( name )
+        except KeyError:
+            raise ArgumentError( "Unknown zone '%s'" % name )
+    
+    def do_get_playback_state( self, qargs_dict ):
+        """
+        Expected args:
+        * None
+        
+        Return data:
+        { zone, playing, playlist_index, track: [ playlist, track ] or null,
+          queue_length, queue_position, logged_in, motion_control }
+        
+        Until the zones are up, the state saved by the last run is returned.
+        """
+        if not self.readiness.is_ready( 'zones' ):
+            return self.saved_playback_state( qargs_dict )
+        zone = self.zone_for( qargs_dict )
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        state = zone.playback_manager.state()
+        state['motion_control'] = zone.motion_manager.is_enabled()
+        return state
+    
+    def saved_playback_state( self, qargs_dict ):
+        """The playback state of a zone as last saved, in the form of
+        `do_get_playback_state`, for while the zones are starting."""
+        self.readiness.require( 'metadata' )
+        from play_queue import PlayQueue
+        name = qargs_dict.pop( 'zone', [self.zone_names[0]] )[0]
+        if name not in self.zone_names:
+            raise ArgumentError( "Unknown zone '%s'" % name )
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        state = self.metadata_store.playback_state( name ) or {}
+        queue = PlayQueue()
+        if 'queue' in state:
+            queue.restore( state['queue'] )
+        return { 'zone': name,
+                 'playing': state.get( 'playing', False ),
+                 'playlist_index': state.get( 'playlist_index' ),
+                 'track': state.get( 'track' ),
+                 'queue_length': len( queue ),
+                 'queue_position': queue.position,
+                 'logged_in': False,
+                 'motion_control': state.get( 'motion_control', False ) }
+    
     def do_set_playback_enabled( self, qargs_dict ):
-        """ """
+        """
+        Expected args:
+        * flag: 'true' to resume playback, 'false' to pause it
+        
+        Return data:
+        None, once the zone's playback manager has carried it out
+        """
+        zone = self.zone_for( qargs_dict )
+        if 'flag' not in qargs_dict:
+            raise ArgumentError( "Missing argument: flag" )
+        flag = qargs_dict.pop( 'flag' )[0]
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        if flag == 'true':
+            fut = zone.playback_manager.resume_playback()
+        elif flag == 'false':
+            fut = zone.playback_manager.pause_playback()
+        else:
+            raise ArgumentError( "Cannot understand flag value '%s'" % flag )
+        return self.command_done( fut, 'playback', { 'zone': zone.name, 'playing': flag == 'true' } )
+    
+    def command_done( self, fut, kind, data ):
+        """Return a Future of None for the API, completed once a playback
+        command's Future `fut` is; if the command changed anything, as its
+        result says, the `kind` state change is published first. An
+        IndexError, in this process or the playback process, is an
+        ArgumentError."""
+        ret = Future()
+        def done( f ):
+            ex = f.exception()
+            if ex is not None:
+                if getattr( ex, 'kind', type( ex ).__name__ ) == 'IndexError':
+                    ex = ArgumentError( str( ex ) )
+                ret.set_exception( ex )
+                return
+            if f.result():
+                self.state_changed( kind, data )
+            ret.set_result( None )
+        fut.add_done_callback( done )
+        return ret
     
     def do_set_motion_control_enabled( self, qargs_dict ):
         #
         # Input handling
+        zone = self.zone_for( qargs_dict )
         if 'flag' not in qargs_dict:
             raise ArgumentError( "Missing argument: flag" )
         flag = qargs_dict.pop( 'flag' )[0]
@@ -199,14 +307,19 @@ class CentralController( object ):
         #
         # Do it
         if flag == 'true':
-            self.motion_manager.enable_motion_monitor()
+            zone.motion_manager.enable_motion_monitor()
         elif flag == 'false':
-            self.motion_manager.disable_motion_monitor()
+            zone.motion_manager.disable_motion_monitor()
         else:
             raise ArgumentError( "Cannot understand flag value '%s'" % flag )
+        self.state_changed( 'motion_control', { 'zone': zone.name, 'enabled': flag == 'true' } )
 
     def do_next_track( self, qargs_dict ):
         """ """
+        zone = self.zone_for( qargs_dict )
+        fut = zone.playback_manager.next_track()
+        fut.add_done_callback( lambda f: self.state_changed( 'track', { 'zone': zone.name } ) )
+        return fut
 
     def do_get_current_playlist( self, qargs_dict ):
         """
@@ -216,14 +329,331 @@ class CentralController( object ):
         Return data:
         { playlist_name, playlist_index }
         """
+        self.zone_for( qargs_dict )
         assert len(qargs_dict) == 0
         ret = { 'playlist_name':'test_playlist', 'playlist_index': 33 }
         return ret 
     
+    def do_get_playlists( self, qargs_dict ):
+        """
+        Expected args:
+        * None
+        
+        Return data:
+        [ playlist_name, ... ]
+        """
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        self.readiness.require( 'api' )
+        return self.api_manager.get_playlists_list()
+    
+    def playlists_list_version( self ):
+        """Cache version of `do_get_playlists`."""
+        self.readiness.require( 'api' )
+        return self.api_manager.playlists_list_version()
+    
+    def do_get_events( self, qargs_dict ):
+        """
+        Long-poll for state-change events. Responds as soon as there are
+        events after `since`, or with no events once `timeout` seconds pass.
+        
+        Expected args:
+        * since (optional): the `seq` from the previous response; if not
+          given, the latest event of each kind is returned straight away
+        * timeout (optional): seconds to wait, at most 60; default 30
+        
+        Return data:
+        { seq, events: [ { seq, kind, time, data }, ... ], coalesced }
+        """
+        try:
+            since = int( qargs_dict.pop( 'since' )[0] ) if 'since' in qargs_dict else None
+            timeout = float( qargs_dict.pop( 'timeout', ['30'] )[0] )
+        except ValueError as ex:
+            raise ArgumentError( "Bad argument value: %s" % ex )
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        
+        return self.events.wait_for_events( since, min( max( timeout, 0.0 ), 60.0 ) )
+    
+    def do_search( self, qargs_dict ):
+        """
+        Search the names of the tracks and playlists the jukebox knows of.
+        If no track matches, Spotify's own search is used instead.
+        
+        Expected args:
+        * q: the words to search for; the last may be incomplete
+        * limit (optional): most results of each kind, at most 100; default 20
+        
+        Return data:
+        { tracks: [ { uri, name, artist, album, duration_ms }, ... ],
+          playlists: [ { uri, name }, ... ],
+          source: 'local' or 'remote' }
+        """
+        if 'q' not in qargs_dict:
+            raise ArgumentError( "Missing argument: q" )
+        query = qargs_dict.pop( 'q' )[0]
+        try:
+            limit = int( qargs_dict.pop( 'limit', ['20'] )[0] )
+        except ValueError as ex:
+            raise ArgumentError( "Bad argument value: %s" % ex )
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        limit = min( max( limit, 1 ), 100 )
+        self.readiness.require( 'metadata' )
+        
+        def response( tracks, source ):
+            return { 'tracks': [ dict( zip( self.TRACK_FIELDS, t ) ) for t in tracks ],
+                     'playlists': [ { 'uri': uri, 'name': name } 
+                                    for uri, name in self.search_index.search_playlists( query, limit ) ],
+                     'source': source }
+        
+        tracks = self.search_index.search_tracks( query, limit )
+        if tracks:
+            return response( tracks, 'local' )
+        
+        self.readiness.require( 'playback' )
+        ret = Future()
+        timeout = self.scheduler.call_later( self.REMOTE_SEARCH_TIMEOUT, ret.set_exception,
+                                             RuntimeError( "Spotify search timed out" ) )
+        def remote_done( fut ):
+            self.scheduler.cancel( timeout )
+            if fut.exception() is not None:
+                ret.set_exception( fut.exception() )
+            else:
+                ret.set_result( response( fut.result(), 'remote' ) )
+        if self.playback_host is not None:
+            search = self.playback_host.search_tracks( query, limit )
+        else:
+            search = self.playback_manager.jukebox.search_tracks( query, limit )
+        search.add_done_callback( remote_done )
+        return ret
+    
+    def do_get_metrics( self, qargs_dict ):
+        """
+        Expected args:
+        * None
+        
+        Return data:
+        the metrics, in the Prometheus text format
+        """
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        return TextResponse( REGISTRY.render() )
+    
     def do_set_current_playlist( self, qargs_dict ):
-        """ """
+        """
+        Expected args:
+        * playlist_index: index of the playlist in the user's list
         
-        print "do -- set current playlist"
+        Return data:
+        None, once the zone's playback manager has carried it out
+        """
+        zone = self.zone_for( qargs_dict )
+        if 'playlist_index' not in qargs_dict:
+            raise ArgumentError( "Missing argument: playlist_index" )
+        try:
+            playlist_index = int( qargs_dict.pop( 'playlist_index' )[0] )
+        except ValueError as ex:
+            raise ArgumentError( "Bad argument value: %s" % ex )
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        if playlist_index < 0:
+            raise ArgumentError( "Playlist index out of range: %d" % playlist_index )
+        log.debug( "Set current playlist", extra=fields( zone=zone.name, playlist=playlist_index ) )
+        fut = zone.playback_manager.set_current_playlist( playlist_index )
+        return self.command_done( fut, 'playlist', { 'zone': zone.name, 'playlist_index': playlist_index } )
+    
+    def do_set_volume( self, qargs_dict ):
+        """
+        Set the output volume, shared by every zone. Needs the audio
+        processor.
+        
+        Expected args:
+        * level: 0 to 100
+        
+        Return data:
+        None
+        """
+        if self.audio_processor is None:
+            raise ArgumentError( "No audio processing; start with --normalise or --crossfade" )
+        if 'level' not in qargs_dict:
+            raise ArgumentError( "Missing argument: level" )
+        try:
+            level = int( qargs_dict.pop( 'level' )[0] )
+        except ValueError as ex:
+            raise ArgumentError( "Bad argument value: %s" % ex )
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        if not 0 <= level <= 100:
+            raise ArgumentError( "Volume out of range: %d" % level )
+        if self.playback_host is not None:
+            self.playback_host.set_volume( level / 100.0 )
+        else:
+            self.audio_processor.set_volume( level / 100.0 )
+        self.state_changed( 'volume', { 'level': level } )
+    
+    def do_sync_start( self, qargs_dict ):
+        """
+        Start a track here and on every sync follower at the same moment.
+        
+        Expected args:
+        * uri: the track's Spotify URI
+        * lead (optional): seconds from now to start; default 0.5
+        
+        Return data:
+        { start_at, followers: { "host:port": { offset_ms, delay_ms }, ... } }
+        """
+        if not self.sync_followers:
+            raise ArgumentError( "Not a sync leader" )
+        if 'uri' not in qargs_dict:
+            raise ArgumentError( "Missing argument: uri" )
+        uri = qargs_dict.pop( 'uri' )[0]
+        try:
+            lead = float( qargs_dict.pop( 'lead', ['0.5'] )[0] )
+        except ValueError as ex:
+            raise ArgumentError( "Bad argument value: %s" % ex )
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        self.readiness.require( 'sync' )
+        
+        when = self.sync_leader.schedule_start( uri, lead )
+        self.play_uri_at( uri, when )
+        self.state_changed( 'track', { 'uri': uri, 'start_at': when } )
+        return { 'start_at': when,
+                 'followers': dict( ( '%s:%d' % addr, { 'offset_ms': est.offset * 1000, 'delay_ms': est.delay * 1000 } )
+                                    for addr, est in self.sync_leader.estimates.items() ) }
+    
+    def do_get_zones( self, qargs_dict ):
+        """
+        Expected args:
+        * None
+        
+        Return data:
+        [ { name, playing, motion_control }, ... ], the default zone first
+        """
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        self.readiness.require( 'zones' )
+        return [ zone.status() for zone in self.zones ]
+    
+    def do_get_health( self, qargs_dict ):
+        """
+        Expected args:
+        * None
+        
+        Return data:
+        { ready, managers: { name: { state, seconds, error }, ... } }, with
+        each manager's state 'pending', 'starting', 'ready' or 'failed'
+        """
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        return { 'ready': self.readiness.all_ready(), 'managers': self.readiness.status() }
+    
+    def do_get_manager_health( self, qargs_dict ):
+        """
+        Answers 503 until the manager is ready, for readiness probes.
+        
+        Expected args:
+        * manager: path parameter, e.g. "playback"
+        
+        Return data:
+        { state, seconds, error }
+        """
+        name = qargs_dict.pop( 'manager' )[0]
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        try:
+            status = self.readiness.status( name )
+        except KeyError:
+            raise ArgumentError( "Unknown manager '%s'" % name )
+        self.readiness.require( name )
+        return status
+    
+    def do_get_audio_cache( self, qargs_dict ):
+        """
+        Expected args:
+        * None
+        
+        Return data:
+        { enabled, tracks, bytes, max_bytes, hits, misses, hit_rate,
+          bytes_served, network_bytes_saved }; only enabled if there is no
+        audio cache
+        """
+        if qargs_dict:
+            raise ArgumentError( "Unexpected arguments: " + ','.join(qargs_dict.keys())  )
+        if self.audio_cache is None:
+            return { 'enabled': False }
+        if self.playback_host is not None:
+            self.readiness.require( 'playback' )
+            return self.playback_host.audio_cache_stats()
+        stats = self.audio_cache.stats()
+        stats['enabled'] = True
+        return stats
+    
+    def register_gauges( self ):
+        """Expose the managers' own counts as metrics, read when the metrics
+        are collected rather than kept up to date on the hot paths. With the
+        playback process, they come from its StatusBlock."""
+        if self.playback_host is not None:
+            status = self.playback_host.status
+            fill_level = lambda: status()['fill_level']
+            overruns = lambda: status()['overruns']
+            underruns = lambda: status()['underruns']
+            queue_length = lambda: status()['queue_length']
+            commands_pending = lambda: status()['commands_pending']
+            REGISTRY.counter( 'symfopi_playback_process_restarts_total', 'Times the playback process was restarted.',
+                              func=lambda: self.playback_host.restarts )
+        else:
+            jukebox = self.playback_manager.jukebox
+            audio = jukebox.audio
+            fill_level = lambda: audio.buffer.fill_level()
+            overruns = lambda: audio.buffer.overruns
+            underruns = lambda: audio.buffer.underruns
+            queue_length = lambda: jukebox.queue_status()[1]
+            commands_pending = self.playback_manager.actor.pending
+        REGISTRY.gauge( 'symfopi_audio_buffer_fill_ratio', 'Fraction of the audio ring buffer holding unplayed frames.',
+                        func=fill_level )
+        REGISTRY.counter( 'symfopi_audio_buffer_overruns_total', 'Writes to the audio buffer that did not fit.',
+                          func=overruns )
+        REGISTRY.counter( 'symfopi_audio_buffer_underruns_total', 'Times the audio buffer ran dry mid-stream.',
+                          func=underruns )
+        REGISTRY.gauge( 'symfopi_play_queue_length', 'Tracks waiting in the play queue.',
+                        func=queue_length )
+        REGISTRY.gauge( 'symfopi_session_commands_pending', 'Commands waiting for the session actor.',
+                        func=commands_pending )
+        REGISTRY.gauge( 'symfopi_scheduler_calls_pending', 'Timers waiting on the shared scheduler.',
+                        func=self.scheduler.pending )
+    
+    def add_zone( self, name, playback_manager=None ):
+        """Add a zone with its own playback and motion managers. The
+        playback manager shares the default zone's Spotify session unless
+        one is given, as it is for the default zone itself."""
+        from motion import MotionManager
+        if playback_manager is None and self.playback_host is not None:
+            playback_manager = self.playback_host.manager( name )
+        elif playback_manager is None:
+            from playback import PlaybackManager
+            shared = self.playback_manager
+            playback_manager = PlaybackManager( shared.sp_username, shared.sp_password, shared.sp_api_key,
+                                                zone=name, shared=shared, clock=self.clock )
+        
+        def motion_started_cb():
+            log.info( "Motion started", extra=fields( zone=name ) )
+            playback_manager.resume_playback()
+            self.state_changed( 'motion', { 'zone': name, 'detected': True } )
+            self.state_changed( 'playback', { 'zone': name, 'playing': True } )
+        
+        def motion_stopped_cb():
+            log.info( "Motion stopped", extra=fields( zone=name ) )
+            playback_manager.pause_playback()
+            self.state_changed( 'motion', { 'zone': name, 'detected': False } )
+            self.state_changed( 'playback', { 'zone': name, 'playing': False } )
+        
+        motion_manager = MotionManager( motion_started_cb, motion_stopped_cb, 
+                                        scheduler=self.scheduler, sensor_factory=self.sensor_factory )
+        zone = Zone( name, playback_manager, motion_manager )
+        self.zones.add( zone )
+        return zone
     
     #
     #
@@ -232,84 +662,321 @@ class CentralController( object ):
     def start( self ):
         """ """
         #
-        # Credentials 
-        spotify_username = "xyz"
-    	spotify_password = "123"
-        spotify_api_key = "sdsad323wd"
+        # HTTP server that represents the central controller API. It listens
+        # before any manager is built, and its functions answer 503 until
+        # the managers they use are ready (see "health")
+        if self.server_mode == 'threaded':
+            httpd = ThreadedHTTPServer( self.api_address, ThreadedHTTPServer.HTTPRequestHandler, self )
+            httpd.timeout = 0.5  # so that SIGTERM is noticed between requests
+        else:
+            httpd = EventLoopHTTPServer( self.api_address, self )
+        self.httpd = httpd
+        self.register_api_functions( httpd )
+        httpd.set_rate_limits( self.RATE_LIMITS )
+        log.info( "API listening" )
         
         #
-        # Playback manager
-        self.playback_manager = PlaybackManager( spotify_username, spotify_password, spotify_api_key )
+        # Managers, built in the background while the API serves
+        self.__startup = threading.Thread( target=self.start_managers, name='startup' )
+        self.__startup.setDaemon( True )
+        self.__startup.start()
         
-        #
-        # API manager
-        self.api_manager = SpotifyAPIManager()
+        # unconditional execution: httpd.serve_forever()
+
+        if self.server_mode == 'threaded':
+            global SIGTERM_SENT
+            while not SIGTERM_SENT:
+                httpd.handle_request()
+        else:
+            httpd.serve_forever()
         
         #
-        # Motion subprocess
-        def motion_started_cb():
-            print "Motion started"
-            self.playback_manager.resume_playback()
+        # Finish up
+        log.info( "Safely stopping" )
+        self.stop()
+    
+    def start_managers( self ):
+        """Build the managers in the order of MANAGERS, skipping any whose
+        dependencies failed. Runs on the startup thread."""
+        for name, needs in self.MANAGERS:
+            if self.__stop_requested:
+                return
+            if name not in self.readiness.status():
+                continue
+            failed = [ n for n in needs if not self.readiness.is_ready( n ) ]
+            if failed:
+                self.readiness.fail( name, "Needs %s" % ', '.join( failed ) )
+                continue
+            self.readiness.run( name, getattr( self, 'start_' + name ) )
+    
+    def start_metadata( self ):
+        """Playlist and track metadata, kept on disk between runs."""
+        from metadata_store import MetadataStore
+        from search_index import SearchIndex
+        self.metadata_store = MetadataStore()
+        self.search_index = SearchIndex()
+        # Searchable straight away from the last run's catalogue, until the
+        # jukebox loads the current one
+        self.scheduler.call_later( 0, self.search_index.load_from_store, self.metadata_store )
+    
+    def start_api( self ):
+        from spotify_API import SpotifyAPIManager
+        self.api_manager = SpotifyAPIManager( metadata_store=self.metadata_store, clock=self.clock )
+        self.metadata_store.add_change_listener( self.api_manager.invalidate_playlists_list )
+        self.api_manager.refresh_playlists_list()
+    
+    def start_playback( self ):
+        """Playback manager of the default zone, which logs in to Spotify for
+        every zone; or with isolate_playback, the playback process, which
+        runs every zone's."""
+        #
+        # Credentials 
+        spotify_username = "xyz"
+    	spotify_password = "123"
+        spotify_api_key = "sdsad323wd"
         
-        def motion_stopped_cb():
-            print "Motion stopped"
-            self.playback_manager.pause_playback()
+        if self.isolate_playback:
+            from playback_process import PlaybackHost
+            config = { 'zones': self.zone_names, 'username': spotify_username, 'password': spotify_password,
+                       'api_key': spotify_api_key }
+            if self.audio_cache is not None:
+                config['audio_cache'] = ( self.audio_cache.directory, self.audio_cache.max_bytes )
+            if self.audio_processor is not None:
+                config['processor'] = self.audio_processor.options
+            self.playback_host = PlaybackHost( config, catalogues=( self.metadata_store, self.search_index ) )
+            self.playback_host.add_track_change_listener( 
+                lambda name: self.state_changed( 'track', { 'name': name } ) )
+            self.playback_host.start()
+            self.playback_manager = self.playback_host.manager( self.zone_names[0] )
+            self.register_gauges()
+            return
         
-        self.motion_manager = MotionManager( motion_started_cb, motion_stopped_cb )
-                
-        #
-        # General set up 
+        from playback import PlaybackManager
+        self.playback_manager = PlaybackManager( spotify_username, spotify_password, spotify_api_key,
+                                                 catalogues=( self.metadata_store, self.search_index ),
+                                                 zone=self.zone_names[0], clock=self.clock,
+                                                 audio_cache=self.audio_cache,
+                                                 processor=self.audio_processor )
+        self.playback_manager.jukebox.add_track_change_listener( 
+            lambda track: self.state_changed( 'track', { 'name': track.name() } ) )
+        self.register_gauges()
+    
+    def start_zones( self ):
+        """Zones, each with its own motion manager."""
+        self.add_zone( self.zone_names[0], self.playback_manager )
+        for name in self.zone_names[1:]:
+            self.add_zone( name )
+        # Carry on from before the last restart; the API serves the restored
+        # state while the session logs in
+        self.restore_state()
         
         #
         # Manager set up
-        #~self.motion_manager.enable_motion_monitor()
-        
-        #
-        # HTTP server that represents the central controller API
-        httpd = ThreadedHTTPServer( ('',8000), ThreadedHTTPServer.HTTPRequestHandler, self )
-        
+        #~self.zones.default().motion_manager.enable_motion_monitor()
+    
+    def start_sync( self ):
+        """Playback in step with other controllers."""
+        from sync import SyncLeader, SyncFollower, DriftCorrector
+        audio = self.audio_output()
+        if self.sync_followers:
+            self.sync_leader = SyncLeader( self.sync_followers, secret=self.sync_secret )
+            self.sync_leader.start( audio.position_at )
+        else:
+            self.sync_follower = SyncFollower( self.play_uri_at, DriftCorrector( audio ).position,
+                                               self.sync_leader_host, port=self.sync_port, secret=self.sync_secret )
+            self.sync_follower.start()
+    
+    def audio_output( self ):
+        """The BufferedAudioOutput, or with the playback process, its
+        RemoteAudioOutput."""
+        if self.playback_host is not None:
+            return self.playback_host.output
+        return self.playback_manager.jukebox.audio
+    
+    def play_uri_at( self, uri, when ):
+        """Play a track so that it is first heard at `when`; see
+        SpotifyJukebox.play_uri_at."""
+        if self.playback_host is not None:
+            return self.playback_host.play_uri_at( uri, when )
+        jukebox = self.playback_manager.jukebox
+        return self.playback_manager.actor.submit( jukebox.play_uri_at, uri, when )
+    
+    def register_api_functions( self, httpd ):
+        """Add the controller's API functions to the HTTP server."""
         httpd.register_api_function( 'get_current_playlist', 
                                      self.do_get_current_playlist,
-                                     'GET' )
+                                     'GET', inline=True,
+                                     cache_version=lambda: self.state_version )
+
+        httpd.register_api_function( 'get_playback_state', 
+                                     self.do_get_playback_state,
+                                     'GET', inline=True, priority='control' )
+
+        httpd.register_api_function( 'get_playlists', 
+                                     self.do_get_playlists,
+                                     'GET', priority='bulk',
+                                     cache_version=self.playlists_list_version )
+
+        httpd.register_api_function( 'search', 
+                                     self.do_search,
+                                     'GET', inline=True )
+
+        httpd.register_api_function( 'events', 
+                                     self.do_get_events,
+                                     'GET', inline=True )
 
         httpd.register_api_function( 'set_playback_enabled', 
                                      self.do_set_playback_enabled,
-                                     'PUT' )
+                                     'PUT', priority='control' )
                                   
         httpd.register_api_function( 'set_motion_control_enabled', 
                                      self.do_set_motion_control_enabled,
-                                     'PUT' )
+                                     'PUT', priority='control' )
                                   
         httpd.register_api_function( 'next_track', 
                                      self.do_next_track,
-                                     'PUT' )
+                                     'PUT', priority='control' )
                                   
         httpd.register_api_function( 'set_current_playlist', 
                                      self.do_set_current_playlist,
-                                     'PUT' )
+                                     'PUT', priority='bulk' )
         
-        # unconditional execution: httpd.serve_forever()
-
-        global SIGTERM_SENT
-        while not SIGTERM_SENT:
-            httpd.handle_request()
+        httpd.register_api_function( 'metrics', 
+                                     self.do_get_metrics,
+                                     'GET', inline=True, priority='bulk' )
         
-        #
-        # Finish up
-        print "Safely stopping"
-        self.stop()
+        httpd.register_api_function( 'set_volume', 
+                                     self.do_set_volume,
+                                     'PUT', priority='control' )
+        
+        httpd.register_api_function( 'sync_start', 
+                                     self.do_sync_start,
+                                     'PUT', priority='control' )
+        
+        httpd.register_api_function( 'zones', 
+                                     self.do_get_zones,
+                                     'GET', inline=True )
+        for name in self.ZONE_FUNCTIONS:
+            httpd.register_alias( 'zones/{zone}/' + name, name )
+        
+        # Several of the above in one request, e.g. for a scene change
+        httpd.register_batch_function( 'batch' )
+        
+        httpd.register_api_function( 'health', 
+                                     self.do_get_health,
+                                     'GET', inline=True )
+        
+        httpd.register_api_function( 'health/{manager}', 
+                                     self.do_get_manager_health,
+                                     'GET', inline=True )
+        
+        httpd.register_api_function( 'audio_cache', 
+                                     self.do_get_audio_cache,
+                                     'GET', inline=True )
+    
+    def request_stop( self ):
+        """Ask the API server to stop serving, so that `start()` goes on to
+        stop the managers. Safe to call from a signal handler."""
+        if isinstance( self.httpd, EventLoopHTTPServer ):
+            self.httpd.shutdown()
     
     def stop( self ):
-        print "Sending STOP instruction to managers"
-        self.playback_manager.finish()
-        self.api_manager.finish()
-        self.motion_manager.finish()
+        log.info( "Sending STOP instruction to managers" )
+        # Let the manager being built finish, and build no more
+        self.__stop_requested = True
+        if self.__startup is not None:
+            self.__startup.join()
+        self.scheduler.stop()
+        for sync in ( self.sync_leader, self.sync_follower ):
+            if sync is not None:
+                sync.stop()
+        if self.readiness.is_ready( 'zones' ):
+            self.save_state( wait=True )
+        self.zones.finish()
+        if self.api_manager is not None:
+            self.api_manager.finish()
+        if self.metadata_store is not None:
+            self.metadata_store.close()
         
         
 if __name__ == '__main__':
 
+    #
+    # Logging: --log-level=LEVEL for every subsystem, or
+    # --log-level=SUBSYSTEM:LEVEL (repeatable) for one, e.g. playback:DEBUG
+    log_level = 'INFO'
+    log_levels = {}
+    for arg in sys.argv[1:]:
+        if arg.startswith( '--log-level=' ):
+            value = arg.split( '=', 1 )[1].upper()
+            if ':' in value:
+                subsystem, subsystem_level = value.split( ':', 1 )
+                log_levels[subsystem.lower()] = subsystem_level
+            else:
+                log_level = value
+    log_listener = setup_logging( log_level, log_levels )
 
-    cc_daemon = CentralController()
+    server_mode = 'threaded' if '--threaded' in sys.argv[1:] else 'eventloop'
+    # --zones=NAME,NAME,... for a controller serving several rooms
+    zone_names = ( 'default', )
+    for arg in sys.argv[1:]:
+        if arg.startswith( '--zones=' ):
+            zone_names = tuple( name for name in arg.split( '=', 1 )[1].split( ',' ) if name )
+    # --sync-leader=HOST[:PORT],... to lead other controllers' playback, or
+    # --sync-follower[=PORT] with --sync-from=HOST to follow the leader on
+    # HOST; --sync-secret-file=PATH signs their messages with the key in
+    # PATH, which both sides need
+    sync_followers = None
+    sync_port = None
+    sync_leader = None
+    sync_secret = None
+    for arg in sys.argv[1:]:
+        if arg.startswith( '--sync-leader=' ):
+            sync_followers = []
+            for follower in arg.split( '=', 1 )[1].split( ',' ):
+                host, _, port = follower.partition( ':' )
+                sync_followers.append( ( host, int( port ) if port else DEFAULT_SYNC_PORT ) )
+        elif arg == '--sync-follower':
+            sync_port = DEFAULT_SYNC_PORT
+        elif arg.startswith( '--sync-follower=' ):
+            sync_port = int( arg.split( '=', 1 )[1] )
+        elif arg.startswith( '--sync-from=' ):
+            sync_leader = arg.split( '=', 1 )[1]
+        elif arg.startswith( '--sync-secret-file=' ):
+            with open( arg.split( '=', 1 )[1] ) as f:
+                sync_secret = f.read().strip()
+    # --audio-cache=DIR[:MB] to keep played tracks on local disk, up to MB
+    # megabytes of them, and play them from there again
+    audio_cache = None
+    for arg in sys.argv[1:]:
+        if arg.startswith( '--audio-cache=' ):
+            from audio_cache import AudioCache
+            directory, _, size_mb = arg.split( '=', 1 )[1].rpartition( ':' )
+            if not directory or not size_mb.isdigit():
+                directory, size_mb = arg.split( '=', 1 )[1], None
+            audio_cache = AudioCache( directory, int( size_mb ) << 20 ) if size_mb else AudioCache( directory )
+    # --normalise and --crossfade=SECS process the audio, with NumPy
+    audio_processor = None
+    normalise = '--normalise' in sys.argv[1:]
+    crossfade_secs = 0.0
+    for arg in sys.argv[1:]:
+        if arg.startswith( '--crossfade=' ):
+            crossfade_secs = float( arg.split( '=', 1 )[1] )
+    if normalise or crossfade_secs:
+        from audio_dsp import AudioProcessor
+        try:
+            audio_processor = AudioProcessor( normalise=normalise, crossfade_secs=crossfade_secs )
+        except RuntimeError as ex:
+            log.warning( "Audio processing disabled: %s", ex )
+    # --isolate-playback runs the Spotify session and audio output in a
+    # child process
+    cc_daemon = CentralController( server_mode=server_mode,
+                                   metrics_enabled='--no-metrics' not in sys.argv[1:],
+                                   zone_names=zone_names,
+                                   sync_followers=sync_followers, sync_port=sync_port,
+                                   sync_leader=sync_leader, sync_secret=sync_secret,
+                                   audio_cache=audio_cache, audio_processor=audio_processor,
+                                   isolate_playback='--isolate-playback' in sys.argv[1:] )
     
     #
     # Rewire the signal handler
@@ -320,12 +987,15 @@ if __name__ == '__main__':
         """
         global SIGTERM_SENT
         SIGTERM_SENT = True
-        #~ need to get working
+        cc_daemon.request_stop()
     signal.signal( signal.SIGTERM, signal_handler_exit )
     
     #
     # Go go go
-    cc_daemon.start()
+    try:
+        cc_daemon.start()
+    finally:
+        log_listener.stop()
 
 
 
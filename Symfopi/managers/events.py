@@ -0,0 +1,108 @@
+import collections
+import time
+import logging
+import threading
+
+from workers import Future
+
+
+class EventBroker( object ):
+    """Fans out state-change events (playback paused/resumed, track changed,
+    playlist changed, motion control enabled...) to any number of
+    subscribers, such as long-polling HTTP clients.
+
+    Every event has a kind, a sequence number and a JSON-able data dict.
+    Subscribers keep their own position in the sequence and ask for the
+    events after it. Recent events are kept in a bounded log, which acts as
+    every subscriber's buffer; a subscriber that has fallen further behind
+    than the log reaches, or that has more than `max_batch` events waiting,
+    is sent only the latest event of each kind instead. Since each event
+    describes the new state of something, that is all a slow subscriber needs
+    to catch up.
+    """
+
+    def __init__( self, scheduler, log_size=256, max_batch=32 ):
+        """
+        scheduler:
+            a Scheduler, used to time out subscribers waiting for events
+        """
+        self.__scheduler = scheduler
+        self.__log = collections.deque( maxlen=log_size )
+        self.__latest = {}    # kind -> latest event of that kind
+        self.__seq = 0
+        self.__waiters = []
+        self.__lock = threading.Lock()
+        self.max_batch = max_batch
+
+    def publish( self, kind, data=None ):
+        """Record an event and pass it to any waiting subscribers."""
+        with self.__lock:
+            self.__seq += 1
+            event = { 'seq': self.__seq, 'kind': kind, 'time': time.time(), 'data': data or {} }
+            self.__log.append( event )
+            self.__latest[kind] = event
+
+            waiters, self.__waiters = self.__waiters, []
+            replies = [ ( fut, timer, self.__events_since( since ) )
+                        for since, fut, timer in waiters ]
+
+        for fut, timer, reply in replies:
+            self.__scheduler.cancel( timer )
+            fut.set_result( reply )
+
+    def events_since( self, since=None ):
+        """Return the events after sequence number `since` as a dict:
+
+            { 'seq': <sequence number to ask from next time>,
+              'events': [ event, ... ],
+              'coalesced': <True if only the latest of each kind is given> }
+
+        With `since` None, the latest event of each kind is given, as a
+        snapshot of the current state.
+        """
+        with self.__lock:
+            return self.__events_since( since )
+
+    def wait_for_events( self, since=None, timeout=30.0 ):
+        """As `events_since`, but if there are no events after `since` yet,
+        waits up to `timeout` seconds for one.
+
+        Returns a Future of the dict, which is completed on the publishing
+        thread (or the scheduler's, on time-out). No thread waits meanwhile.
+        """
+        fut = Future()
+        with self.__lock:
+            reply = self.__events_since( since )
+            if not reply['events'] and timeout > 0:
+                waiter = [ reply['seq'], fut, None ]
+                waiter[2] = self.__scheduler.call_later( timeout, self.__time_out, waiter )
+                self.__waiters.append( waiter )
+                return fut
+        fut.set_result( reply )
+        return fut
+
+    def __time_out( self, waiter ):
+        with self.__lock:
+            try:
+                self.__waiters.remove( waiter )
+            except ValueError:
+                return  # already given events
+            reply = { 'seq': self.__seq, 'events': [], 'coalesced': False }
+        waiter[1].set_result( reply )
+
+    def __events_since( self, since ):
+        if since is None or since < 0:
+            return self.__coalesced( 0 )
+        if since >= self.__seq:
+            return { 'seq': self.__seq, 'events': [], 'coalesced': False }
+
+        missed = self.__seq - since
+        if missed > len( self.__log ) or missed > self.max_batch:
+            return self.__coalesced( since )
+        events = list( self.__log )[-missed:]
+        return { 'seq': self.__seq, 'events': events, 'coalesced': False }
+
+    def __coalesced( self, since ):
+        events = sorted( ( e for e in self.__latest.itervalues() if e['seq'] > since ),
+                         key=lambda e: e['seq'] )
+        return { 'seq': self.__seq, 'events': events, 'coalesced': True }
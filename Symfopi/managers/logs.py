@@ -0,0 +1,192 @@
+import json
+import logging
+import Queue
+import sys
+import threading
+import time
+
+# Every subsystem logs under this logger, e.g. 'symfopi.playback'
+ROOT_LOGGER = 'symfopi'
+
+# Subsystem -> (records, per seconds) allowed through before the rest of
+# a burst is dropped
+DEFAULT_RATE_LIMITS = { 'playlists': ( 10, 10.0 ) }
+
+# Nothing is output until setup_logging() is called
+logging.getLogger( ROOT_LOGGER ).addHandler( logging.NullHandler() )
+
+
+def get_logger( subsystem ):
+    """Return the logger for a subsystem, such as 'playback' or 'api'."""
+    return logging.getLogger( ROOT_LOGGER + '.' + subsystem )
+
+
+def fields( **kwargs ):
+    """Structured fields for a log call, appended to the message as
+    key=value pairs: `log.info( "Loading track", extra=fields( track=name ) )`."""
+    return { 'fields': kwargs }
+
+
+def _format_field( value ):
+    if isinstance( value, basestring ):
+        if not value or any( c in value for c in ' "=\t\n' ):
+            return json.dumps( value )
+        return value.encode( 'utf-8' ) if isinstance( value, unicode ) else value
+    return str( value )
+
+
+class StructuredFormatter( logging.Formatter ):
+    """Formats a record as one line:
+    `<time> <level> <logger> <message> key=value ...`."""
+
+    def format( self, record ):
+        line = '%s %-7s %s %s' % ( self.formatTime( record ), record.levelname, record.name, record.getMessage() )
+        record_fields = getattr( record, 'fields', None )
+        if record_fields:
+            line += ' ' + ' '.join( '%s=%s' % ( key, _format_field( value ) )
+                                    for key, value in sorted( record_fields.items() ) )
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException( record.exc_info )
+        if record.exc_text:
+            line += '\n' + record.exc_text
+        return line
+
+
+class RateLimitFilter( logging.Filter ):
+    """Lets through at most `records` records per `per` seconds for each
+    message (by its format string, not its arguments), so a burst of
+    callbacks cannot flood the log. The next record let through after some
+    were dropped carries a `suppressed` field with their number."""
+
+    def __init__( self, records, per ):
+        logging.Filter.__init__( self )
+        self.rate = float( records ) / per
+        self.burst = float( records )
+        self.__lock = threading.Lock()
+        self.__buckets = {}      # (logger name, msg) -> [tokens, last time, suppressed]
+
+    def filter( self, record ):
+        key = ( record.name, record.msg )
+        now = time.time()
+        with self.__lock:
+            bucket = self.__buckets.get( key )
+            if bucket is None:
+                bucket = self.__buckets[key] = [ self.burst, now, 0 ]
+            bucket[0] = min( self.burst, bucket[0] + ( now - bucket[1] ) * self.rate )
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1.0
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record_fields = dict( getattr( record, 'fields', None ) or {} )
+            record_fields['suppressed'] = suppressed
+            record.fields = record_fields
+        return True
+
+
+class QueueHandler( logging.Handler ):
+    """Hands records to a QueueListener's thread instead of writing them.
+
+    The message is formatted on the calling thread, so the record holds no
+    references to the caller's objects, but nothing blocks: if the queue is
+    full the record is dropped and counted.
+    """
+
+    def __init__( self, queue ):
+        logging.Handler.__init__( self )
+        self.queue = queue
+        self.dropped = 0
+
+    def emit( self, record ):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException( record.exc_info )
+                record.exc_info = None
+            self.queue.put_nowait( record )
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError( record )
+
+
+class QueueListener( object ):
+    """A thread that takes records from a queue and writes them to
+    `handlers`, so that the threads logging never wait on I/O."""
+
+    _STOP = object()
+
+    def __init__( self, queue, handlers, queue_handler=None ):
+        self.queue = queue
+        self.handlers = handlers
+        self.__queue_handler = queue_handler
+        self.__dropped_reported = 0
+        self.__thread = threading.Thread( target=self.__run, name='logging' )
+        self.__thread.setDaemon( True )
+
+    def start( self ):
+        self.__thread.start()
+
+    def stop( self ):
+        """Write the records already queued, then stop the thread."""
+        self.queue.put( self._STOP )
+        self.__thread.join()
+        for handler in self.handlers:
+            handler.flush()
+
+    def __handle( self, record ):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle( record )
+
+    def __report_dropped( self ):
+        dropped = self.__queue_handler.dropped if self.__queue_handler is not None else 0
+        if dropped != self.__dropped_reported:
+            record = logging.LogRecord( ROOT_LOGGER + '.logging', logging.WARNING, __file__, 0,
+                                        "Log queue full; records dropped", None, None )
+            record.fields = { 'dropped': dropped - self.__dropped_reported }
+            self.__dropped_reported = dropped
+            self.__handle( record )
+
+    def __run( self ):
+        while True:
+            record = self.queue.get()
+            if record is self._STOP:
+                self.__report_dropped()
+                return
+            self.__report_dropped()
+            self.__handle( record )
+
+
+def setup_logging( level='INFO', levels=None, stream=None, rate_limits=DEFAULT_RATE_LIMITS, queue_size=10000 ):
+    """Send the subsystems' logging through a queue to a background thread
+    writing structured lines to `stream` (stderr by default). Returns the
+    QueueListener; call its `stop()` at exit to write what is queued.
+
+    level:
+        level for every subsystem
+    levels:
+        dict of subsystem -> level, overriding `level`
+    rate_limits:
+        dict of subsystem -> (records, per seconds), see RateLimitFilter
+    """
+    root = logging.getLogger( ROOT_LOGGER )
+    root.setLevel( level )
+    root.propagate = False
+    for subsystem, subsystem_level in ( levels or {} ).items():
+        get_logger( subsystem ).setLevel( subsystem_level )
+    for subsystem, ( records, per ) in rate_limits.items():
+        get_logger( subsystem ).addFilter( RateLimitFilter( records, per ) )
+
+    output = logging.StreamHandler( stream or sys.stderr )
+    output.setFormatter( StructuredFormatter() )
+    queue = Queue.Queue( queue_size )
+    queue_handler = QueueHandler( queue )
+    root.addHandler( queue_handler )
+
+    listener = QueueListener( queue, [ output ], queue_handler )
+    listener.start()
+    return listener
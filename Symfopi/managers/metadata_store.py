@@ -0,0 +1,314 @@
+import collections
+import json
+import os
+import time
+import logging
+import threading
+import Queue
+import sqlite3
+
+from logs import get_logger
+
+log = get_logger( 'catalogue' )
+
+DEFAULT_DB_PATH = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'web', 'symfopi.db' )
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS playlists (
+    uri         TEXT PRIMARY KEY,
+    position    INTEGER NOT NULL,
+    name        TEXT,
+    num_tracks  INTEGER,
+    updated     REAL
+);
+CREATE INDEX IF NOT EXISTS playlists_by_position ON playlists (position);
+CREATE INDEX IF NOT EXISTS playlists_by_name ON playlists (name);
+
+CREATE TABLE IF NOT EXISTS tracks (
+    playlist_uri  TEXT NOT NULL,
+    position      INTEGER NOT NULL,
+    uri           TEXT,
+    name          TEXT,
+    artist        TEXT,
+    album         TEXT,
+    duration_ms   INTEGER,
+    PRIMARY KEY (playlist_uri, position)
+);
+CREATE INDEX IF NOT EXISTS tracks_by_name ON tracks (name);
+CREATE INDEX IF NOT EXISTS tracks_by_uri ON tracks (uri);
+
+CREATE TABLE IF NOT EXISTS playback_state (
+    zone     TEXT PRIMARY KEY,
+    state    TEXT NOT NULL,
+    updated  REAL
+);
+"""
+
+
+class MetadataStore( object ):
+    """Playlist and track metadata kept in the SQLite database, so that the
+    catalogue can be listed at start-up without waiting for the Spotify
+    login and container to load.
+
+    The jukebox's container and playlist callbacks feed the store with plain
+    tuples (see the `*_info` helpers in playback.py):
+
+        playlist: (uri, name)
+        track:    (uri, name, artist, album, duration_ms)
+
+    Writes are queued and applied by a single writer thread, so callbacks
+    never wait on disk. Reads use a connection per thread. Change listeners
+    are called on the writer thread after each write to the catalogue is
+    committed.
+
+    The store also keeps a snapshot of each zone's playback state, so that
+    it can be resumed after a restart.
+    """
+
+    def __init__( self, db_path=DEFAULT_DB_PATH ):
+        self.db_path = db_path
+        self.__local = threading.local()
+        self.__writes = Queue.Queue()
+        self.change_listeners = ()
+        self.__state_lock = threading.Lock()
+        self.__pending_states = {}     # zone -> playback state not yet written
+
+        conn = self.__connect()
+        conn.executescript( SCHEMA )
+        conn.commit()
+
+        self.__writer = threading.Thread( target=self.__write_loop, name='metadata-writer' )
+        self.__writer.setDaemon( True )
+        self.__writer.start()
+
+    def __connect( self ):
+        conn = sqlite3.connect( self.db_path, timeout=30 )
+        try:
+            # Readers do not block the writer, and vice versa
+            conn.execute( "PRAGMA journal_mode=WAL" )
+        except sqlite3.DatabaseError:
+            pass
+        conn.execute( "PRAGMA synchronous=NORMAL" )
+        return conn
+
+    def __reader( self ):
+        conn = getattr( self.__local, 'conn', None )
+        if conn is None:
+            conn = self.__local.conn = self.__connect()
+        return conn
+
+    def add_change_listener( self, func ):
+        """Call `func()` after each change to the stored catalogue."""
+        self.change_listeners = self.change_listeners + (func,)
+
+    #
+    #
+    # Writes
+    #
+    def __write_loop( self ):
+        conn = self.__connect()
+        while True:
+            op = self.__writes.get()
+            if op is None:
+                conn.close()
+                return
+            func, args, done, notify = op
+            if func is not None:
+                # This is the only writer; whatever goes wrong, it carries
+                # on with the next write
+                try:
+                    with conn:
+                        func( conn, *args )
+                except Exception:
+                    log.exception( "Metadata store write failed" )
+                else:
+                    if notify:
+                        for listener in self.change_listeners:
+                            try:
+                                listener()
+                            except Exception:
+                                log.exception( "Metadata store change listener failed" )
+            if done is not None:
+                done.set()
+
+    def __queue( self, func, *args ):
+        self.__writes.put( (func, args, None, True) )
+
+    def flush( self, timeout=None ):
+        """Wait until every write queued so far has been applied."""
+        done = threading.Event()
+        self.__writes.put( (None, (), done, False) )
+        done.wait( timeout )
+
+    def close( self ):
+        self.__writes.put( None )
+        self.__writer.join()
+
+    def sync_container( self, playlists ):
+        """Replace the list of playlists.
+
+        playlists:
+            list of ((uri, name), tracks) in container order; `tracks` is a
+            list of track tuples, or None if not known (the stored tracks of
+            the playlist are then kept)
+        """
+        self.__queue( self.__sync_container, playlists )
+
+    def playlist_added( self, position, playlist, tracks=None ):
+        self.__queue( self.__playlist_added, position, playlist, tracks )
+
+    def playlist_removed( self, position ):
+        self.__queue( self.__playlist_removed, position )
+
+    def playlist_moved( self, old_position, new_position ):
+        self.__queue( self.__playlist_moved, old_position, new_position )
+
+    def playlist_renamed( self, uri, name ):
+        self.__queue( self.__playlist_renamed, uri, name )
+
+    def sync_tracks( self, playlist_uri, tracks ):
+        """Replace the tracks of a playlist."""
+        self.__queue( self.__sync_tracks, playlist_uri, tracks )
+
+    def tracks_added( self, playlist_uri, position, tracks ):
+        self.__queue( self.__tracks_added, playlist_uri, position, tracks )
+
+    def save_playback_state( self, zone, state ):
+        """Snapshot a zone's playback state, a JSON-able dict. A snapshot
+        still waiting to be written is replaced rather than written too, so
+        however often the state changes, each zone has at most one write
+        queued."""
+        with self.__state_lock:
+            queued = zone in self.__pending_states
+            self.__pending_states[zone] = state
+        if not queued:
+            self.__writes.put( (self.__write_playback_state, (zone,), None, False) )
+
+    def __write_playback_state( self, conn, zone ):
+        with self.__state_lock:
+            state = self.__pending_states.pop( zone )
+        conn.execute( "INSERT OR REPLACE INTO playback_state (zone, state, updated) VALUES (?, ?, ?)",
+                      (zone, json.dumps( state ), time.time()) )
+
+    @staticmethod
+    def __sync_container( conn, playlists ):
+        now = time.time()
+        keep = set()
+        for position, ( (uri, name), tracks ) in enumerate( playlists ):
+            keep.add( uri )
+            conn.execute( "INSERT OR IGNORE INTO playlists (uri, position) VALUES (?, ?)", (uri, position) )
+            conn.execute( "UPDATE playlists SET position = ?, name = ?, updated = ? WHERE uri = ?",
+                          (position, name, now, uri) )
+            if tracks is not None:
+                MetadataStore.__sync_tracks( conn, uri, tracks )
+        for (uri,) in conn.execute( "SELECT uri FROM playlists" ).fetchall():
+            if uri not in keep:
+                conn.execute( "DELETE FROM playlists WHERE uri = ?", (uri,) )
+                conn.execute( "DELETE FROM tracks WHERE playlist_uri = ?", (uri,) )
+
+    @staticmethod
+    def __playlist_added( conn, position, playlist, tracks ):
+        uri, name = playlist
+        conn.execute( "UPDATE playlists SET position = position + 1 WHERE position >= ?", (position,) )
+        conn.execute( "INSERT OR REPLACE INTO playlists (uri, position, name, num_tracks, updated) "
+                      "VALUES (?, ?, ?, NULL, ?)", (uri, position, name, time.time()) )
+        if tracks is not None:
+            MetadataStore.__sync_tracks( conn, uri, tracks )
+
+    @staticmethod
+    def __playlist_removed( conn, position ):
+        row = conn.execute( "SELECT uri FROM playlists WHERE position = ?", (position,) ).fetchone()
+        if row is not None:
+            conn.execute( "DELETE FROM playlists WHERE uri = ?", row )
+            conn.execute( "DELETE FROM tracks WHERE playlist_uri = ?", row )
+        conn.execute( "UPDATE playlists SET position = position - 1 WHERE position > ?", (position,) )
+
+    @staticmethod
+    def __playlist_moved( conn, old_position, new_position ):
+        row = conn.execute( "SELECT uri FROM playlists WHERE position = ?", (old_position,) ).fetchone()
+        if row is None:
+            return
+        # libspotify gives the new position as an index into the list before
+        # the move, as for list insertion
+        if new_position > old_position:
+            new_position -= 1
+            conn.execute( "UPDATE playlists SET position = position - 1 "
+                          "WHERE position > ? AND position <= ?", (old_position, new_position) )
+        else:
+            conn.execute( "UPDATE playlists SET position = position + 1 "
+                          "WHERE position >= ? AND position < ?", (new_position, old_position) )
+        conn.execute( "UPDATE playlists SET position = ? WHERE uri = ?", (new_position, row[0]) )
+
+    @staticmethod
+    def __playlist_renamed( conn, uri, name ):
+        conn.execute( "UPDATE playlists SET name = ?, updated = ? WHERE uri = ?", (name, time.time(), uri) )
+
+    @staticmethod
+    def __sync_tracks( conn, playlist_uri, tracks ):
+        conn.execute( "DELETE FROM tracks WHERE playlist_uri = ?", (playlist_uri,) )
+        conn.executemany( "INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          ( (playlist_uri, i) + tuple( t ) for i, t in enumerate( tracks ) ) )
+        conn.execute( "UPDATE playlists SET num_tracks = ?, updated = ? WHERE uri = ?",
+                      (len( tracks ), time.time(), playlist_uri) )
+
+    @staticmethod
+    def __tracks_added( conn, playlist_uri, position, tracks ):
+        # Shift the later tracks out of the way, highest first, so that the
+        # primary key never clashes
+        later = conn.execute( "SELECT position FROM tracks WHERE playlist_uri = ? AND position >= ? "
+                              "ORDER BY position DESC", (playlist_uri, position) ).fetchall()
+        conn.executemany( "UPDATE tracks SET position = position + ? WHERE playlist_uri = ? AND position = ?",
+                          ( (len( tracks ), playlist_uri, p) for (p,) in later ) )
+        conn.executemany( "INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          ( (playlist_uri, position + i) + tuple( t ) for i, t in enumerate( tracks ) ) )
+        conn.execute( "UPDATE playlists SET num_tracks = "
+                      "(SELECT COUNT(*) FROM tracks WHERE playlist_uri = ?), updated = ? WHERE uri = ?",
+                      (playlist_uri, time.time(), playlist_uri) )
+
+    #
+    #
+    # Reads
+    #
+    def playlists( self ):
+        """Return [(position, name, uri, num_tracks)], in container order."""
+        return self.__reader().execute(
+            "SELECT position, name, uri, num_tracks FROM playlists ORDER BY position" ).fetchall()
+
+    def playlist_names( self ):
+        return [ row[1] for row in self.playlists() ]
+
+    def playlist_at( self, position ):
+        """Return (position, name, uri, num_tracks) of a playlist, or None."""
+        return self.__reader().execute(
+            "SELECT position, name, uri, num_tracks FROM playlists WHERE position = ?",
+            (position,) ).fetchone()
+
+    def find_playlists( self, name ):
+        """Return [(position, name, uri, num_tracks)] of playlists called `name`."""
+        return self.__reader().execute(
+            "SELECT position, name, uri, num_tracks FROM playlists WHERE name = ? ORDER BY position",
+            (name,) ).fetchall()
+
+    def tracks( self, playlist_position ):
+        """Return [(position, uri, name, artist, album, duration_ms)] of a
+        playlist's tracks, in order."""
+        return self.__reader().execute(
+            "SELECT t.position, t.uri, t.name, t.artist, t.album, t.duration_ms "
+            "FROM tracks t JOIN playlists p ON t.playlist_uri = p.uri "
+            "WHERE p.position = ? ORDER BY t.position", (playlist_position,) ).fetchall()
+
+    def playback_state( self, zone ):
+        """Return the last playback state saved for a zone, or None."""
+        with self.__state_lock:
+            if zone in self.__pending_states:
+                return self.__pending_states[zone]
+        row = self.__reader().execute( "SELECT state FROM playback_state WHERE zone = ?", (zone,) ).fetchone()
+        return json.loads( row[0] ) if row is not None else None
+
+    def find_tracks( self, name ):
+        """Return [(playlist_position, position, uri, name, artist, album,
+        duration_ms)] of tracks called `name`."""
+        return self.__reader().execute(
+            "SELECT p.position, t.position, t.uri, t.name, t.artist, t.album, t.duration_ms "
+            "FROM tracks t JOIN playlists p ON t.playlist_uri = p.uri "
+            "WHERE t.name = ? ORDER BY p.position, t.position", (name,) ).fetchall()
@@ -0,0 +1,220 @@
+import bisect
+import math
+import threading
+import time
+
+# Latency buckets in seconds, from 0.5 ms to 10 s
+DEFAULT_BUCKETS = ( 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0 )
+
+
+def _format_value( value ):
+    if value == float( 'inf' ):
+        return '+Inf'
+    if isinstance( value, float ) and value.is_integer() and abs( value ) < 1e15:
+        return str( int( value ) )
+    return repr( value )
+
+
+def _format_labels( pairs ):
+    if not pairs:
+        return ''
+    return '{' + ','.join( '%s="%s"' % ( name, str( value ).replace( '\\', r'\\' ).replace( '"', r'\"' ) )
+                           for name, value in pairs ) + '}'
+
+
+class _Metric( object ):
+    """A single time series, or one child of a labelled family."""
+
+    def __init__( self, registry ):
+        self._registry = registry
+        self._lock = threading.Lock()
+
+
+class Counter( _Metric ):
+    """A count that only goes up; either counted here, or read from a
+    function (such as an existing counter attribute) when the metrics are
+    collected."""
+
+    def __init__( self, registry, func=None ):
+        _Metric.__init__( self, registry )
+        self.value = 0
+        self.func = func
+
+    def inc( self, amount=1 ):
+        if self._registry.enabled:
+            with self._lock:
+                self.value += amount
+
+    def samples( self, name, labels ):
+        value = self.value
+        if self.func is not None:
+            try:
+                value = self.func()
+            except Exception:
+                value = float( 'nan' )
+        yield name, labels, value
+
+
+class Gauge( _Metric ):
+    """A value that goes up and down; either set directly, or read from a
+    function when the metrics are collected."""
+
+    def __init__( self, registry, func=None ):
+        _Metric.__init__( self, registry )
+        self.value = 0
+        self.func = func
+
+    def set( self, value ):
+        if self._registry.enabled:
+            self.value = value
+
+    def inc( self, amount=1 ):
+        if self._registry.enabled:
+            with self._lock:
+                self.value += amount
+
+    def dec( self, amount=1 ):
+        self.inc( -amount )
+
+    def samples( self, name, labels ):
+        value = self.value
+        if self.func is not None:
+            try:
+                value = self.func()
+            except Exception:
+                value = float( 'nan' )
+        yield name, labels, value
+
+
+class Histogram( _Metric ):
+    """Counts of observations (such as latencies, in seconds) falling in
+    fixed buckets, plus their count and sum."""
+
+    def __init__( self, registry, buckets=DEFAULT_BUCKETS ):
+        _Metric.__init__( self, registry )
+        self.buckets = tuple( sorted( buckets ) )
+        self.counts = [ 0 ] * ( len( self.buckets ) + 1 )   # the last is +Inf
+        self.sum = 0.0
+
+    def observe( self, value ):
+        if self._registry.enabled:
+            i = bisect.bisect_left( self.buckets, value )
+            with self._lock:
+                self.counts[i] += 1
+                self.sum += value
+
+    def observe_since( self, started ):
+        """Observe the seconds since `started`, a time.time() value."""
+        if self._registry.enabled:
+            self.observe( time.time() - started )
+
+    def samples( self, name, labels ):
+        with self._lock:
+            counts = list( self.counts )
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip( self.buckets + ( float( 'inf' ), ), counts ):
+            cumulative += count
+            yield name + '_bucket', labels + ( ( 'le', _format_value( float( bound ) ) ), ), cumulative
+        yield name + '_count', labels, cumulative
+        yield name + '_sum', labels, total
+
+
+class _Family( object ):
+    """A metric with labels: one child metric per combination of label
+    values, created on first use."""
+
+    def __init__( self, name, kind, help, label_names, make_child ):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.label_names = label_names
+        self.__make_child = make_child
+        self.__children = {}
+        self.__lock = threading.Lock()
+
+    def labels( self, *values ):
+        child = self.__children.get( values )
+        if child is None:
+            with self.__lock:
+                child = self.__children.get( values )
+                if child is None:
+                    child = self.__children[values] = self.__make_child()
+        return child
+
+    def samples( self ):
+        for values, child in sorted( self.__children.items() ):
+            labels = tuple( zip( self.label_names, values ) )
+            for sample in child.samples( self.name, labels ):
+                yield sample
+
+
+class MetricsRegistry( object ):
+    """Counters, gauges and histograms, exposed in the Prometheus text format.
+
+    Metrics are created once, up front, and updated on the hot paths, where
+    an update is a flag test plus, when enabled, a short locked update of a
+    number; nothing is allocated or formatted until `render()` is called.
+    With `enabled` false, updates do nothing but the flag test.
+
+    Registering a name again returns the metric already registered, so
+    that several controllers in one process can share the registry; a
+    `func` given again replaces the one the metric was read from. A name
+    registered again as a different kind of metric, or with different
+    labels, raises ValueError.
+    """
+
+    def __init__( self, enabled=True ):
+        self.enabled = enabled
+        self.__families = []
+        self.__by_name = {}
+        self.__lock = threading.Lock()
+
+    def __add( self, name, kind, help, labels, make_child, func=None ):
+        with self.__lock:
+            family = self.__by_name.get( name )
+            if family is None:
+                family = self.__by_name[name] = _Family( name, kind, help, tuple( labels ), make_child )
+                self.__families.append( family )
+            elif family.kind != kind or family.label_names != tuple( labels ):
+                raise ValueError( "Metric '%s' is already registered, as a %s labelled by %r" % (
+                    name, family.kind, family.label_names ) )
+        if labels:
+            return family
+        metric = family.labels()
+        if func is not None:
+            metric.func = func
+        return metric
+
+    def counter( self, name, help, labels=(), func=None ):
+        """Return a Counter, or a family of them to call `labels()` on.
+        `func`, for an unlabelled counter, is called for the value whenever
+        the metrics are rendered."""
+        return self.__add( name, 'counter', help, labels, lambda: Counter( self ), func )
+
+    def gauge( self, name, help, labels=(), func=None ):
+        """Return a Gauge, or a family of them. `func`, for an unlabelled
+        gauge, is called for the value whenever the metrics are rendered."""
+        return self.__add( name, 'gauge', help, labels, lambda: Gauge( self ), func )
+
+    def histogram( self, name, help, labels=(), buckets=DEFAULT_BUCKETS ):
+        """Return a Histogram, or a family of them."""
+        return self.__add( name, 'histogram', help, labels, lambda: Histogram( self, buckets ) )
+
+    def render( self ):
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        for family in self.__families:
+            lines.append( '# HELP %s %s' % ( family.name, family.help ) )
+            lines.append( '# TYPE %s %s' % ( family.name, family.kind ) )
+            for name, labels, value in family.samples():
+                if isinstance( value, float ) and math.isnan( value ):
+                    value_str = 'NaN'
+                else:
+                    value_str = _format_value( value )
+                lines.append( '%s%s %s' % ( name, _format_labels( labels ), value_str ) )
+        return '\n'.join( lines ) + '\n'
+
+
+# The registry the managers record to
+REGISTRY = MetricsRegistry()
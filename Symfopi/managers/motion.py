@@ -4,102 +4,219 @@ import signal
 from datetime import datetime as dt
 import logging
 import threading
-import random 
+import random
 
+from scheduler import Scheduler
+from metrics import REGISTRY
+from logs import get_logger
 
-class MotionMonitorMocker( threading.Thread ):
+log = get_logger( 'motion' )
+
+MOTION_READINGS = REGISTRY.counter( 'symfopi_motion_readings_total', 'Raw readings reported by the motion sensor.' )
+MOTION_TRANSITIONS = REGISTRY.counter( 'symfopi_motion_transitions_total',
+                                       'Debounced changes between motion and stillness.', labels=('state',) )
+
+
+class MotionSensor( object ):
+    """Interface for a source of raw motion readings, such as a PIR sensor.
+
+    Once started, a sensor calls `report_motion( detected )` whenever its
+    reading changes (or simply whenever it has a reading; repeats are
+    harmless). It may do so from any thread. The MotionMonitor takes care of
+    debouncing the readings.
+    """
+
+    def start( self, report_motion ):
+        raise NotImplementedError()
+
+    def stop( self ):
+        raise NotImplementedError()
+
+
+class MotionMonitorMocker( MotionSensor ):
     """A mocker object for testing a motion monitor in the app.
-    
-    Also serves to demonstrate how the real motion monitor should act. 
+
+    Also serves to demonstrate how the real motion sensor should act: reports
+    motion 5 seconds after starting, reports that it has stopped 10 seconds
+    after that, and repeats. Uses the scheduler's thread rather than any of
+    its own.
     """
-    
-    def __init__( self, motion_started_callback, motion_stopped_callback ):
-        threading.Thread.__init__( self )
-        
-        self.__motion_stopped_cb = motion_stopped_callback
+
+    def __init__( self, scheduler, motion_after=5.0, still_after=10.0 ):
+        self.__scheduler = scheduler
+        self.__motion_after = motion_after
+        self.__still_after = still_after
+        self.__report_motion = None
+        self.__next_call = None
+        self.__stop_requested = False
+
+    def start( self, report_motion ):
+        self.__report_motion = report_motion
+        self.__stop_requested = False
+        self.__next_call = self.__scheduler.call_later( self.__motion_after, self.__motion )
+
+    def stop( self ):
+        self.__stop_requested = True
+        if self.__next_call is not None:
+            self.__scheduler.cancel( self.__next_call )
+            self.__next_call = None
+
+    def __motion( self ):
+        if self.__stop_requested:
+            return
+        self.__report_motion( True )
+        self.__next_call = self.__scheduler.call_later( self.__still_after, self.__still )
+
+    def __still( self ):
+        if self.__stop_requested:
+            return
+        self.__report_motion( False )
+        self.__next_call = self.__scheduler.call_later( self.__motion_after, self.__motion )
+
+
+class MotionMonitor( object ):
+    """Turns raw readings from a MotionSensor into "motion started" and
+    "motion stopped" callbacks, with debounce and hysteresis:
+
+    * motion has to be reported continuously for `start_debounce` seconds
+      before the started callback fires, so a single spurious reading does
+      not start playback;
+    * once started, there has to be no motion for `stop_hold` seconds before
+      the stopped callback fires, so that short gaps in motion do not
+      toggle playback.
+
+    Both delays are timers on a shared Scheduler, so a monitor uses no thread
+    of its own, and the callbacks run on the scheduler's thread.
+    """
+
+    def __init__( self, sensor, scheduler, motion_started_callback, motion_stopped_callback,
+                  start_debounce=0.5, stop_hold=5.0 ):
+        self.__sensor = sensor
+        self.__scheduler = scheduler
         self.__motion_started_cb = motion_started_callback
-        
-        self.__stop_requested = False 
-    
+        self.__motion_stopped_cb = motion_stopped_callback
+        self.start_debounce = start_debounce
+        self.stop_hold = stop_hold
+
+        self.__lock = threading.Lock()
+        self.__active = False    # whether the started callback was the last one
+        self.__pending = None    # ScheduledCall that will change __active
+        self.__running = False
+
+        self.events_seen = 0     # raw readings reported
+        self.transitions = 0     # callbacks fired
+
+    def start( self ):
+        self.__running = True
+        self.__sensor.start( self.report_motion )
+
     def stop( self ):
-        self.__stop_requested = True 
-    
-    def run( self ):
-        children = []
-        while not self.__stop_requested:
-            if not children or all( map( lambda x: not x.is_alive(), children ) ):
-                # all the timers have stopped, so start some new ones
-                
-                tmr = threading.Timer( 5, self.__motion_started_cb )  # in x secs abolsute time
-                children.append( tmr )
-                tmr.start()
-
-                tmr = threading.Timer( 15, self.__motion_stopped_cb )  # in x secs abolsute time
-                children.append( tmr )
-                tmr.start()
-            
-            time.sleep( 0.1 )
-        
-        # Main loop finished, so tidy up
-        for c in children:
-            c.cancel()
-            
+        """Stop the sensor and cancel any pending transition. Does not fire
+        the stopped callback."""
+        self.__running = False
+        self.__sensor.stop()
+        with self.__lock:
+            self.__cancel_pending()
+
+    def is_motion_active( self ):
+        return self.__active
+
+    def report_motion( self, detected ):
+        """Called by the sensor with each raw reading."""
+        with self.__lock:
+            self.events_seen += 1
+            MOTION_READINGS.inc()
+            if not self.__running:
+                return
+
+            if detected == self.__active:
+                # Back to the reported state before the debounce/hold ran out
+                self.__cancel_pending()
+            elif self.__pending is None:
+                delay = self.start_debounce if detected else self.stop_hold
+                self.__pending = self.__scheduler.call_later( delay, self.__transition, detected )
+
+    def __cancel_pending( self ):
+        if self.__pending is not None:
+            self.__scheduler.cancel( self.__pending )
+            self.__pending = None
+
+    def __transition( self, detected ):
+        with self.__lock:
+            if not self.__running or self.__active == detected:
+                return
+            self.__active = detected
+            self.__pending = None
+            self.transitions += 1
+        MOTION_TRANSITIONS.labels( 'motion' if detected else 'still' ).inc()
+
+        if detected:
+            self.__motion_started_cb()
+        else:
+            self.__motion_stopped_cb()
+
+
 class MotionManager( object ):
-    
-    def __init__( self, motion_started_callback, motion_stopped_callback ):
+
+    def __init__( self, motion_started_callback, motion_stopped_callback, scheduler=None,
+                  sensor_factory=None, start_debounce=0.5, stop_hold=5.0 ):
         """
-        Directly pauses or resume playback. 
-        [Temporary design. A mocking object. Future: two callbacks given
-        to the motion monitor thread. One call back for doing something
-        when motion is sensed and another for when motion stops.]
+        Calls `motion_started_callback` and `motion_stopped_callback` as
+        motion starts and stops, while motion monitoring is enabled.
+
+        scheduler:
+            Scheduler for the motion monitor's timers; one is created if not
+            given
+        sensor_factory:
+            called with the scheduler to make the MotionSensor when
+            monitoring is enabled; defaults to the MotionMonitorMocker
+        start_debounce, stop_hold:
+            see MotionMonitor
         """
         super(MotionManager,self).__init__()
-        self.__motion_monitor_thread = None
+        self.__motion_monitor = None
         self.__motion_started_cb = motion_started_callback
         self.__motion_stopped_cb = motion_stopped_callback
+        self.__owns_scheduler = scheduler is None
+        self.__scheduler = scheduler if scheduler is not None else Scheduler( name='motion' )
+        self.__sensor_factory = sensor_factory if sensor_factory is not None else MotionMonitorMocker
+        self.start_debounce = start_debounce
+        self.stop_hold = stop_hold
 
     def enable_motion_monitor( self ):
         """
         Enable motion monitoring.
-        
+
         If monitoring is already enabled, it will be restarted.
         """
         # Disable if already running
-        if self.__motion_monitor_thread is not None:
+        if self.__motion_monitor is not None:
             self.disable_motion_monitor()
-        
+
         # Enable
-        assert self.__motion_monitor_thread is None
-        self.__motion_monitor_thread = MotionMonitorMocker( self.__motion_started_cb, self.__motion_stopped_cb )
-        self.__motion_monitor_thread.setDaemon( True )
-        self.__motion_monitor_thread.start()
-    
+        assert self.__motion_monitor is None
+        self.__motion_monitor = MotionMonitor( self.__sensor_factory( self.__scheduler ),
+                                               self.__scheduler,
+                                               self.__motion_started_cb, self.__motion_stopped_cb,
+                                               self.start_debounce, self.stop_hold )
+        self.__motion_monitor.start()
+
     def is_enabled( self ):
         """ """
-        if self.__motion_monitor_thread is None:
-            return False 
-        else:
-            if self.__motion_monitor_thread.isAlive():
-                return True
-            else:
-                return False 
-    
+        return self.__motion_monitor is not None
+
     def disable_motion_monitor( self ):
         """Disable motion monitoring.
-        
-        If monitoring is already disabled, no effect. Blocks until the motion
-        monitor thread succesfully stops.
-        """
-        if self.__motion_monitor_thread is not None:
-            self.__motion_monitor_thread.stop()
-            self.__motion_monitor_thread.join()
-            self.__motion_monitor_thread = None 
-            print "Motion thread stop successful"
-        
-    def finish():
-        """Finish and tidy up the manager."""
-        self.disable_motion_manager()
-
-
 
+        If monitoring is already disabled, no effect.
+        """
+        if self.__motion_monitor is not None:
+            self.__motion_monitor.stop()
+            self.__motion_monitor = None
+            log.info( "Motion monitor stopped" )
 
+    def finish( self ):
+        """Finish and tidy up the manager."""
+        self.disable_motion_monitor()
+        if self.__owns_scheduler:
+            self.__scheduler.stop()
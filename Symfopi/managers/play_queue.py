@@ -0,0 +1,212 @@
+import bisect
+import collections
+import random
+import logging
+
+
+class _RangeSource( object ):
+    """Consecutive tracks of one playlist."""
+
+    __slots__ = ( 'playlist', 'first_track' )
+
+    def __init__( self, playlist, first_track ):
+        self.playlist = playlist
+        self.first_track = first_track
+
+    def entry( self, i ):
+        return ( self.playlist, self.first_track + i )
+
+    def describe( self ):
+        return [ 'range', self.playlist, self.first_track ]
+
+
+class _ShuffledSource( object ):
+    """The entries of a list of slices, in a random order.
+
+    The order is a keyed pseudo-random permutation of the entry indices,
+    computed per entry when asked for, so shuffling does not build a list of
+    the entries. The permutation is a small Feistel network over the
+    smallest power-of-four range that holds every index, with cycle-walking
+    to stay within the number of entries.
+    """
+
+    ROUNDS = 4
+
+    def __init__( self, slices, seed=None ):
+        if seed is None:
+            # Chosen here rather than left to Random(), so that the order
+            # can be rebuilt from a snapshot
+            seed = random.getrandbits( 64 )
+        self.seed = seed
+        self.__slices = [ _Slice( s.source, s.lo, s.hi ) for s in slices ]
+        self.__starts = []
+        n = 0
+        for s in self.__slices:
+            self.__starts.append( n )
+            n += len( s )
+        self.size = n
+
+        bits = 2
+        while ( 1 << bits ) < n:
+            bits += 2
+        self.__half_bits = bits // 2
+        self.__half_mask = ( 1 << self.__half_bits ) - 1
+        rnd = random.Random( seed )
+        self.__keys = [ rnd.getrandbits( 32 ) for i in xrange( self.ROUNDS ) ]
+
+    def __permute( self, i ):
+        half_bits, mask = self.__half_bits, self.__half_mask
+        while True:
+            left, right = i >> half_bits, i & mask
+            for key in self.__keys:
+                f = ( ( right * 0x9E3779B1 ) ^ key ) & 0xFFFFFFFF
+                f = ( f ^ ( f >> 15 ) ) & mask
+                left, right = right, left ^ f
+            i = ( left << half_bits ) | right
+            if i < self.size:
+                return int( i )
+
+    def entry( self, i ):
+        j = self.__permute( i )
+        k = bisect.bisect_right( self.__starts, j ) - 1
+        s = self.__slices[k]
+        return s.source.entry( s.lo + j - self.__starts[k] )
+
+    def describe( self ):
+        return [ 'shuffle', self.seed, [ s.describe() for s in self.__slices ] ]
+
+
+class _Slice( object ):
+    """Entries `lo` up to (not including) `hi` of a source."""
+
+    __slots__ = ( 'source', 'lo', 'hi' )
+
+    def __init__( self, source, lo, hi ):
+        self.source = source
+        self.lo = lo
+        self.hi = hi
+
+    def __len__( self ):
+        return self.hi - self.lo
+
+    def describe( self ):
+        return [ self.source.describe(), self.lo, self.hi ]
+
+    @staticmethod
+    def from_description( desc ):
+        ( kind, arg, more ), lo, hi = desc
+        if kind == 'range':
+            source = _RangeSource( arg, more )
+        elif kind == 'shuffle':
+            source = _ShuffledSource( [ _Slice.from_description( d ) for d in more ], arg )
+        else:
+            raise ValueError( "Unknown queue source '%s'" % kind )
+        return _Slice( source, lo, hi )
+
+
+class PlayQueue( object ):
+    """The queue of tracks to play, as `(playlist, track)` index pairs.
+
+    Stored as a deque of slices of ranges ("playlist P, tracks i to j")
+    rather than one tuple per track, so queueing a whole playlist costs the
+    same however long it is. Taking the next entry, peeking at it and
+    inserting an entry to play next are O(1). Removing an entry from the
+    middle splits a slice, at a cost in the number of slices. Shuffling wraps
+    the remaining slices in a lazily computed permutation.
+    """
+
+    def __init__( self ):
+        self.__slices = collections.deque()
+        self.__len = 0
+        self.position = 0    # entries taken from the queue since it was last cleared
+
+    def __len__( self ):
+        return self.__len
+
+    def __iter__( self ):
+        for s in list( self.__slices ):
+            for i in xrange( s.lo, s.hi ):
+                yield s.source.entry( i )
+
+    def append_range( self, playlist, first_track, stop_track ):
+        """Queue tracks `first_track` up to (not including) `stop_track` of
+        a playlist."""
+        if stop_track > first_track:
+            self.__slices.append( _Slice( _RangeSource( playlist, first_track ), 0,
+                                          stop_track - first_track ) )
+            self.__len += stop_track - first_track
+
+    def append( self, playlist, track ):
+        self.append_range( playlist, track, track + 1 )
+
+    def insert_next( self, playlist, track ):
+        """Queue a track to be played before everything else queued."""
+        self.__slices.appendleft( _Slice( _RangeSource( playlist, track ), 0, 1 ) )
+        self.__len += 1
+
+    def peek( self ):
+        """Return the next entry without taking it, or None."""
+        if not self.__slices:
+            return None
+        s = self.__slices[0]
+        return s.source.entry( s.lo )
+
+    def popleft( self ):
+        """Take the next entry. Raises IndexError if the queue is empty."""
+        if not self.__slices:
+            raise IndexError( "pop from an empty PlayQueue" )
+        s = self.__slices[0]
+        entry = s.source.entry( s.lo )
+        s.lo += 1
+        if s.lo == s.hi:
+            self.__slices.popleft()
+        self.__len -= 1
+        self.position += 1
+        return entry
+
+    def remove( self, index ):
+        """Remove the entry `index` places from the front of the queue."""
+        if not 0 <= index < self.__len:
+            raise IndexError( "PlayQueue index out of range" )
+        for k, s in enumerate( self.__slices ):
+            if index < len( s ):
+                break
+            index -= len( s )
+
+        i = s.lo + index
+        if i == s.lo:
+            s.lo += 1
+        elif i == s.hi - 1:
+            s.hi -= 1
+        else:
+            self.__slices.rotate( -( k + 1 ) )
+            self.__slices.appendleft( _Slice( s.source, i + 1, s.hi ) )
+            self.__slices.rotate( k + 1 )
+            s.hi = i
+        if not len( s ):
+            del self.__slices[k]
+        self.__len -= 1
+
+    def shuffle( self, seed=None ):
+        """Put the remaining entries in a random order."""
+        if self.__len < 2:
+            return
+        source = _ShuffledSource( self.__slices, seed )
+        self.__slices = collections.deque( [ _Slice( source, 0, source.size ) ] )
+
+    def clear( self ):
+        self.__slices.clear()
+        self.__len = 0
+        self.position = 0
+
+    def snapshot( self ):
+        """Return the queue as JSON-able data for `restore()`; its size is in
+        the number of slices, not of entries."""
+        return { 'position': self.position, 'slices': [ s.describe() for s in self.__slices ] }
+
+    def restore( self, snapshot ):
+        """Replace the queue's contents with those of a `snapshot()`."""
+        slices = collections.deque( _Slice.from_description( d ) for d in snapshot['slices'] )
+        self.__slices = slices
+        self.__len = sum( len( s ) for s in slices )
+        self.position = snapshot['position']
@@ -1,4 +1,7 @@
 import collections
+import functools
+import math
+import os
 import time
 import signal
 from datetime import datetime as dt
@@ -8,70 +11,285 @@ import random
 
 from abstract_manager import AbstractManager
 
-from spotify import ArtistBrowser, Link, ToplistBrowser
+from spotify import Link
 from spotify.audiosink import import_audio_sink
 from spotify.manager import SpotifySessionManager, SpotifyPlaylistManager, \
     SpotifyContainerManager
+
+from audio_buffer import BufferedAudioOutput
+from audio_cache import CachedTrackPlayer
+from play_queue import PlayQueue
+from browse import BrowseLoader
+from workers import Future
+from session_actor import SessionActor
+from scheduler import SYSTEM_CLOCK
+from metrics import REGISTRY
+from logs import get_logger, fields
+
+AudioSink = import_audio_sink()
+
+LOGIN_SECONDS = REGISTRY.histogram('symfopi_spotify_login_seconds',
+                                   'Time from connecting to libspotify to the login completing.',
+                                   buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+TRACK_LOAD_SECONDS = REGISTRY.histogram('symfopi_spotify_track_load_seconds',
+                                        'Time taken by libspotify to load a track for playing.')
+INTER_TRACK_GAP_SECONDS = REGISTRY.histogram('symfopi_inter_track_gap_seconds',
+                                             'Silence heard between one track and the next.')
+
+log = get_logger('playback')
+# Playlist and container callbacks, which come in bursts
+playlist_log = get_logger('playlists')
+
+# Set once the user's playlist container has loaded
+container_loaded = threading.Event()
+
+
+def on_actor(method):
+    """Decorator for a libspotify callback: run it on the object's
+    SessionActor, if it has one, rather than on the thread that called."""
+    @functools.wraps(method)
+    def callback(self, *args):
+        actor = self.actor
+        if actor is not None and not actor.on_actor_thread():
+            actor.submit(method, self, *args)
+        else:
+            method(self, *args)
+    return callback
+
+
+def playlist_info(p):
+    """Return the (uri, name) of a playlist, for the metadata store."""
+    return (str(Link.from_playlist(p)), p.name())
+
+
+def track_info(t):
+    """Return the (uri, name, artist, album, duration_ms) of a track, for
+    the metadata store."""
+    artists = t.artists()
+    album = t.album()
+    return (str(Link.from_track(t, 0)), t.name(),
+            artists[0].name() if artists else None,
+            album.name() if album is not None else None,
+            t.duration())
     
 
 class PlaybackManager( object ):
     """A manager for audio playback. 
+    
+    Playback state and the Spotify session are only touched on the
+    manager's SessionActor thread: the public methods submit commands to it
+    and return Futures, which may be ignored.
+    
+    Each zone of a multi-room controller has its own manager, with its own
+    queue and playback state; they share the first zone's session, jukebox
+    and actor. libspotify plays one track at a time per session, so the
+    zone that last resumed or skipped has the player, playing from its
+    queue, and the others keep theirs until they take it back.
     """
-    def __init__( self, username, password, api_key ):
+    def __init__( self, username, password, api_key, catalogues=(), zone='default', shared=None,
+                  clock=SYSTEM_CLOCK, audio_cache=None, processor=None ):
+        """
+        catalogues:
+            objects to keep up to date with the user's playlists and their
+            tracks, such as a MetadataStore and a SearchIndex
+        zone:
+            name of the zone the manager plays for
+        shared:
+            PlaybackManager whose session, jukebox and actor to share rather
+            than logging in again; `catalogues` is then unused
+        clock:
+            SystemClock (or VirtualClock, in a simulation) that the
+            manager's waits are in
+        audio_cache:
+            AudioCache to play tracks from when it has them, and to record
+            streamed tracks into; unused with `shared`
+        processor:
+            AudioProcessor for volume, loudness normalisation and
+            crossfades; unused with `shared`
+        """
         self._is_playing = False 
         self.__curr_pl_indx = None 
+        self.zone = zone
+        self.clock = clock
+        # Track and position restored from a snapshot, until played
+        self.__resume_entry = None
+        self.__resume_position_ms = None
         
         self.sp_username = username
         self.sp_password = password
         self.sp_api_key = api_key 
         
-        self.jukebox = SpotifyJukebox( username=username, password=password, remember_me=True, application_key=api_key )
+        self.owns_session = shared is None
+        if shared is None:
+            self.actor = SessionActor()
+            self.jukebox = SpotifyJukebox( username=username, password=password, remember_me=True, application_key=api_key,
+                                          catalogues=catalogues, actor=self.actor, audio_cache=audio_cache,
+                                          processor=processor, clock=clock )
+            self.queue = self.jukebox.queue_for( self )
+        else:
+            self.actor = shared.actor
+            self.jukebox = shared.jukebox
+            self.queue = PlayQueue()
         
     def pause_playback( self ):
         """Pause music playback. No change if playback was already paused.
+        Supersedes a pause or resume that has not been carried out yet.
+        Returns a Future of whether playback was paused by it.
         """
-        print "pause playback called"
-        if not self._is_playing:
-            print " > Already paused; no need to do anything."
-        else:
-            print " > Pausing playback."
-            self._is_playing = False 
+        return self.actor.submit( self.__pause_playback, coalesce=( self.zone, 'playing' ) )
 
     def resume_playback( self ):
         """Initiate playback or resume playback from a paused state. 
         No change if playback is already occurring.
+        Supersedes a pause or resume that has not been carried out yet.
+        Returns a Future of whether playback was resumed by it.
         """
-        print "unpause playback called"
-        if self._is_playing:
-            print " > Playback already occurring. Do nothing."
-        else:
-            print " > Switching from paused to begin playback."
-            
-            pl_indx = self.__curr_pl_indx
-            
-            #~ play the playlist at pl_indx
-            
-            self._is_playing = True
+        return self.actor.submit( self.__resume_playback, coalesce=( self.zone, 'playing' ) )
 
     def set_current_playlist( self, playlist_index ):
         """Change the current playlist. If a song is currently being played,
         a song from the new playlist will be selected at random and played.
+        Supersedes a change of playlist that has not been carried out yet.
+        Returns a Future of whether the current playlist changed.
         """
-        print "set current playlist called"
-        print "[set pl] halting for 0.5 seconds"
-        time.sleep(0.5)
-        print "[set pl] done"
-        self.__curr_pl_indx = playlist_index 
-        
+        return self.actor.submit( self.__set_current_playlist, playlist_index, coalesce=( self.zone, 'playlist' ) )
+
+    def next_track( self ):
+        """Skip to the next queued track."""
+        return self.actor.submit( self.__next_track )
+
+    def is_playing( self ):
+        return self._is_playing
+
+    def state( self ):
+        """Return a JSON-able dict of the zone's playback state. Answered
+        from the manager's own fields, so it is available straight after a
+        restore, before the session has logged in."""
+        entry = self.__resume_entry
+        if self.jukebox.queue_owner is self and self.jukebox.current_entry is not None:
+            entry = self.jukebox.current_entry
+        return { 'zone': self.zone,
+                 'playing': self._is_playing,
+                 'playlist_index': self.__curr_pl_indx,
+                 'track': list( entry ) if entry is not None else None,
+                 'queue_length': len( self.queue ),
+                 'queue_position': self.queue.position,
+                 'logged_in': getattr( self.jukebox, 'session', None ) is not None }
+
+    def snapshot( self ):
+        """Return a Future of the playback state as JSON-able data for
+        `restore()`: queue, current playlist and track, position in the
+        track and whether playing."""
+        return self.actor.submit( self.__snapshot )
+
+    def restore( self, state ):
+        """Take up the state from a `snapshot()` taken before a restart. The
+        saved track goes back at the front of the queue, to carry on from
+        the saved position when it is played; playback resumes if it was
+        playing."""
+        return self.actor.submit( self.__restore, state )
+
+    #
+    # Commands; run on the actor thread
+    
+    def __pause_playback( self ):
+        log.debug( "Pause playback called" )
+        if not self._is_playing:
+            log.debug( "Already paused; nothing to do" )
+            return False
+        log.info( "Pausing playback", extra=fields( zone=self.zone ) )
+        self._is_playing = False 
+        return True
+
+    def __resume_playback( self ):
+        log.debug( "Resume playback called" )
         if self._is_playing:
-            # if the manager is playing, then we need to restart it with the
-            # new song
-            self.pause_playback()
-            self.resume_playback()
+            log.debug( "Already playing; nothing to do" )
+            return False
+        log.info( "Resuming playback", extra=fields( zone=self.zone ) )
+        self.__take_player()
+        
+        pl_indx = self.__curr_pl_indx
+        
+        #~ play the playlist at pl_indx
+        
+        self._is_playing = True
+        return True
+
+    def __set_current_playlist( self, playlist_index ):
+        log.debug( "Set current playlist called", extra=fields( playlist=playlist_index ) )
+        ctr = getattr( self.jukebox, 'ctr', None )
+        listed = ctr is not None and ctr.is_loaded()
+        if listed:
+            # Raises IndexError for a playlist the user does not have
+            self.jukebox.resolve_playlist( playlist_index )
+        changed = self.__curr_pl_indx != playlist_index
+        self.__curr_pl_indx = playlist_index 
+        if not self._is_playing:
+            return changed
+        if getattr( self.jukebox, 'loader', None ) is None or not listed:
+            self.__restart_playlist( playlist_index )
+            return changed
+        # Playing from the new playlist needs it loaded; the wait happens
+        # off the actor, so that other commands are not held up meanwhile
+        self.jukebox.playlist_loaded( playlist_index ).add_done_callback(
+            lambda f: self.actor.submit( self.__restart_playlist, playlist_index ) )
+        return changed
+    
+    def __restart_playlist( self, playlist_index ):
+        """Restart playback with the new playlist, once loaded, unless it
+        has been changed again or playback paused meanwhile."""
+        if self.__curr_pl_indx == playlist_index and self._is_playing:
+            self.__pause_playback()
+            self.__resume_playback()
+    
+    def __next_track( self ):
+        if getattr( self.jukebox, 'session', None ) is None:
+            log.warning( "Not logged in; cannot skip track" )
+            return
+        self.__take_player()
+        self.jukebox.next()
+
+    def __take_player( self ):
+        """Have the shared jukebox play from this zone's queue."""
+        if self.jukebox.queue_owner is not self:
+            self.jukebox.set_queue( self.queue, self )
+        if self.__resume_entry is not None:
+            self.jukebox.seek_on_next_load( self.__resume_position_ms )
+            self.__resume_entry = self.__resume_position_ms = None
+
+    def __snapshot( self ):
+        state = { 'playing': self._is_playing,
+                  'playlist_index': self.__curr_pl_indx,
+                  'queue': self.queue.snapshot() }
+        if self.__resume_entry is not None:
+            # Not played since the last restore; the entry is at the front
+            # of the queue already
+            state['position_ms'] = self.__resume_position_ms
+            state['queue']['resume_entry'] = list( self.__resume_entry )
+        elif self.jukebox.queue_owner is self and self.jukebox.current_entry is not None:
+            state['track'] = list( self.jukebox.current_entry )
+            state['position_ms'] = self.jukebox.track_position_ms()
+        return state
+
+    def __restore( self, state ):
+        self.__curr_pl_indx = state.get( 'playlist_index' )
+        self.queue.restore( state['queue'] )
+        entry = state['queue'].get( 'resume_entry' )
+        if state.get( 'track' ) is not None:
+            entry = tuple( state['track'] )
+            self.queue.insert_next( *entry )
+        if entry is not None:
+            self.__resume_entry = tuple( entry )
+            self.__resume_position_ms = state.get( 'position_ms' )
+        log.info( "Restored playback state", extra=fields( zone=self.zone, queued=len( self.queue ) ) )
+        if state.get( 'playing' ):
+            self.__resume_playback()
     
-    def finish():
+    def finish( self ):
         """Finish and tidy up the manager."""
-        pass 
+        if self.owns_session:
+            self.actor.stop()
         # TO DO: stop the PySpotify session?
             
 
@@ -93,6 +311,15 @@ class SpotifyJukebox(SpotifySessionManager):
         # Prevent the Spotify Session Manager from trying to read the appkey from file 
         self.appkey_file = None
         self.application_key = kw['application_key']
+        self.catalogues = tuple(kw.pop('catalogues', ()))
+        # SessionActor to run libspotify's callbacks on, if any
+        self.actor = kw.pop('actor', None)
+        # AudioCache of whole tracks to play without streaming, if any
+        self.audio_cache = kw.pop('audio_cache', None)
+        # AudioProcessor for the delivered frames, if any
+        processor = kw.pop('processor', None)
+        # SystemClock that login, load and inter-track gap times are taken in
+        self.clock = kw.pop('clock', SYSTEM_CLOCK)
         
         #
         # Parent constructor
@@ -100,47 +327,215 @@ class SpotifyJukebox(SpotifySessionManager):
         
         #
         # Standard set up
-        self.audio = AudioSink(backend=self)
+        # Frames from libspotify go through a ring buffer to the sink, so a
+        # slow sink cannot hold up the session thread. A crossfade overlaps
+        # the end of a track still buffered, so the buffer must hold it
+        seconds = 2
+        if processor is not None and processor.crossfade_secs:
+            seconds = max(seconds, int(math.ceil(processor.crossfade_secs)) + 1)
+        self.audio = BufferedAudioOutput(AudioSink(backend=self), capacity_frames=44100 * seconds,
+                                         processor=processor)
         # MJW self.ui = JukeboxUI(self)
         self.ctr = None
+        self.loader = None          # BrowseLoader, once logged in
         self.playing = False
-        self._queue = []
-        self.playlist_manager = JukeboxPlaylistManager()
-        self.container_manager = JukeboxContainerManager()
+        self._queue = PlayQueue()
+        self.queue_owner = None     # the zone's PlaybackManager that _queue belongs to
+        self.playlist_manager = self.JukeboxPlaylistManager()
+        self.container_manager = self.JukeboxContainerManager()
+        self.playlist_manager.catalogues = self.catalogues
+        self.container_manager.catalogues = self.catalogues
+        self.playlist_manager.actor = self.actor
+        self.container_manager.actor = self.actor
+        self.container_manager.playlist_manager = self.playlist_manager
+        # Playlist objects by container index; dropped when the container changes
+        self._playlists = {}
+        self.container_manager.add_change_listener(self._playlists.clear)
         self.track_playing = None
-        print "Logging in, please wait..."
-
-    def new_track_playing(self, track):
+        self.current_entry = None   # (playlist, track) playing, if it came from a playlist
+        # Frames are delivered on libspotify's thread, or a CachedTrackPlayer's,
+        # so the state they update is shared with the actor under this lock:
+        # _track_frames, _switched_at and _recorder
+        self._delivery_lock = threading.Lock()
+        self._track_frames = 0      # frames of the current track delivered
+        self._seek_ms = None        # position to start the next track loaded from
+        self._preloaded = None      # ((playlist, track), spotify track) of the next queue entry
+        self._switched_at = None    # (time, seconds of audio still buffered) at the last track switch
+        self._cached_player = None  # CachedTrackPlayer, while the current track plays from the cache
+        self._recorder = None       # CacheRecorder of the current track, while it streams
+        self.inter_track_gaps = collections.deque(maxlen=100)  # in ms, most recent last
+        self._connect_started = None
+        log.info("Logging in, please wait...")
+
+    track_change_listeners = ()
+
+    def add_track_change_listener(self, func):
+        """Call `func(track)` whenever a new track starts loading."""
+        self.track_change_listeners = self.track_change_listeners + (func,)
+
+    def new_track_playing(self, track, entry=None):
         self.track_playing = track
+        self.current_entry = entry
+        with self._delivery_lock:
+            self._track_frames = 0
+        for func in self.track_change_listeners:
+            func(track)
     
+    def connect(self):
+        """Overrides parent method, to time the login."""
+        self._connect_started = self.clock()
+        SpotifySessionManager.connect(self)
+
     #
-    # Overridden SpotifySessionManager callbacks.
+    # Overridden SpotifySessionManager callbacks, run on the actor.
     
+    @on_actor
     def logged_in(self, session, error):
         """Callback. Called when the login completes."""
+        if self._connect_started is not None:
+            LOGIN_SECONDS.observe(self.clock() - self._connect_started)
+            self._connect_started = None
         if error:
-            print error
+            log.error("Login failed: %s", error)
             return
         self.session = session
+        self.loader = BrowseLoader(session)
+        self.playlist_manager.add_state_listener(self.loader.playlist_state_changed)
         self.ctr = session.playlist_container()
         self.container_manager.watch(self.ctr)
         self.starred = session.starred()
+        self.playlist_manager.watch(self.starred)
         # MJW self.ui.start()
 
     def logged_out(self, session):
         """Callback. The user has or has been logged out from Spotify."""
         #MJW self.ui.cmdqueue.append("quit")
         
+    @on_actor
     def end_of_track(self, sess):
-        """Callback. Playback has reached the end of the current track."""
-        self.audio.end_of_track()
+        """Callback. Playback has reached the end of the current track.
+
+        If there is a next track it is started straight away, without
+        stopping the audio output, so it follows on from the frames of this
+        track that are still buffered."""
+        with self._delivery_lock:
+            recorder, self._recorder = self._recorder, None
+        if recorder is not None:
+            recorder.commit()
+        if self._queue:
+            self._switch_to_next(crossfade=True)
+        else:
+            self.playing = False
+            self.audio.end_of_track()
 
     #
     # Other SpotifySessionManager overrides.
 
     def music_delivery_safe(self, *args, **kwargs):
-        """Overrides parent method."""
-        return self.audio.music_delivery(*args, **kwargs)
+        """Overrides parent method. Returns the number of frames consumed;
+        libspotify delivers the rest again later."""
+        consumed = self.audio.music_delivery(*args, **kwargs)
+        if not consumed:
+            return 0
+        with self._delivery_lock:
+            self._track_frames += consumed
+            recorder = self._recorder
+            if recorder is not None:
+                session, frames, frame_size, num_frames, sample_type, sample_rate, channels = args
+                recorder.write(frames, frame_size, consumed, sample_type, sample_rate, channels)
+            if self._switched_at is not None:
+                self._record_gap()
+        return consumed
+
+    def _record_gap(self):
+        """Record the gap heard between the last track and the one whose
+        first frames have just arrived: the time they took to arrive, less
+        the audio of the last track that was still buffered to cover it.
+        Called holding _delivery_lock."""
+        switched_time, buffered_secs = self._switched_at
+        self._switched_at = None
+        gap_ms = max(0.0, self.clock() - switched_time - buffered_secs) * 1000
+        self.inter_track_gaps.append(gap_ms)
+        INTER_TRACK_GAP_SECONDS.observe(gap_ms / 1000)
+        log.debug("Inter-track gap", extra=fields(gap_ms=round(gap_ms, 1)))
+
+    def _session_load(self, track, crossfade=False):
+        """Load a track on the player, timing how long it takes: from the
+        audio cache if it has the track, otherwise on libspotify, recording
+        the track into the cache as it streams. With `crossfade`, the track
+        is mixed over the end of the last one."""
+        started = self.clock()
+        self._drop_cached_track()
+        self.audio.new_track(crossfade)
+        uri = str(Link.from_track(track, 0)) if self.audio_cache is not None else None
+        cached = self.audio_cache.open(uri) if uri is not None else None
+        if cached is not None:
+            self.session.unload()
+            player = CachedTrackPlayer(self.audio_cache, uri, cached, self.music_delivery_safe,
+                                       lambda: self._cached_track_ended(player),
+                                       lambda position_ms: self._cached_track_failed(player, position_ms))
+            self._cached_player = player
+        else:
+            self.session.load(track)
+        TRACK_LOAD_SECONDS.observe(self.clock() - started)
+        if self._seek_ms:
+            if cached is not None:
+                self._cached_player.seek(self._seek_ms)
+            else:
+                self.session.seek(self._seek_ms)
+            with self._delivery_lock:
+                self._track_frames = int(self._seek_ms * (self.audio.sample_rate or 44100) / 1000)
+        elif uri is not None and cached is None:
+            # Only tracks streamed from the start are recorded
+            recorder = self.audio_cache.recorder(uri, track.duration())
+            with self._delivery_lock:
+                self._recorder = recorder
+        self._seek_ms = None
+
+    def _drop_cached_track(self):
+        """Stop playing the current track from the cache, or recording it."""
+        if self._cached_player is not None:
+            self._cached_player.unload()
+            self._cached_player = None
+        with self._delivery_lock:
+            recorder, self._recorder = self._recorder, None
+        if recorder is not None:
+            recorder.abort()
+
+    def _player_play(self, play):
+        """Start or pause the current track, on libspotify or the cache."""
+        if self._cached_player is not None:
+            self._cached_player.play(play)
+        else:
+            self.session.play(1 if play else 0)  # pause playback if '0', otherwise play
+
+    @on_actor
+    def _cached_track_ended(self, player):
+        """Called by a CachedTrackPlayer after its last frame."""
+        if player is self._cached_player:
+            self._cached_player = None
+            self.end_of_track(self.session)
+
+    @on_actor
+    def _cached_track_failed(self, player, position_ms):
+        """Called by a CachedTrackPlayer that found its file damaged: the
+        rest of the track is streamed instead."""
+        if player is self._cached_player:
+            self._cached_player = None
+            self.session.load(self.track_playing)
+            self.session.seek(position_ms)
+            if self.playing:
+                self.session.play(1)
+
+    def seek_on_next_load(self, position_ms):
+        """Start the next track loaded `position_ms` into it, as when
+        resuming a restored track."""
+        self._seek_ms = position_ms
+
+    def track_position_ms(self):
+        """Return the position heard in the current track, in ms."""
+        frames = self._track_frames - len(self.audio.buffer)
+        return max(0, frames) * 1000 // (self.audio.sample_rate or 44100)
 
     #
     # Other jukebox methods.
@@ -149,100 +544,199 @@ class SpotifyJukebox(SpotifySessionManager):
         if self.playing:
             self.stop()
         self.new_track_playing(track)
-        self.session.load(track)  # loads the specified track on the player
-        print "Loading %s" % track.name()
+        self._session_load(track)  # loads the specified track on the player
+        log.info("Loading track", extra=fields(track=track.name()))
+
+    def resolve_playlist(self, playlist):
+        """Return the playlist object for a container index; one past the
+        last index is the starred list. Raises IndexError for any other."""
+        pl = self._playlists.get(playlist)
+        if pl is None:
+            if 0 <= playlist < len(self.ctr):
+                pl = self.ctr[playlist]
+            elif playlist == len(self.ctr):
+                pl = self.starred
+            else:
+                raise IndexError("Playlist index out of range: %d" % playlist)
+            self._playlists[playlist] = pl
+        return pl
+
+    def resolve(self, playlist, track):
+        """Return the (playlist, track) objects for a queue entry."""
+        pl = self.resolve_playlist(playlist)
+        return pl, pl[track]
 
     def load(self, playlist, track):
         if self.playing:
             self.stop()
-        if 0 <= playlist < len(self.ctr):
-            pl = self.ctr[playlist]
-        elif playlist == len(self.ctr):
-            pl = self.starred
-        spot_track = pl[track]
-        self.new_track_playing(spot_track)
-        self.session.load(spot_track)
-        print "Loading %s from %s" % (spot_track.name(), pl.name())
+        pl, spot_track = self.resolve(playlist, track)
+        self.new_track_playing(spot_track, (playlist, track))
+        self._session_load(spot_track)
+        log.info("Loading track", extra=fields(track=spot_track.name(), playlist=pl.name()))
 
     def load_playlist(self, playlist):
         if self.playing:
             self.stop()
-        if 0 <= playlist < len(self.ctr):
-            pl = self.ctr[playlist]
-        elif playlist == len(self.ctr):
-            pl = self.starred
-        print "Loading playlist %s" % pl.name()
+        pl = self.resolve_playlist(playlist)
+        log.info("Loading playlist", extra=fields(playlist=pl.name()))
         if len(pl):
-            print "Loading %s from %s" % (pl[0].name(), pl.name())
-            self.new_track_playing(pl[0])
-            self.session.load(pl[0])
-        for i, track in enumerate(pl):
-            if i == 0:
-                continue
-            self._queue.append((playlist, i))
+            log.info("Loading track", extra=fields(track=pl[0].name(), playlist=pl.name()))
+            self.new_track_playing(pl[0], (playlist, 0))
+            self._session_load(pl[0])
+        self._queue.append_range(playlist, 1, len(pl))
+
+    def play_uri_at(self, uri, when):
+        """Play a track so that it is first heard at `when` (time.time()),
+        in step with other players: libspotify starts delivering it now,
+        and the audio output holds the frames back until then."""
+        track = Link.from_string(uri).as_track()
+        self.load_track(track)
+        self.audio.start_at(when)
+        self.play()
 
     def queue(self, playlist, track):
         if self.playing:
-            self._queue.append((playlist, track))
+            self._queue.append(playlist, track)
         else:
-            print 'Loading %s', track.name()
             self.load(playlist, track)
             self.play()
 
     def play(self):
         self.audio.start()
-        self.session.play(1)  # pause playback if '0', otherwise play
-        print "Playing"
+        self._player_play(True)
+        log.info("Playing")
         self.playing = True
+        self.preload_next()
 
     def stop(self):
-        self.session.play(0)
-        print "Stopping"
+        self._player_play(False)
+        log.info("Stopping")
         self.playing = False
         self.audio.stop()
 
     def next(self):
-        self.stop()
         if self._queue:
-            t = self._queue.pop(0)
-            self.load(*t)
-            self.play()
+            # Skip: drop what is buffered of this track, but leave the audio
+            # device running
+            self.audio.flush()
+            if not self.playing:
+                self.audio.start()
+            self._switch_to_next()
         else:
             self.stop()
 
+    def preload_next(self):
+        """Resolve the next queue entry ahead of time, and ask libspotify to
+        start fetching it, so that switching to it is quick."""
+        entry = self._queue.peek()
+        if entry is None:
+            self._preloaded = None
+            return
+        if self._preloaded is not None and self._preloaded[0] == entry:
+            return
+        pl, spot_track = self.resolve(*entry)
+        self._preloaded = (entry, spot_track)
+        prefetch = getattr(self.session, 'prefetch', None)
+        if prefetch is not None:
+            prefetch(spot_track)
+
+    def _switch_to_next(self, crossfade=False):
+        """Start the next queued track without stopping the audio output,
+        crossfading into it if it follows on from the end of the last."""
+        entry = self._queue.popleft()
+        if self._preloaded is not None and self._preloaded[0] == entry:
+            spot_track = self._preloaded[1]
+        else:
+            pl, spot_track = self.resolve(*entry)
+        self._preloaded = None
+
+        buffered_secs = len(self.audio.buffer) / float(self.audio.sample_rate or 44100)
+        with self._delivery_lock:
+            self._switched_at = (self.clock(), buffered_secs)
+        self.new_track_playing(spot_track, entry)
+        self._session_load(spot_track, crossfade)
+        self._player_play(True)
+        self.playing = True
+        log.info("Playing track", extra=fields(track=spot_track.name()))
+        self.preload_next()
+
+    def shuffle_queue(self, seed=None):
+        """Put the queued tracks in a random order."""
+        self._queue.shuffle(seed)
+        if self.playing:
+            self.preload_next()
+
+    def queue_for(self, owner):
+        """Return the current queue, now belonging to `owner`."""
+        self.queue_owner = owner
+        return self._queue
+
+    def set_queue(self, queue, owner):
+        """Play from another zone's queue from the next track on."""
+        self._queue = queue
+        self._preloaded = None
+        self.queue_owner = owner
+        if self.playing:
+            self.preload_next()
+
+    def queue_status(self):
+        """Return (tracks played from the queue, tracks still queued)."""
+        return self._queue.position, len(self._queue)
+
     def search(self, *args, **kwargs):
         self.session.search(*args, **kwargs)  # returns a Results class
 
-    def browse(self, link, callback):
+    def search_tracks(self, query, limit=20):
+        """Search Spotify for tracks. Returns a Future of a list of track
+        tuples (see track_info), completed on the session thread."""
+        fut = Future()
+        if getattr(self, 'session', None) is None:
+            fut.set_result([])
+            return fut
+        def callback(results, userdata):
+            fut.set_result([track_info(t) for t in results.tracks()[:limit]])
+        self.session.search(query, callback, track_count=limit)
+        return fut
+
+    def browse(self, link, callback=None):
+        """Browse an album or artist. Returns a Future of the loaded browser,
+        completed on the session thread; `callback(browser)` is called then
+        too, if given."""
         if link.type() == link.LINK_ALBUM:
-            browser = self.session.browse_album(link.as_album(), callback)  # browse an album. Once metadata loaded, the callback is called
-            while not browser.is_loaded():
-                time.sleep(0.1)
-            for track in browser:
-                print track.name()
-        if link.type() == link.LINK_ARTIST:
-            browser = ArtistBrowser(link.as_artist())
-            while not browser.is_loaded():
-                time.sleep(0.1)
-            for album in browser:
-                print album.name()
+            fut = self.loader.album(link.as_album())
+        elif link.type() == link.LINK_ARTIST:
+            fut = self.loader.artist(link.as_artist())
+        else:
+            raise ValueError("Can only browse albums and artists")
+        if callback is not None:
+            fut.add_done_callback(lambda f: callback(f.result()))
+        return fut
+
+    def browse_many(self, links, max_in_flight=8):
+        """Browse many albums and artists, with at most `max_in_flight`
+        loading at once. Returns a Future of the list of browsers."""
+        def load(link):
+            if link.type() == link.LINK_ALBUM:
+                return self.loader.album(link.as_album())
+            return self.loader.artist(link.as_artist())
+        return self.loader.load_many(load, links, max_in_flight)
+
+    def playlist_loaded(self, playlist):
+        """Return a Future of the playlist object for a container index (see
+        resolve_playlist), completed once it has loaded."""
+        return self.loader.playlist(self.resolve_playlist(playlist))
 
     def watch(self, p, unwatch=False):
         if not unwatch:
-            print "Watching playlist: %s" % p.name()
+            playlist_log.debug("Watching playlist", extra=fields(playlist=p.name()))
             self.playlist_manager.watch(p)
         else:
-            print "Unatching playlist: %s" % p.name()
+            playlist_log.debug("Unwatching playlist", extra=fields(playlist=p.name()))
             self.playlist_manager.unwatch(p)
 
     def toplist(self, tl_type, tl_region):
-        print repr(tl_type)
-        print repr(tl_region)
-        def callback(tb, ud):
-            for i in xrange(len(tb)):
-                print '%3d: %s' % (i+1, tb[i].name())
-
-        tb = ToplistBrowser(tl_type, tl_region, callback)
+        """Returns a Future of the loaded ToplistBrowser."""
+        return self.loader.toplist(tl_type, tl_region)
 
     def shell(self):
         import code
@@ -250,30 +744,103 @@ class SpotifyJukebox(SpotifySessionManager):
         shell.interact()
     
 
-    ## playlist callbacks ##
+    ## playlist callbacks, run on the jukebox's actor ##
     class JukeboxPlaylistManager(SpotifyPlaylistManager):
+        catalogues = ()
+        state_listeners = ()
+        actor = None
+
+        def add_state_listener(self, func):
+            """Call `func(playlist)` whenever a watched playlist's state
+            changes, such as when it finishes loading."""
+            self.state_listeners = self.state_listeners + (func,)
+
+        def sync_tracks(self, p):
+            if self.catalogues and p.is_loaded():
+                uri, tracks = str(Link.from_playlist(p)), [track_info(t) for t in p]
+                for cat in self.catalogues:
+                    cat.sync_tracks(uri, tracks)
+
+        @on_actor
         def tracks_added(self, p, t, i, u):
-            print 'Tracks added to playlist %s' % p.name()
+            playlist_log.info('Tracks added to playlist', extra=fields(playlist=p.name(), count=len(t)))
+            if self.catalogues:
+                uri, tracks = str(Link.from_playlist(p)), [track_info(x) for x in t]
+                for cat in self.catalogues:
+                    cat.tracks_added(uri, i, tracks)
 
+        @on_actor
         def tracks_moved(self, p, t, i, u):
-            print 'Tracks moved in playlist %s' % p.name()
+            playlist_log.info('Tracks moved in playlist', extra=fields(playlist=p.name()))
+            self.sync_tracks(p)
 
+        @on_actor
         def tracks_removed(self, p, t, u):
-            print 'Tracks removed from playlist %s' % p.name()
+            playlist_log.info('Tracks removed from playlist', extra=fields(playlist=p.name()))
+            self.sync_tracks(p)
 
+        @on_actor
+        def playlist_renamed(self, p, u):
+            for cat in self.catalogues:
+                cat.playlist_renamed(*playlist_info(p))
 
-    ## container calllbacks ##
+        @on_actor
+        def playlist_state_changed(self, p, u):
+            # Fires when a playlist finishes loading, among other things
+            self.sync_tracks(p)
+            for func in self.state_listeners:
+                func(p)
+
+
+    ## container callbacks, run on the jukebox's actor ##
     class JukeboxContainerManager(SpotifyContainerManager):
+        change_listeners = ()
+        catalogues = ()
+        playlist_manager = None
+        actor = None
+
+        def add_change_listener(self, func):
+            """Call `func()` whenever a playlist is added, moved or removed."""
+            self.change_listeners = self.change_listeners + (func,)
+
+        def notify_changed(self):
+            for func in self.change_listeners:
+                func()
+
+        @on_actor
         def container_loaded(self, c, u):
+            if self.catalogues:
+                # Tracks of playlists that have not loaded yet follow from
+                # the playlist manager's callbacks
+                playlists = [(playlist_info(p), [track_info(t) for t in p] if p.is_loaded() else None)
+                             for p in c]
+                for cat in self.catalogues:
+                    cat.sync_container(playlists)
+            for p in c:
+                self.playlist_manager.watch(p)
             container_loaded.set()
 
+        @on_actor
         def playlist_added(self, c, p, i, u):
-            print 'Container: playlist "%s" added.' % p.name()
+            playlist_log.info('Playlist added', extra=fields(playlist=p.name()))
+            for cat in self.catalogues:
+                cat.playlist_added(i, playlist_info(p))
+            self.playlist_manager.watch(p)
+            self.notify_changed()
 
+        @on_actor
         def playlist_moved(self, c, p, oi, ni, u):
-            print 'Container: playlist "%s" moved.' % p.name()
+            playlist_log.info('Playlist moved', extra=fields(playlist=p.name()))
+            for cat in self.catalogues:
+                cat.playlist_moved(oi, ni)
+            self.notify_changed()
 
+        @on_actor
         def playlist_removed(self, c, p, i, u):
-            print 'Container: playlist "%s" removed.' % p.name()
+            playlist_log.info('Playlist removed', extra=fields(playlist=p.name()))
+            for cat in self.catalogues:
+                cat.playlist_removed(i)
+            self.playlist_manager.unwatch(p)
+            self.notify_changed()
 
 
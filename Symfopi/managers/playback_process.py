@@ -0,0 +1,626 @@
+import collections
+import itertools
+import logging
+import marshal
+import mmap
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from workers import Future
+from logs import get_logger, setup_logging, fields, ROOT_LOGGER
+
+log = get_logger( 'playback_process' )
+
+# Each message on the pipe: its length, then a marshalled tuple
+FRAME = struct.Struct( '<I' )
+
+# Calls the controller may make of a zone's manager in the playback process
+ZONE_METHODS = ( 'pause_playback', 'resume_playback', 'set_current_playlist', 'next_track', 'snapshot', 'restore' )
+
+# Calls on the session and audio output, shared by every zone
+SESSION_METHODS = ( 'search_tracks', 'play_uri_at', 'correct_drift', 'set_volume', 'audio_cache_stats' )
+
+# Catalogue updates the jukebox makes, passed on to the controller's
+# MetadataStore and SearchIndex
+CATALOGUE_METHODS = ( 'sync_container', 'sync_tracks', 'tracks_added', 'playlist_renamed', 'playlist_added',
+                      'playlist_moved', 'playlist_removed' )
+
+
+class Channel( object ):
+    """One end of the pipe between the controller and the playback process:
+    length-prefixed marshalled tuples over a socket. Any thread may send;
+    one thread receives."""
+
+    def __init__( self, sock ):
+        self.sock = sock
+        self.__lock = threading.Lock()
+
+    def send( self, *message ):
+        data = marshal.dumps( message, 2 )
+        with self.__lock:
+            self.sock.sendall( FRAME.pack( len( data ) ) + data )
+
+    def recv( self ):
+        """Return the next message, or None once the other end has closed."""
+        header = self.__read( FRAME.size )
+        if header is None:
+            return None
+        data = self.__read( FRAME.unpack( header )[0] )
+        return marshal.loads( data ) if data is not None else None
+
+    def __read( self, size ):
+        chunks = []
+        while size:
+            try:
+                chunk = self.sock.recv( min( size, 1 << 16 ) )
+            except socket.error:
+                return None
+            if not chunk:
+                return None
+            chunks.append( chunk )
+            size -= len( chunk )
+        return ''.join( chunks )
+
+    def close( self ):
+        try:
+            self.sock.shutdown( socket.SHUT_RDWR )
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class StatusBlock( object ):
+    """Figures the playback process publishes for the controller to read
+    without asking: a small file mapped into the memory of both. There is
+    one writer; it bumps a sequence number before and after each update,
+    and readers retry until they see it even and unchanged, so they never
+    take a half-written update. A writer killed mid-update leaves the
+    sequence odd, so a reader gives up after READ_TRIES and answers with the
+    last update it did read; its 'updated' time shows how stale it is."""
+
+    FIELDS = ( 'fill_level', 'overruns', 'underruns', 'queue_length', 'commands_pending',
+               'position_time', 'position_frames', 'sample_rate', 'updated' )
+    SEQUENCE = struct.Struct( '<Q' )
+    VALUES = struct.Struct( '<%dd' % len( FIELDS ) )
+    READ_TRIES = 100
+
+    def __init__( self, path, create=False ):
+        self.path = path
+        size = self.SEQUENCE.size + self.VALUES.size
+        if create:
+            with open( path, 'wb' ) as f:
+                f.write( '\0' * size )
+        with open( path, 'r+b' ) as f:
+            self.__map = mmap.mmap( f.fileno(), size )
+        self.__sequence = 0
+        self.__last_read = dict.fromkeys( self.FIELDS, 0.0 )
+
+    def write( self, values ):
+        """Publish a dict of FIELDS; missing fields are written as 0."""
+        self.__sequence += 1
+        self.SEQUENCE.pack_into( self.__map, 0, self.__sequence )
+        self.VALUES.pack_into( self.__map, self.SEQUENCE.size, *[ values.get( name, 0.0 ) for name in self.FIELDS ] )
+        self.__sequence += 1
+        self.SEQUENCE.pack_into( self.__map, 0, self.__sequence )
+
+    def read( self ):
+        """Return the last update as a dict of FIELDS; never blocks."""
+        for i in xrange( self.READ_TRIES ):
+            before, = self.SEQUENCE.unpack_from( self.__map, 0 )
+            values = self.VALUES.unpack_from( self.__map, self.SEQUENCE.size )
+            after, = self.SEQUENCE.unpack_from( self.__map, 0 )
+            if before == after and not before % 2:
+                self.__last_read = dict( zip( self.FIELDS, values ) )
+                break
+        return dict( self.__last_read )
+
+    def close( self ):
+        self.__map.close()
+
+
+class RemoteError( RuntimeError ):
+    """A call to the playback process failed there, or was lost as the
+    process died. `kind` is the name of the exception class raised there,
+    if it was."""
+
+    def __init__( self, message, kind=None ):
+        RuntimeError.__init__( self, message )
+        self.kind = kind
+
+
+class PlaybackHost( object ):
+    """Runs the Spotify session and the audio output in a child process,
+    so that they do not compete for the GIL with the controller's API
+    threads and their JSON encoding.
+
+    The child is given its end of a socket pair as its standard input, and
+    its first message on it is ( 'config', config ); the config holds the
+    Spotify credentials, so it is never put on the child's command line.
+    Calls go to the child as ( 'call', id, zone, method,
+    args ), answered by ( 'result', id, value ) or ( 'error', id, message ).
+    The child also sends, unasked: ( 'ready', ) once its managers are built;
+    ( 'state', zone, state ) and ( 'snapshot', zone, snapshot ) as a
+    zone's playback changes; ( 'track', name ) as a new track starts; and
+    ( 'catalogue', method, args ) for the catalogues. Figures for the
+    metrics and for sync come through a StatusBlock in shared memory. Audio
+    itself never crosses over: the sink is in the child.
+
+    If the child dies, it is started again, after a delay that grows if it
+    keeps dying, and each zone carries on from its last snapshot. Calls made
+    meanwhile are held until it is back; calls it had not answered fail with
+    RemoteError.
+    """
+
+    RESTART_DELAYS = ( 0, 1, 2, 5, 10, 30 )
+    # Seconds a child must have run for its death not to count towards the
+    # next restart's delay
+    STABLE_SECS = 60
+    START_TIMEOUT = 60.0
+    STOP_TIMEOUT = 5.0
+
+    def __init__( self, config, catalogues=() ):
+        """
+        config:
+            JSON-able dict for the child: 'zones', the zone names, the
+            default first; 'username', 'password', 'api_key'; optionally
+            'audio_cache', ( directory, max_bytes ), 'processor', the
+            AudioProcessor's options, and 'factory', "module:function" to
+            build the managers with, see `spotify_managers()`, with
+            'factory_path' the directory to import its module from
+        catalogues:
+            objects to keep up to date with the user's playlists, as for
+            PlaybackManager
+        """
+        self.config = dict( config )
+        self.config.setdefault( 'log_level',
+                                logging.getLevelName( logging.getLogger( ROOT_LOGGER ).getEffectiveLevel() ) )
+        self.zone_names = tuple( config['zones'] )
+        self.catalogues = tuple( catalogues )
+        self.restarts = 0
+
+        fd, path = tempfile.mkstemp( prefix='symfopi-status-', dir='/dev/shm' if os.path.isdir( '/dev/shm' ) else None )
+        os.close( fd )
+        self.status_block = StatusBlock( path, create=True )
+        self.output = RemoteAudioOutput( self )
+
+        self.__lock = threading.Lock()
+        self.__ids = itertools.count( 1 )
+        self.__pending = {}            # call id -> Future
+        self.__held = []               # calls made while the child is down
+        self.__states = {}             # zone -> last state
+        self.__snapshots = {}          # zone -> last snapshot, to restore after a crash
+        self.__channel = None          # while the child is up and ready
+        self.__process = None
+        self.__ready = threading.Event()
+        self.__stopping = False
+        self.__quick_deaths = 0
+
+    track_change_listeners = ()
+
+    def add_track_change_listener( self, func ):
+        """Call `func( name )` whenever a new track starts loading."""
+        self.track_change_listeners = self.track_change_listeners + (func,)
+
+    def start( self ):
+        """Start the child and wait until it has built its managers. Raises
+        RuntimeError if it does not."""
+        self.__spawn()
+        if not self.__ready.wait( self.START_TIMEOUT ):
+            raise RuntimeError( "Playback process did not start" )
+
+    def manager( self, zone ):
+        """Return the RemotePlaybackManager of a zone."""
+        return RemotePlaybackManager( self, zone )
+
+    def __spawn( self ):
+        parent_sock, child_sock = socket.socketpair()
+        # The child's end is its stdin; nothing else of the controller's,
+        # such as the API's listening socket or the database, is inherited
+        args = [ sys.executable, os.path.abspath( __file__.replace( '.pyc', '.py' ) ), '--child',
+                 '0', self.status_block.path ]
+        process = subprocess.Popen( args, stdin=child_sock.fileno(), close_fds=True )
+        child_sock.close()
+        self.__process = process
+        channel = Channel( parent_sock )
+        channel.send( 'config', self.config )
+        started = time.time()
+        thread = threading.Thread( target=self.__read, args=( channel, process, started ), name='playback-host' )
+        thread.setDaemon( True )
+        thread.start()
+        log.info( "Started playback process", extra=fields( pid=process.pid ) )
+
+    def __read( self, channel, process, started ):
+        """Handle the child's messages until it goes, then start another."""
+        while True:
+            message = channel.recv()
+            if message is None:
+                break
+            kind = message[0]
+            if kind == 'result' or kind == 'error':
+                with self.__lock:
+                    fut = self.__pending.pop( message[1], None )
+                if fut is None:
+                    continue
+                if kind == 'result':
+                    fut.set_result( message[2] )
+                else:
+                    fut.set_exception( RemoteError( message[2], message[2].partition( ':' )[0] ) )
+            elif kind == 'state':
+                self.__states[message[1]] = message[2]
+            elif kind == 'snapshot':
+                self.__snapshots[message[1]] = message[2]
+            elif kind == 'track':
+                for func in self.track_change_listeners:
+                    func( message[1] )
+            elif kind == 'catalogue':
+                for cat in self.catalogues:
+                    getattr( cat, message[1] )( *message[2] )
+            elif kind == 'ready':
+                self.__child_ready( channel )
+
+        # The child has gone
+        with self.__lock:
+            self.__channel = None
+            lost, self.__pending = self.__pending, {}
+        channel.close()
+        exit_code = process.wait()
+        for fut in lost.itervalues():
+            fut.set_exception( RemoteError( "Playback process exited" ) )
+        if self.__stopping:
+            return
+        self.restarts += 1
+        if time.time() - started >= self.STABLE_SECS:
+            self.__quick_deaths = 0
+        delay = self.RESTART_DELAYS[min( self.__quick_deaths, len( self.RESTART_DELAYS ) - 1 )]
+        self.__quick_deaths += 1
+        log.error( "Playback process died; restarting", extra=fields( exit_code=exit_code, delay=delay ) )
+        time.sleep( delay )
+        if not self.__stopping:
+            self.__spawn()
+
+    def __child_ready( self, channel ):
+        """Bring a new child up to date, then let calls through."""
+        with self.__lock:
+            if self.__ready.is_set():
+                # A restart: carry on where the last child was
+                for zone, snapshot in self.__snapshots.items():
+                    channel.send( 'call', 0, zone, 'restore', ( snapshot, ) )
+            held, self.__held = self.__held, []
+            for message in held:
+                channel.send( *message )
+            self.__channel = channel
+        self.__ready.set()
+        log.info( "Playback process ready", extra=fields( restarts=self.restarts ) )
+
+    def call( self, zone, method, *args ):
+        """Call a method of a zone's manager, or if `zone` is None, of the
+        session, in the child. Returns a Future of its result."""
+        fut = Future()
+        with self.__lock:
+            call_id = next( self.__ids )
+            self.__pending[call_id] = fut
+            message = ( 'call', call_id, zone, method, args )
+            channel = self.__channel
+            if channel is None:
+                self.__held.append( message )
+                return fut
+        try:
+            channel.send( *message )
+        except socket.error:
+            # Dying; the reader fails the call once the child has gone
+            pass
+        return fut
+
+    def state( self, zone ):
+        """Return a zone's last known state, as PlaybackManager.state()."""
+        state = self.__states.get( zone )
+        if state is None:
+            return { 'zone': zone, 'playing': False, 'playlist_index': None, 'track': None,
+                     'queue_length': 0, 'queue_position': 0, 'logged_in': False }
+        return dict( state )
+
+    def remember_snapshot( self, zone, snapshot ):
+        self.__snapshots[zone] = snapshot
+
+    def status( self ):
+        """Return the child's latest StatusBlock figures."""
+        return self.status_block.read()
+
+    def search_tracks( self, query, limit=20 ):
+        return self.call( None, 'search_tracks', query, limit )
+
+    def play_uri_at( self, uri, when ):
+        return self.call( None, 'play_uri_at', uri, when )
+
+    def set_volume( self, volume ):
+        return self.call( None, 'set_volume', volume )
+
+    def audio_cache_stats( self ):
+        return self.call( None, 'audio_cache_stats' )
+
+    def kill( self ):
+        """Kill the child, as a crash would."""
+        process = self.__process
+        if process is not None:
+            process.kill()
+
+    def finish( self ):
+        """Stop the child, letting it finish its managers."""
+        self.__stopping = True
+        with self.__lock:
+            channel = self.__channel
+        process = self.__process
+        if channel is not None:
+            try:
+                channel.send( 'stop' )
+            except socket.error:
+                pass
+        if process is not None:
+            deadline = time.time() + self.STOP_TIMEOUT
+            while process.poll() is None and time.time() < deadline:
+                time.sleep( 0.05 )
+            if process.poll() is None:
+                log.warning( "Playback process did not stop; killing it" )
+                process.kill()
+        self.status_block.close()
+        try:
+            os.remove( self.status_block.path )
+        except OSError:
+            pass
+
+
+class RemotePlaybackManager( object ):
+    """Stands in for a zone's PlaybackManager, run in the playback process.
+    Commands return Futures, as PlaybackManager's do; `state()` and
+    `is_playing()` answer from the state the child last sent."""
+
+    def __init__( self, host, zone ):
+        self.host = host
+        self.zone = zone
+        self.owns_session = zone == host.zone_names[0]
+
+    def pause_playback( self ):
+        return self.host.call( self.zone, 'pause_playback' )
+
+    def resume_playback( self ):
+        return self.host.call( self.zone, 'resume_playback' )
+
+    def set_current_playlist( self, playlist_index ):
+        return self.host.call( self.zone, 'set_current_playlist', playlist_index )
+
+    def next_track( self ):
+        return self.host.call( self.zone, 'next_track' )
+
+    def is_playing( self ):
+        return self.host.state( self.zone )['playing']
+
+    def state( self ):
+        return self.host.state( self.zone )
+
+    def snapshot( self ):
+        fut = self.host.call( self.zone, 'snapshot' )
+
+        def remember( f ):
+            if f.exception() is None:
+                self.host.remember_snapshot( self.zone, f.result() )
+        fut.add_done_callback( remember )
+        return fut
+
+    def restore( self, state ):
+        self.host.remember_snapshot( self.zone, state )
+        return self.host.call( self.zone, 'restore', state )
+
+    def finish( self ):
+        if self.owns_session:
+            self.host.finish()
+
+
+class RemoteAudioOutput( object ):
+    """The parts of the child's BufferedAudioOutput that sync uses: the
+    playback position, read from the StatusBlock, and drift correction."""
+
+    def __init__( self, host ):
+        self.host = host
+
+    @property
+    def sample_rate( self ):
+        return self.host.status()['sample_rate'] or None
+
+    def position_at( self, when ):
+        status = self.host.status()
+        if not status['position_time'] or not status['sample_rate']:
+            return None
+        return status['position_frames'] + ( when - status['position_time'] ) * status['sample_rate']
+
+    def correct_drift( self, frames ):
+        self.host.call( None, 'correct_drift', frames )
+
+
+#
+# The playback process
+
+class RemoteCatalogue( object ):
+    """Passes the jukebox's catalogue updates to the controller."""
+
+    def __init__( self, channel ):
+        self.channel = channel
+
+    def __getattr__( self, name ):
+        if name not in CATALOGUE_METHODS:
+            raise AttributeError( name )
+        return lambda *args: self.channel.send( 'catalogue', name, args )
+
+
+def spotify_managers( config, catalogues ):
+    """Build a PlaybackManager for each zone, sharing the first's session."""
+    from playback import PlaybackManager
+    audio_cache = processor = None
+    if config.get( 'audio_cache' ):
+        from audio_cache import AudioCache
+        audio_cache = AudioCache( *config['audio_cache'] )
+    if config.get( 'processor' ):
+        from audio_dsp import AudioProcessor
+        processor = AudioProcessor( **config['processor'] )
+    names = config['zones']
+    first = PlaybackManager( config['username'], config['password'], config['api_key'], catalogues=catalogues,
+                             zone=names[0], audio_cache=audio_cache, processor=processor )
+    return [ first ] + [ PlaybackManager( config['username'], config['password'], config['api_key'],
+                                          zone=name, shared=first ) for name in names[1:] ]
+
+
+class PlaybackChild( object ):
+    """The playback process's side of a PlaybackHost: runs the calls that
+    come over the pipe, and publishes each zone's state and the status."""
+
+    # Seconds between StatusBlock updates, and between checks for zone
+    # state to send and snapshots to take
+    STATUS_SECS = 0.05
+    STATE_SECS = 1.0
+
+    def __init__( self, channel, status_block, config ):
+        self.channel = channel
+        self.status_block = status_block
+        if config.get( 'factory_path' ):
+            sys.path.insert( 0, config['factory_path'] )
+        module_name, _, func_name = config.get( 'factory', 'playback_process:spotify_managers' ).partition( ':' )
+        factory = getattr( __import__( module_name ), func_name )
+        self.managers = collections.OrderedDict(
+            ( pm.zone, pm ) for pm in factory( config, ( RemoteCatalogue( channel ), ) ) )
+        self.first = self.managers.values()[0]
+        self.jukebox = self.first.jukebox
+        self.jukebox.add_track_change_listener( lambda track: channel.send( 'track', track.name() ) )
+        self.__sent_states = {}
+        self.__stop = threading.Event()
+
+    def run( self ):
+        thread = threading.Thread( target=self.__publish, name='playback-status' )
+        thread.setDaemon( True )
+        thread.start()
+        self.channel.send( 'ready' )
+        while True:
+            message = self.channel.recv()
+            if message is None or message[0] == 'stop':
+                break
+            kind, call_id, zone, method, args = message
+            self.__call( call_id, zone, method, args )
+        self.__stop.set()
+        thread.join()
+        for pm in self.managers.itervalues():
+            pm.finish()
+
+    def __call( self, call_id, zone, method, args ):
+        try:
+            if zone is None:
+                if method not in SESSION_METHODS:
+                    raise AttributeError( "No session method '%s'" % method )
+                result = getattr( self, 'do_' + method )( *args )
+            else:
+                if method not in ZONE_METHODS:
+                    raise AttributeError( "No zone method '%s'" % method )
+                result = getattr( self.managers[zone], method )( *args )
+        except Exception as ex:
+            log.exception( "Call from the controller failed" )
+            self.channel.send( 'error', call_id, "%s: %s" % ( type( ex ).__name__, ex ) )
+            return
+        if not isinstance( result, Future ):
+            self.channel.send( 'result', call_id, result )
+            return
+
+        def reply( fut ):
+            if fut.exception() is not None:
+                self.channel.send( 'error', call_id, "%s: %s" % ( type( fut.exception() ).__name__, fut.exception() ) )
+            else:
+                self.channel.send( 'result', call_id, fut.result() )
+            if zone is not None:
+                self.__send_state( zone )
+        result.add_done_callback( reply )
+
+    def do_search_tracks( self, query, limit ):
+        return self.jukebox.search_tracks( query, limit )
+
+    def do_play_uri_at( self, uri, when ):
+        self.first.actor.submit( self.jukebox.play_uri_at, uri, when )
+
+    def do_correct_drift( self, frames ):
+        self.jukebox.audio.correct_drift( frames )
+
+    def do_set_volume( self, volume ):
+        processor = self.jukebox.audio.processor
+        if processor is None:
+            raise ValueError( "No audio processing" )
+        processor.set_volume( volume )
+
+    def do_audio_cache_stats( self ):
+        cache = getattr( self.jukebox, 'audio_cache', None )
+        if cache is None:
+            return { 'enabled': False }
+        stats = cache.stats()
+        stats['enabled'] = True
+        return stats
+
+    def __send_state( self, zone ):
+        state = self.managers[zone].state()
+        if state != self.__sent_states.get( zone ):
+            self.__sent_states[zone] = state
+            self.channel.send( 'state', zone, state )
+            return True
+        return False
+
+    def __publish( self ):
+        """Keep the StatusBlock up to date, and send each zone's state and
+        snapshot as they change, and its snapshot every STATE_SECS while it
+        plays, for the controller to restore from should this process die."""
+        audio = self.jukebox.audio
+        last_states = 0
+        while not self.__stop.wait( self.STATUS_SECS ):
+            now = time.time()
+            position = audio.position_at( now )
+            self.status_block.write( { 'fill_level': audio.buffer.fill_level(),
+                                       'overruns': audio.buffer.overruns,
+                                       'underruns': audio.buffer.underruns,
+                                       'queue_length': self.jukebox.queue_status()[1],
+                                       'commands_pending': self.first.actor.pending(),
+                                       'position_time': now if position is not None else 0.0,
+                                       'position_frames': position or 0.0,
+                                       'sample_rate': audio.sample_rate or 0.0,
+                                       'updated': now } )
+            if now - last_states < self.STATE_SECS:
+                continue
+            last_states = now
+            for zone, pm in self.managers.items():
+                if self.__send_state( zone ) or pm.is_playing():
+                    pm.snapshot().add_done_callback( lambda fut, zone=zone: self.__send_snapshot( zone, fut ) )
+
+    def __send_snapshot( self, zone, fut ):
+        if fut.exception() is None:
+            self.channel.send( 'snapshot', zone, fut.result() )
+
+
+def child_main( fd, status_path ):
+    channel = Channel( socket.fromfd( fd, socket.AF_UNIX, socket.SOCK_STREAM ) )
+    if fd == 0:
+        null = os.open( os.devnull, os.O_RDONLY )
+        os.dup2( null, 0 )
+        os.close( null )
+    else:
+        os.close( fd )
+    message = channel.recv()
+    if message is None or message[0] != 'config':
+        sys.exit( "No config from the controller" )
+    config = message[1]
+    listener = setup_logging( config.get( 'log_level', 'INFO' ) )
+    try:
+        PlaybackChild( channel, StatusBlock( status_path ), config ).run()
+    finally:
+        listener.stop()
+
+
+if __name__ == '__main__':
+    if len( sys.argv ) == 4 and sys.argv[1] == '--child':
+        child_main( int( sys.argv[2] ), sys.argv[3] )
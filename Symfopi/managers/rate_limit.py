@@ -0,0 +1,53 @@
+import time
+import threading
+
+
+class RateLimiter( object ):
+    """Token buckets per client: each client may make `rate` requests a
+    second on average, in bursts of up to `burst`.
+
+    Clients are whatever hashable key the caller identifies them by, such
+    as an address. Once there are `max_clients` buckets, those that have
+    been quiet long enough to be full again are dropped; clients beyond
+    that share one bucket, so the table stays bounded however many
+    addresses are seen.
+    """
+
+    OVERFLOW = object()      # key of the bucket shared by clients beyond max_clients
+
+    def __init__( self, rate, burst, max_clients=1024, clock=time.time ):
+        self.rate = float( rate )
+        self.burst = float( burst )
+        self.max_clients = max_clients
+        self.clock = clock
+        self.__buckets = {}  # client -> [tokens, time of last update]
+        self.__lock = threading.Lock()
+
+    def acquire( self, client ):
+        """Take a token for a request from `client`. Returns 0 if there was
+        one, or else the seconds until there will be."""
+        now = self.clock()
+        with self.__lock:
+            bucket = self.__buckets.get( client )
+            if bucket is None:
+                if len( self.__buckets ) >= self.max_clients:
+                    self.__prune( now )
+                if len( self.__buckets ) >= self.max_clients:
+                    client = self.OVERFLOW
+                bucket = self.__buckets.setdefault( client, [ self.burst, now ] )
+            tokens = min( self.burst, bucket[0] + ( now - bucket[1] ) * self.rate )
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+            bucket[0] = tokens
+            return ( 1 - tokens ) / self.rate
+
+    def __len__( self ):
+        return len( self.__buckets )
+
+    def __prune( self, now ):
+        refill_secs = self.burst / self.rate
+        for client, ( tokens, last ) in self.__buckets.items():
+            if now - last >= refill_secs:
+                del self.__buckets[client]
@@ -0,0 +1,89 @@
+import collections
+import threading
+import time
+
+from api_server import ServiceUnavailable
+from logs import get_logger, fields
+
+log = get_logger( 'startup' )
+
+
+class Readiness( object ):
+    """Tracks which of the controller's managers are up, for managers that
+    are built in the background after the API has started serving.
+
+    Each manager goes from 'pending' to 'starting' to 'ready', or to
+    'failed' if it could not be built. API functions call `require()` for
+    the managers they use, and so answer 503 until those are ready.
+    """
+
+    PENDING, STARTING, READY, FAILED = 'pending', 'starting', 'ready', 'failed'
+
+    # Seconds a client is told to wait before retrying a request that
+    # needed a manager still starting
+    RETRY_AFTER = 1
+
+    def __init__( self, names ):
+        self.__lock = threading.Lock()
+        self.__managers = collections.OrderedDict()
+        for name in names:
+            self.__managers[name] = { 'state': self.PENDING, 'seconds': None, 'error': None }
+        self.__ready = dict( ( name, threading.Event() ) for name in names )
+        self.__started = time.time()
+
+    def run( self, name, func, *args ):
+        """Build a manager: call `func( *args )`, recording how long it took
+        and whether it failed. Returns what `func` returns, or None if it
+        raised."""
+        with self.__lock:
+            self.__managers[name]['state'] = self.STARTING
+        started = time.time()
+        try:
+            ret = func( *args )
+        except Exception as ex:
+            log.exception( "Failed to start %s", name )
+            with self.__lock:
+                self.__managers[name].update( state=self.FAILED, seconds=time.time() - started, error=str( ex ) )
+            return None
+        seconds = time.time() - started
+        with self.__lock:
+            self.__managers[name].update( state=self.READY, seconds=seconds )
+        self.__ready[name].set()
+        log.info( "Started %s", name, extra=fields( seconds=round( seconds, 3 ),
+                                                    since_start=round( time.time() - self.__started, 3 ) ) )
+        return ret
+
+    def fail( self, name, error ):
+        """Record that a manager will not start, e.g. as one it needs failed."""
+        log.error( "Not starting %s: %s", name, error )
+        with self.__lock:
+            self.__managers[name].update( state=self.FAILED, error=error )
+
+    def is_ready( self, name ):
+        return self.__ready[name].is_set()
+
+    def all_ready( self ):
+        return all( event.is_set() for event in self.__ready.itervalues() )
+
+    def wait( self, name, timeout=None ):
+        """Wait for a manager to be ready. Returns whether it is."""
+        return self.__ready[name].wait( timeout )
+
+    def require( self, *names ):
+        """Raise ServiceUnavailable unless every named manager is ready."""
+        for name in names:
+            if not self.__ready[name].is_set():
+                with self.__lock:
+                    state = self.__managers[name]['state']
+                if state == self.FAILED:
+                    raise ServiceUnavailable( "%s failed to start" % name.capitalize() )
+                raise ServiceUnavailable( "%s is starting" % name.capitalize(), self.RETRY_AFTER )
+
+    def status( self, name=None ):
+        """Return a JSON-able dict of a manager's state, seconds taken to
+        start and error if it failed, or a dict of every manager's if
+        `name` is None. Raises KeyError for an unknown manager."""
+        with self.__lock:
+            if name is not None:
+                return dict( self.__managers[name] )
+            return collections.OrderedDict( ( n, dict( m ) ) for n, m in self.__managers.iteritems() )
@@ -0,0 +1,70 @@
+import collections
+import hashlib
+import logging
+import threading
+
+
+class CachedResponse( object ):
+    """The JSON-encoded payload of a response, and the version of the
+    controller's state that it was produced from."""
+
+    __slots__ = ( 'version', 'payload', 'etag' )
+
+    def __init__( self, version, payload ):
+        self.version = version
+        self.payload = payload
+        # The ETag hashes the content, not the version, so a state change that
+        # leaves the response the same still lets clients keep their copy
+        self.etag = '"%s"' % hashlib.sha1( payload ).hexdigest()[:20]
+
+    def matches( self, if_none_match ):
+        """Whether an If-None-Match header value names this response."""
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        return self.etag in [ tag.strip() for tag in if_none_match.split( ',' ) ]
+
+
+class ResponseCache( object ):
+    """Encoded responses of the API functions registered as cacheable, kept
+    until the version they were produced from changes.
+
+    Entries are keyed on the function and its arguments. The least recently
+    used entries are dropped once there are more than `max_entries`.
+    """
+
+    def __init__( self, max_entries=256 ):
+        self.max_entries = max_entries
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def make_key( func_handle, qargs_dict ):
+        if not qargs_dict:
+            return func_handle
+        return ( func_handle, tuple( sorted( (k, tuple( v )) for k, v in qargs_dict.iteritems() ) ) )
+
+    def lookup( self, key, version ):
+        """Return the CachedResponse stored for `key` at `version`, or None."""
+        with self.__lock:
+            entry = self.__entries.get( key )
+            if entry is None or entry.version != version:
+                return None
+            # Move to the most recently used end
+            del self.__entries[key]
+            self.__entries[key] = entry
+            return entry
+
+    def store( self, key, version, payload ):
+        entry = CachedResponse( version, payload )
+        with self.__lock:
+            self.__entries.pop( key, None )
+            self.__entries[key] = entry
+            while len( self.__entries ) > self.max_entries:
+                self.__entries.popitem( last=False )
+        return entry
+
+    def clear( self ):
+        with self.__lock:
+            self.__entries.clear()
@@ -0,0 +1,128 @@
+import collections
+import logging
+import urllib
+
+
+class RoutingError( RuntimeError ):
+    """No function can be found for a request.
+
+    status:
+        the HTTP status to respond with (404 or 405)
+    allow:
+        for a 405, the methods that the path does accept
+    """
+
+    def __init__( self, status, message, allow=() ):
+        RuntimeError.__init__( self, message )
+        self.status = status
+        self.allow = tuple( allow )
+
+
+class _TrieNode( object ):
+    __slots__ = ( 'literals', 'param_name', 'param_child', 'methods' )
+
+    def __init__( self ):
+        self.literals = {}       # path segment -> _TrieNode
+        self.param_name = None
+        self.param_child = None  # _TrieNode for a "{name}" segment
+        self.methods = None      # HTTP method -> func, if a route ends here
+
+
+class RouteTable( object ):
+    """Maps request paths to functions, per HTTP method.
+
+    Paths are written without leading or trailing slashes. A path segment
+    written as `{name}` is a parameter that matches any single segment, e.g.
+    `playlists/{index}/tracks`.
+
+    Routes without parameters are found with a single dict lookup. Routes with
+    parameters are kept in a trie of path segments, built as they are added;
+    at each level a literal segment is preferred to a parameter.
+    """
+
+    def __init__( self ):
+        self.__static = {}   # path -> { HTTP method -> func }
+        self.__trie = _TrieNode()
+
+    def add( self, pathname, http_method, func ):
+        pathname = pathname.strip( '/' )
+        segments = pathname.split( '/' )
+
+        if not any( self.__is_param( s ) for s in segments ):
+            self.__static.setdefault( pathname, {} )[http_method] = func
+            return
+
+        node = self.__trie
+        for seg in segments:
+            if self.__is_param( seg ):
+                name = seg[1:-1]
+                if node.param_child is None:
+                    node.param_name = name
+                    node.param_child = _TrieNode()
+                elif node.param_name != name:
+                    raise ValueError( "Path parameter '%s' in '%s' clashes with '%s'"
+                                      % ( name, pathname, node.param_name ) )
+                node = node.param_child
+            else:
+                node = node.literals.setdefault( seg, _TrieNode() )
+        if node.methods is None:
+            node.methods = {}
+        node.methods[http_method] = func
+
+    @staticmethod
+    def __is_param( segment ):
+        return len( segment ) > 2 and segment[0] == '{' and segment[-1] == '}'
+
+    def match( self, http_method, path ):
+        """Find the function for a request.
+
+        path:
+            the path part of the URL, with or without surrounding slashes
+
+        Returns `(func, params)`, where params maps the names of any path
+        parameters to the segments they matched. Raises RoutingError if there
+        is no route for the path (404), or none for the method (405).
+        """
+        path = path.strip( '/' )
+        methods = self.__static.get( path )
+        params = {}
+        if methods is None:
+            methods = self.__match_trie( self.__trie, path.split( '/' ), 0, params )
+            if methods is None:
+                raise RoutingError( 404, "No such function: '%s'" % path )
+
+        func = methods.get( http_method )
+        if func is None:
+            raise RoutingError( 405, "Function '%s' does not accept %s" % ( path, http_method ),
+                                allow=sorted( methods ) )
+        return func, params
+
+    def __match_trie( self, node, segments, indx, params ):
+        if indx == len( segments ):
+            return node.methods
+
+        seg = segments[indx]
+        child = node.literals.get( seg )
+        if child is not None:
+            methods = self.__match_trie( child, segments, indx + 1, params )
+            if methods is not None:
+                return methods
+
+        if node.param_child is not None and seg:
+            methods = self.__match_trie( node.param_child, segments, indx + 1, params )
+            if methods is not None:
+                params[node.param_name] = urllib.unquote( seg )
+                return methods
+
+        return None
+
+    def __len__( self ):
+        return sum( len( m ) for m in self.__static.itervalues() ) + self.__count( self.__trie )
+
+    def __count( self, node ):
+        n = len( node.methods ) if node.methods else 0
+        for child in node.literals.itervalues():
+            n += self.__count( child )
+        if node.param_child is not None:
+            n += self.__count( node.param_child )
+        return n
@@ -0,0 +1,157 @@
+import heapq
+import itertools
+import time
+import logging
+import threading
+
+from logs import get_logger
+
+log = get_logger( 'scheduler' )
+
+
+class SystemClock( object ):
+    """Real time, for a Scheduler or anything else that takes a clock:
+    calling it gives `time.time()`, and `sleep()` is `time.sleep()`."""
+
+    speed = 1.0
+
+    def __call__( self ):
+        return time.time()
+
+    def sleep( self, seconds ):
+        time.sleep( seconds )
+
+
+SYSTEM_CLOCK = SystemClock()
+
+
+class VirtualClock( SystemClock ):
+    """A clock for simulations, running `speed` times as fast as real time
+    from `start` (by default, the time it is created). Given to a Scheduler,
+    and to whatever else keeps time in the simulation, it runs timer-driven
+    scenarios such as motion control's at, say, 1000x: a 5 s hold passes in
+    5 ms."""
+
+    def __init__( self, speed=1000.0, start=None ):
+        self.speed = float( speed )
+        self.__real_start = time.time()
+        self.start = self.__real_start if start is None else start
+
+    def __call__( self ):
+        return self.start + ( time.time() - self.__real_start ) * self.speed
+
+    def sleep( self, seconds ):
+        time.sleep( seconds / self.speed )
+
+
+class ScheduledCall( object ):
+    """A handle on a function scheduled with a Scheduler."""
+
+    __slots__ = ( 'when', 'func', 'args', 'cancelled' )
+
+    def __init__( self, when, func, args ):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel( self ):
+        """Stop the function being called, if it has not been already."""
+        self.cancelled = True
+
+
+class Scheduler( object ):
+    """A single thread that calls functions at given times.
+
+    Pending calls are kept in a heap ordered by time, so scheduling and
+    cancelling are cheap however many calls are pending, and no thread is
+    created per call (unlike threading.Timer). Cancelled calls are left in the
+    heap until they come up, unless they come to outnumber the live ones, in
+    which case the heap is rebuilt without them.
+
+    Functions run one at a time on the scheduler's thread, so they should be
+    quick; exceptions they raise are printed and otherwise ignored.
+
+    Times are in the scheduler's `clock`, real time by default; a
+    VirtualClock makes the calls come round faster.
+    """
+
+    def __init__( self, name='scheduler', clock=SYSTEM_CLOCK ):
+        self.clock = clock
+        self.__heap = []
+        self.__seq = itertools.count()   # tie-break for calls at the same time
+        self.__cancelled = 0
+        self.__cond = threading.Condition()
+        self.__stop_requested = False
+
+        self.__thread = threading.Thread( target=self.__run, name=name )
+        self.__thread.setDaemon( True )
+        self.__thread.start()
+
+    def call_later( self, delay, func, *args ):
+        """Call `func(*args)` in `delay` seconds. Returns a ScheduledCall."""
+        return self.call_at( self.clock() + delay, func, *args )
+
+    def call_at( self, when, func, *args ):
+        """Call `func(*args)` at time `when` (as from the scheduler's clock)."""
+        call = ScheduledCall( when, func, args )
+        with self.__cond:
+            heapq.heappush( self.__heap, ( when, next( self.__seq ), call ) )
+            # Only wake the thread if its next wake-up needs bringing forward
+            if self.__heap[0][2] is call:
+                self.__cond.notify()
+        return call
+
+    def cancel( self, call ):
+        """Cancel a ScheduledCall, tidying up the heap if it is mostly
+        cancelled calls."""
+        if call.cancelled:
+            return
+        call.cancel()
+        with self.__cond:
+            self.__cancelled += 1
+            if self.__cancelled > 64 and self.__cancelled * 2 > len( self.__heap ):
+                self.__heap = [ entry for entry in self.__heap if not entry[2].cancelled ]
+                heapq.heapify( self.__heap )
+                self.__cancelled = 0
+
+    def pending( self ):
+        """Number of entries in the heap, including cancelled ones."""
+        return len( self.__heap )
+
+    def stop( self, wait=True ):
+        """Stop the scheduler thread. Calls still pending are dropped."""
+        with self.__cond:
+            self.__stop_requested = True
+            self.__cond.notify()
+        if wait and threading.current_thread() is not self.__thread:
+            self.__thread.join()
+
+    def __run( self ):
+        while True:
+            with self.__cond:
+                while True:
+                    if self.__stop_requested:
+                        return
+                    if not self.__heap:
+                        self.__cond.wait()
+                        continue
+                    when, _, call = self.__heap[0]
+                    if call.cancelled:
+                        heapq.heappop( self.__heap )
+                        self.__cancelled = max( 0, self.__cancelled - 1 )
+                        continue
+                    delay = when - self.clock()
+                    if delay > 0:
+                        self.__cond.wait( delay / self.clock.speed )
+                        continue
+                    heapq.heappop( self.__heap )
+                    break
+
+            if call.cancelled:
+                continue
+            call.cancelled = True  # done; a later cancel() is a no-op
+            try:
+                call.func( *call.args )
+            except Exception as ex:
+                log.exception( "Error in scheduled call %r", call.func )
@@ -0,0 +1,260 @@
+import bisect
+import re
+import sys
+import threading
+
+TOKEN_RE = re.compile( r'\w+', re.UNICODE )
+
+
+def tokenize( text ):
+    """Split a name into lower-case words."""
+    if not text:
+        return []
+    if isinstance( text, str ):
+        text = text.decode( 'utf-8', 'replace' )
+    return TOKEN_RE.findall( text.lower() )
+
+
+class PrefixIndex( object ):
+    """An inverted index from words to documents, answering queries in which
+    every word of the query is a prefix of some word of the document (so
+    "beat ab" finds "Abbey Road" by The Beatles).
+
+    The vocabulary is kept sorted, so the words starting with a prefix are a
+    contiguous run found by bisection; nothing is stored per prefix. Each
+    document is indexed once however many times it is added, and removed
+    again when it has been removed as many times as it was added.
+    """
+
+    def __init__( self ):
+        self.__postings = {}     # word -> set of document keys
+        self.__vocab = []        # sorted words of __postings
+        self.__docs = {}         # key -> [value, words, references]
+
+    def __len__( self ):
+        return len( self.__docs )
+
+    def add( self, key, value, *texts ):
+        """Add a reference to the document `key`, found by the words of
+        `texts`. If it is already indexed with a different value, such as a
+        track whose metadata had not loaded, the new value and words replace
+        the old."""
+        doc = self.__docs.get( key )
+        if doc is not None:
+            doc[2] += 1
+            if doc[0] == value:
+                return
+            refs = doc[2]
+            doc[2] = 1
+            self.discard( key )
+        else:
+            refs = 1
+        words = set()
+        for text in texts:
+            words.update( tokenize( text ) )
+        words = tuple( words )
+        self.__docs[key] = [ value, words, refs ]
+        for w in words:
+            keys = self.__postings.get( w )
+            if keys is None:
+                keys = self.__postings[w] = set()
+                bisect.insort( self.__vocab, w )
+            keys.add( key )
+
+    def discard( self, key ):
+        doc = self.__docs.get( key )
+        if doc is None:
+            return
+        doc[2] -= 1
+        if doc[2] > 0:
+            return
+        del self.__docs[key]
+        for w in doc[1]:
+            keys = self.__postings[w]
+            keys.discard( key )
+            if not keys:
+                del self.__postings[w]
+                del self.__vocab[bisect.bisect_left( self.__vocab, w )]
+
+    def clear( self ):
+        self.__postings.clear()
+        del self.__vocab[:]
+        self.__docs.clear()
+
+    def __words_with_prefix( self, prefix ):
+        vocab = self.__vocab
+        return vocab[bisect.bisect_left( vocab, prefix ):bisect.bisect_left( vocab, prefix + u'\uffff' )]
+
+    def __postings_size( self, prefix, cap ):
+        """Number of postings of the words starting with `prefix`, counting
+        no further than `cap`."""
+        n = 0
+        for w in self.__words_with_prefix( prefix ):
+            n += len( self.__postings[w] )
+            if n > cap:
+                break
+        return n
+
+    def search( self, query, limit=20 ):
+        """Return the values of up to `limit` documents matching `query`,
+        ordered by the words matching its most selective term."""
+        terms = sorted( set( tokenize( query ) ), key=len, reverse=True )
+        if not terms or limit <= 0:
+            return []
+        # Candidates come from the term with the fewest postings; the rest
+        # are checked against each candidate's words
+        first, best = terms[0], None
+        if len( terms ) > 1:
+            for t in terms:
+                size = self.__postings_size( t, best if best is not None else sys.maxint )
+                if best is None or size < best:
+                    first, best = t, size
+        # Words matching each of the other terms, to test candidates against
+        rest = [ frozenset( self.__words_with_prefix( t ) ) for t in terms if t != first ]
+        results = []
+        seen = set()
+        for w in self.__words_with_prefix( first ):
+            for key in self.__postings[w]:
+                if key in seen:
+                    continue
+                seen.add( key )
+                value, words, refs = self.__docs[key]
+                if all( not matching.isdisjoint( words ) for matching in rest ):
+                    results.append( value )
+                    if len( results ) >= limit:
+                        return results
+        return results
+
+
+class SearchIndex( object ):
+    """An in-memory index of the names of the playlists and tracks the
+    jukebox has seen, so that search-as-you-type does not go to Spotify for
+    every keystroke.
+
+    Kept up to date through the same calls as the MetadataStore (the jukebox
+    passes each container and playlist change to both), with tracks and
+    playlists as the same tuples:
+
+        playlist: (uri, name)
+        track:    (uri, name, artist, album, duration_ms)
+
+    A track is found by words from its name, artist or album. Safe to update
+    from the session thread while other threads search.
+    """
+
+    def __init__( self ):
+        self.__lock = threading.Lock()
+        self.__playlist_uris = []    # in container order
+        self.__playlist_tracks = {}  # playlist uri -> [track uri] in playlist order
+        self.__tracks = PrefixIndex()
+        self.__playlists = PrefixIndex()
+        self.__synced = False
+
+    def __len__( self ):
+        """Number of distinct tracks indexed."""
+        return len( self.__tracks )
+
+    def search_tracks( self, query, limit=20 ):
+        """Return up to `limit` track tuples matching `query`."""
+        with self.__lock:
+            return self.__tracks.search( query, limit )
+
+    def search_playlists( self, query, limit=20 ):
+        """Return up to `limit` (uri, name) of playlists matching `query`."""
+        with self.__lock:
+            return self.__playlists.search( query, limit )
+
+    #
+    #
+    # Updates
+    #
+    def load_from_store( self, store ):
+        """Index the catalogue saved in a MetadataStore. Does nothing if the
+        index has already been given the container by the jukebox, which is
+        more up to date."""
+        playlists = [ ( (uri, name), [ row[1:] for row in store.tracks( position ) ] )
+                      for position, name, uri, num_tracks in store.playlists() ]
+        with self.__lock:
+            if not self.__synced:
+                self.__sync_container( playlists )
+
+    def sync_container( self, playlists ):
+        """Replace the list of playlists; see MetadataStore.sync_container."""
+        with self.__lock:
+            self.__synced = True
+            self.__sync_container( playlists )
+
+    def __sync_container( self, playlists ):
+        new_uris = [ uri for (uri, name), tracks in playlists ]
+        keep = set( new_uris )
+        for uri in self.__playlist_uris:
+            if uri not in keep:
+                self.__drop_playlist( uri )
+        for (uri, name), tracks in playlists:
+            self.__playlists.discard( uri )
+            self.__playlists.add( uri, (uri, name), name )
+            if tracks is not None:
+                self.__sync_tracks( uri, tracks )
+            else:
+                self.__playlist_tracks.setdefault( uri, [] )
+        self.__playlist_uris = new_uris
+
+    def playlist_added( self, position, playlist, tracks=None ):
+        uri, name = playlist
+        with self.__lock:
+            self.__drop_playlist( uri )
+            if uri in self.__playlist_uris:
+                self.__playlist_uris.remove( uri )
+            self.__playlist_uris.insert( position, uri )
+            self.__playlists.add( uri, playlist, name )
+            self.__playlist_tracks[uri] = []
+            if tracks is not None:
+                self.__sync_tracks( uri, tracks )
+
+    def playlist_removed( self, position ):
+        with self.__lock:
+            if 0 <= position < len( self.__playlist_uris ):
+                self.__drop_playlist( self.__playlist_uris.pop( position ) )
+
+    def playlist_moved( self, old_position, new_position ):
+        with self.__lock:
+            if not 0 <= old_position < len( self.__playlist_uris ):
+                return
+            uri = self.__playlist_uris.pop( old_position )
+            # As in MetadataStore, the new position is an index before the move
+            if new_position > old_position:
+                new_position -= 1
+            self.__playlist_uris.insert( new_position, uri )
+
+    def playlist_renamed( self, uri, name ):
+        with self.__lock:
+            if uri in self.__playlist_tracks:
+                self.__playlists.discard( uri )
+                self.__playlists.add( uri, (uri, name), name )
+
+    def sync_tracks( self, playlist_uri, tracks ):
+        with self.__lock:
+            self.__sync_tracks( playlist_uri, tracks )
+
+    def tracks_added( self, playlist_uri, position, tracks ):
+        with self.__lock:
+            uris = [ self.__add_track( t ) for t in tracks ]
+            self.__playlist_tracks.setdefault( playlist_uri, [] )[position:position] = uris
+
+    def __add_track( self, track ):
+        uri, name, artist, album, duration_ms = track
+        self.__tracks.add( uri, tuple( track ), name, artist, album )
+        return uri
+
+    def __sync_tracks( self, playlist_uri, tracks ):
+        # Add before discarding, so tracks still in the playlist stay indexed
+        # rather than being dropped and tokenized again
+        old = self.__playlist_tracks.get( playlist_uri, () )
+        self.__playlist_tracks[playlist_uri] = [ self.__add_track( t ) for t in tracks ]
+        for uri in old:
+            self.__tracks.discard( uri )
+
+    def __drop_playlist( self, uri ):
+        self.__playlists.discard( uri )
+        for track_uri in self.__playlist_tracks.pop( uri, () ):
+            self.__tracks.discard( track_uri )
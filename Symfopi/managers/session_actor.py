@@ -0,0 +1,130 @@
+import collections
+import logging
+import threading
+
+from workers import Future
+from logs import get_logger
+
+log = get_logger( 'session' )
+
+
+class _Command( object ):
+
+    __slots__ = ( 'func', 'args', 'future', 'key', 'followers' )
+
+    def __init__( self, func, args, key ):
+        self.func = func
+        self.args = args
+        self.future = Future()
+        self.key = key
+        self.followers = []    # Futures of commands coalesced into this one
+
+
+class SessionActor( object ):
+    """A single thread that owns the Spotify session and playback state.
+
+    Anything that touches them (API requests, motion callbacks, libspotify's
+    own callbacks) submits a command instead of calling in directly, so they
+    run one at a time, in order, on the actor's thread. Each command's
+    result or exception comes back through a Future.
+
+    A command can be given a `coalesce` key: if a command with the same key
+    is still waiting to run, the new command takes its place in the queue
+    rather than joining the back, and both Futures get the new command's
+    result. So a burst of pause/resume commands from the motion sensor only
+    applies the final state, and is not held back however busy the queue.
+    """
+
+    def __init__( self, name='session' ):
+        self.__queue = collections.deque()
+        self.__waiting = {}          # coalesce key -> waiting _Command
+        self.__cond = threading.Condition()
+        self.__stop_requested = False
+
+        self.submitted = 0
+        self.executed = 0
+        self.coalesced = 0
+
+        self.__thread = threading.Thread( target=self.__run, name=name )
+        self.__thread.setDaemon( True )
+        self.__thread.start()
+
+    def on_actor_thread( self ):
+        return threading.current_thread() is self.__thread
+
+    def submit( self, func, *args, **kwargs ):
+        """Run `func(*args)` on the actor thread. Returns a Future of its
+        result.
+
+        coalesce (keyword only):
+            key under which the command replaces a waiting one
+
+        Called on the actor thread itself (from within a command), runs
+        `func` straight away, so that commands can use each other without
+        deadlocking.
+        """
+        key = kwargs.pop( 'coalesce', None )
+        if kwargs:
+            raise TypeError( "Unexpected keyword arguments: " + ','.join( kwargs.keys() ) )
+
+        cmd = _Command( func, args, key )
+        if self.on_actor_thread():
+            self.submitted += 1
+            self.__execute( cmd )
+            return cmd.future
+
+        with self.__cond:
+            if self.__stop_requested:
+                raise RuntimeError( "SessionActor has been stopped" )
+            self.submitted += 1
+            if key is not None:
+                waiting = self.__waiting.get( key )
+                if waiting is not None:
+                    waiting.func, waiting.args = func, args
+                    waiting.followers.append( cmd.future )
+                    self.coalesced += 1
+                    return cmd.future
+                self.__waiting[key] = cmd
+            self.__queue.append( cmd )
+            self.__cond.notify()
+        return cmd.future
+
+    def call( self, func, *args, **kwargs ):
+        """As submit(), but waits for and returns the result."""
+        return self.submit( func, *args, **kwargs ).result()
+
+    def pending( self ):
+        """Number of commands waiting to run."""
+        return len( self.__queue )
+
+    def stop( self, wait=True ):
+        """Stop the actor once the commands already submitted have run."""
+        with self.__cond:
+            self.__stop_requested = True
+            self.__cond.notify()
+        if wait and not self.on_actor_thread():
+            self.__thread.join()
+
+    def __execute( self, cmd ):
+        try:
+            result = cmd.func( *cmd.args )
+        except Exception as ex:
+            log.exception( "Error in session command %r", cmd.func )
+            for fut in [ cmd.future ] + cmd.followers:
+                fut.set_exception( ex )
+        else:
+            for fut in [ cmd.future ] + cmd.followers:
+                fut.set_result( result )
+        self.executed += 1
+
+    def __run( self ):
+        while True:
+            with self.__cond:
+                while not self.__queue and not self.__stop_requested:
+                    self.__cond.wait()
+                if not self.__queue:
+                    return
+                cmd = self.__queue.popleft()
+                if cmd.key is not None:
+                    del self.__waiting[cmd.key]
+            self.__execute( cmd )
@@ -1,28 +1,190 @@
 import collections
-import time
 import signal
 from datetime import datetime as dt
 import logging
 import threading
-import random 
+import random
+
+from workers import Future
+from scheduler import SYSTEM_CLOCK
+from logs import get_logger
+
+log = get_logger( 'spotify_api' )
+
+
+class CatalogueCache( object ):
+    """A cached value that is slow to fetch, such as the list of playlists.
+
+    * Reads of a fresh value (younger than `ttl` seconds) return straight
+      away without taking a lock.
+    * Reads of a stale value (younger than `ttl + stale_ttl` seconds) also
+      return straight away, and start a refresh in a background thread.
+    * Reads with no usable value block until a fetch completes.
+    * However many callers ask at once, at most one fetch is in flight, and
+      every caller waiting on a value shares its result.
+
+    `invalidate()` marks the value stale and starts a refresh; if it is called
+    while a fetch is in flight, that fetch's result is still served but another
+    fetch follows it.
+    """
+
+    def __init__( self, fetch_func, ttl=300.0, stale_ttl=3600.0, clock=SYSTEM_CLOCK ):
+        """
+        fetch_func:
+            called with no arguments, on a background thread, to fetch the
+            value
+        clock:
+            SystemClock that the value's age is measured in
+        """
+        self.__fetch_func = fetch_func
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+
+        self.__entry = None  # (value, fetched_at), replaced as a whole
+        self.__lock = threading.Lock()
+        self.__inflight = None
+        self.__generation = 0
+        self.version = 0     # incremented each time a fetched value is stored
+
+    def get( self ):
+        """Return the cached value, fetching it first if there is none."""
+        entry = self.__entry
+        if entry is not None:
+            age = self.clock() - entry[1]
+            if age < self.ttl:
+                return entry[0]
+            if age < self.ttl + self.stale_ttl:
+                self.refresh()
+                return entry[0]
+        return self.refresh().result()
+
+    def seed( self, value ):
+        """Serve `value`, e.g. one saved by a previous run, until a fetched
+        value replaces it. It counts as stale, so the first read starts a
+        fetch. No effect once a value has been fetched."""
+        with self.__lock:
+            if self.__entry is None:
+                self.__entry = ( value, self.clock() - self.ttl )
+                self.version += 1
+
+    def current_version( self ):
+        """Return `version`, starting a refresh first if the value is stale,
+        as a read with get() would."""
+        entry = self.__entry
+        if entry is not None and self.clock() - entry[1] >= self.ttl:
+            self.refresh()
+        return self.version
+
+    def peek( self ):
+        """Return the cached value, however old, or None. Never blocks."""
+        entry = self.__entry
+        return entry[0] if entry is not None else None
+
+    def refresh( self ):
+        """Start fetching the value in the background, unless a fetch is
+        already in flight. Returns the Future of the fetch."""
+        with self.__lock:
+            if self.__inflight is not None:
+                return self.__inflight
+            fut = self.__inflight = Future()
+            generation = self.__generation
+
+        t = threading.Thread( target=self.__fetch, args=(fut, generation) )
+        t.setDaemon( True )
+        t.start()
+        return fut
+
+    def invalidate( self ):
+        """Mark the cached value as out of date and fetch it again."""
+        with self.__lock:
+            self.__generation += 1
+            entry = self.__entry
+            if entry is not None:
+                # Keep serving the old value while the refresh runs
+                self.__entry = ( entry[0], self.clock() - self.ttl )
+        self.refresh()
+
+    def __fetch( self, fut, generation ):
+        try:
+            value = self.__fetch_func()
+        except Exception as ex:
+            with self.__lock:
+                self.__inflight = None
+            fut.set_exception( ex )
+            return
+
+        with self.__lock:
+            self.__inflight = None
+            if generation == self.__generation:
+                self.__entry = ( value, self.clock() )
+                again = False
+            else:
+                # Invalidated while fetching: serve this, but refetch
+                self.__entry = ( value, self.clock() - self.ttl )
+                again = True
+            self.version += 1
+        fut.set_result( value )
+        if again:
+            self.refresh()
 
 
 class SpotifyAPIManager( object ):
     """A manager for retrieving information from the Spotify API.
     """
+    def __init__( self, playlists_ttl=300.0, metadata_store=None, clock=SYSTEM_CLOCK ):
+        """
+        metadata_store:
+            MetadataStore to list the playlists from. The list saved in it
+            by the last run is served straight away at start-up.
+        clock:
+            SystemClock (or VirtualClock, in a simulation) that the
+            manager's waits are in
+        """
+        self.clock = clock
+        self.__metadata_store = metadata_store
+        self.__playlists = CatalogueCache( self.fetch_playlists_list, ttl=playlists_ttl, clock=clock )
+        if metadata_store is not None:
+            names = metadata_store.playlist_names()
+            if names:
+                self.__playlists.seed( names )
+
     def get_playlists_list( self ):
         """Return a list of the user's playlists.
+
+        Served from a cache; only blocks if the list has never been fetched.
+        """
+        return self.__playlists.get()
+
+    def playlists_list_version( self ):
+        """A number that changes whenever a new list of playlists is fetched."""
+        return self.__playlists.current_version()
+
+    def refresh_playlists_list( self ):
+        """Start fetching the list of playlists in the background."""
+        self.__playlists.refresh()
+
+    def invalidate_playlists_list( self ):
+        """The user's playlists have changed; fetch them again."""
+        self.__playlists.invalidate()
+
+    def fetch_playlists_list( self ):
+        """Fetch a list of the user's playlists from Spotify. Slow, unless
+        there is a metadata store, which the jukebox keeps up to date.
         """
-        print "get PL called"
-        print "[get PL list] halting for 5 seconds"
-        time.sleep(5.0)
-        print "[get PL list] done"
-        
+        if self.__metadata_store is not None:
+            # See any changes that are still queued for writing
+            self.__metadata_store.flush( 5.0 )
+            return self.__metadata_store.playlist_names()
+
+        log.debug( "Fetching the playlists list" )
+        self.clock.sleep(5.0)
+
         pllist = ['playlist1','playlist2', 'playlist3',]
-        
+
         return pllist
-        
-    def finish():
+
+    def finish( self ):
         """Finish and tidy up the manager."""
-        pass 
-        # TO DO: stop the PySpotify session?
\ No newline at end of file
+        pass
+        # TO DO: stop the PySpotify session?
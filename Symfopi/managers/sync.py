@@ -0,0 +1,303 @@
+import hmac
+import json
+import socket
+import hashlib
+import threading
+import time
+
+from logs import get_logger, fields
+
+log = get_logger( 'sync' )
+
+# UDP port that followers listen on for the leader
+DEFAULT_SYNC_PORT = 8001
+
+# Seconds before now past which a follower ignores a command's time, so a
+# recorded 'start' cannot be replayed later
+REPLAY_WINDOW = 5.0
+
+
+def encode( msg, secret=None ):
+    """A sync message as a datagram: its JSON, after an HMAC-SHA256 of it
+    with the shared `secret`, if there is one."""
+    data = json.dumps( msg )
+    if secret is None:
+        return data
+    return hmac.new( secret, data, hashlib.sha256 ).hexdigest() + data
+
+
+def decode( data, secret=None ):
+    """The message in a datagram from `encode()`. Raises ValueError if it
+    was not signed with `secret`."""
+    if secret is not None:
+        mac, data = data[:64], data[64:]
+        if not hmac.compare_digest( mac, hmac.new( secret, data, hashlib.sha256 ).hexdigest() ):
+            raise ValueError( "Bad signature" )
+    return json.loads( data )
+
+
+class ClockEstimate( object ):
+    """How a follower's clock relates to the leader's.
+
+    offset:
+        seconds to add to a leader clock time for the follower's clock
+    delay:
+        round-trip network delay of the probe the offset came from
+    """
+
+    __slots__ = ( 'offset', 'delay' )
+
+    def __init__( self, offset, delay ):
+        self.offset = offset
+        self.delay = delay
+
+    def __repr__( self ):
+        return 'ClockEstimate(offset=%.3f ms, delay=%.3f ms)' % ( self.offset * 1000, self.delay * 1000 )
+
+
+def estimate_clock( samples ):
+    """Estimate the clock offset from NTP-style probe timestamps, a list of
+    `(t0, t1, t2, t3)`: leader send, follower receive, follower reply,
+    leader receive. As NTP's clock filter does, the probe with the least
+    round-trip delay is trusted, it being the least held up by queueing
+    on either side. Returns a ClockEstimate, or None without samples."""
+    best = None
+    for t0, t1, t2, t3 in samples:
+        delay = ( t3 - t0 ) - ( t2 - t1 )
+        if best is None or delay < best.delay:
+            best = ClockEstimate( ( ( t1 - t0 ) + ( t2 - t3 ) ) / 2.0, delay )
+    return best
+
+
+class SyncFollower( object ):
+    """Answers a sync leader's clock probes over UDP, and passes on its
+    commands, with their times converted to this node's clock by the
+    leader.
+
+    Only messages from the leader's host are heeded, and with a shared
+    secret, only those signed with it.
+
+    on_start:
+        `on_start( uri, when )`: start playing the track at clock time
+        `when`
+    on_position:
+        `on_position( when, frames )`: the leader will have played `frames`
+        frames of the track by clock time `when`
+    leader:
+        host name or address of the leader
+    secret:
+        key the leader signs its messages with, if any
+    """
+
+    def __init__( self, on_start, on_position, leader, port=DEFAULT_SYNC_PORT, host='', clock=time.time,
+                  secret=None ):
+        self.on_start = on_start
+        self.on_position = on_position
+        self.leader = socket.gethostbyname( leader )
+        self.secret = secret
+        self.clock = clock
+        self.__sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+        self.__sock.bind( ( host, port ) )
+        self.__sock.settimeout( 0.5 )
+        self.address = self.__sock.getsockname()
+        self.__stop_requested = False
+        self.__thread = threading.Thread( target=self.__run, name='sync-follower' )
+        self.__thread.setDaemon( True )
+
+    def start( self ):
+        self.__thread.start()
+
+    def stop( self ):
+        self.__stop_requested = True
+        self.__thread.join()
+        self.__sock.close()
+
+    def __run( self ):
+        while not self.__stop_requested:
+            try:
+                data, addr = self.__sock.recvfrom( 2048 )
+            except socket.timeout:
+                continue
+            received = self.clock()
+            if addr[0] != self.leader:
+                log.warning( "Sync message from %s, not the leader; ignored", addr[0] )
+                continue
+            try:
+                msg = decode( data, self.secret )
+                op = msg['op']
+                if op == 'probe':
+                    reply = { 'op': 'probe_reply', 'seq': msg['seq'], 't0': msg['t0'], 't1': received }
+                    reply['t2'] = self.clock()
+                    self.__sock.sendto( encode( reply, self.secret ), addr )
+                elif msg['at'] < received - REPLAY_WINDOW:
+                    log.warning( "Stale sync message from %s; ignored", addr[0] )
+                elif op == 'start':
+                    self.on_start( msg['uri'], msg['at'] )
+                elif op == 'position':
+                    self.on_position( msg['at'], msg['frames'] )
+            except ValueError as ex:
+                log.warning( "Bad sync message from %s: %s", addr[0], ex )
+            except Exception:
+                log.exception( "Bad sync message from %s", addr[0] )
+
+
+class SyncLeader( object ):
+    """Keeps follower controllers playing in step with this one.
+
+    Estimates each follower's clock offset with NTP-style probes over UDP,
+    tells followers when to start a track in their own clock, and sends
+    them this node's playback position now and then, from which they
+    correct drift (see DriftCorrector).
+    """
+
+    def __init__( self, followers, clock=time.time, probes=8, probe_timeout=0.2, secret=None ):
+        """
+        followers:
+            (host, port) addresses of the followers' SyncFollowers
+        probes:
+            probes per estimate; the best one is used
+        secret:
+            key to sign messages with, shared with the followers, if any
+        """
+        # By address, as probe replies come from
+        self.followers = [ ( socket.gethostbyname( host ), port ) for host, port in followers ]
+        self.clock = clock
+        self.secret = secret
+        self.probes = probes
+        self.probe_timeout = probe_timeout
+        self.estimates = {}        # follower address -> ClockEstimate
+        self.__sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+        self.__sock.bind( ( '', 0 ) )
+        self.__lock = threading.Lock()
+        self.__seq = 0
+        self.__periodic = None
+
+    def measure( self, addr ):
+        """Probe a follower's clock. Returns a ClockEstimate, or None if no
+        probe was answered."""
+        samples = []
+        with self.__lock:
+            for i in xrange( self.probes ):
+                self.__seq += 1
+                seq = self.__seq
+                t0 = self.clock()
+                self.__sock.sendto( encode( { 'op': 'probe', 'seq': seq, 't0': t0 }, self.secret ), addr )
+                deadline = t0 + self.probe_timeout
+                while True:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        break
+                    self.__sock.settimeout( remaining )
+                    try:
+                        data, reply_addr = self.__sock.recvfrom( 2048 )
+                    except socket.timeout:
+                        break
+                    t3 = self.clock()
+                    if reply_addr != addr:
+                        continue
+                    try:
+                        reply = decode( data, self.secret )
+                    except ValueError:
+                        log.warning( "Bad probe reply from sync follower", extra=fields( follower='%s:%d' % addr ) )
+                        continue
+                    if reply.get( 'seq' ) == seq:
+                        samples.append( ( reply['t0'], reply['t1'], reply['t2'], t3 ) )
+                        break
+                    # else a late reply to an earlier probe
+        estimate = estimate_clock( samples )
+        if estimate is None:
+            log.warning( "No reply from sync follower", extra=fields( follower='%s:%d' % addr ) )
+        else:
+            self.estimates[addr] = estimate
+        return estimate
+
+    def measure_all( self ):
+        """Probe every follower. Returns the `estimates` dict."""
+        for addr in self.followers:
+            self.measure( addr )
+        return self.estimates
+
+    def __send( self, msg_func ):
+        for addr in self.followers:
+            estimate = self.estimates.get( addr )
+            if estimate is not None:
+                self.__sock.sendto( encode( msg_func( estimate.offset ), self.secret ), addr )
+
+    def schedule_start( self, uri, lead=0.5 ):
+        """Tell the followers to start the track `lead` seconds from now.
+        Returns the start time, in this node's clock, for this node to
+        start at too.
+
+        Never probes, so never waits on the network: the clock estimates
+        are those `start()` keeps up to date in the background, and a
+        follower without one yet, such as one that cannot be reached, is
+        left out."""
+        missing = [ addr for addr in self.followers if addr not in self.estimates ]
+        if missing:
+            log.warning( "No clock estimate yet for sync followers; not starting them",
+                         extra=fields( followers=','.join( '%s:%d' % addr for addr in missing ) ) )
+        when = self.clock() + lead
+        self.__send( lambda offset: { 'op': 'start', 'uri': uri, 'at': when + offset } )
+        return when
+
+    def send_position( self, when, frames ):
+        """Tell the followers this node will have played `frames` frames by
+        clock time `when`."""
+        self.__send( lambda offset: { 'op': 'position', 'at': when + offset, 'frames': frames } )
+
+    def start( self, position_func, interval=1.0 ):
+        """Probe the followers straight away, then every `interval` seconds
+        probe them again, to follow their clocks' drift, and send them
+        `position_func( when )`, this node's position at clock time `when`,
+        unless it is None. Probes wait on the network, so they run on a
+        thread of their own rather than on a Scheduler."""
+        stop = threading.Event()
+
+        def run():
+            self.measure_all()
+            while not stop.wait( interval ):
+                self.measure_all()
+                now = self.clock()
+                frames = position_func( now )
+                if frames is not None:
+                    self.send_position( now, frames )
+        thread = threading.Thread( target=run, name='sync-leader' )
+        thread.setDaemon( True )
+        thread.start()
+        self.__periodic = ( stop, thread )
+
+    def stop( self ):
+        if self.__periodic is not None:
+            stop, thread = self.__periodic
+            stop.set()
+            thread.join()
+            self.__periodic = None
+        self.__sock.close()
+
+
+class DriftCorrector( object ):
+    """Keeps a follower's audio output in step with the positions its
+    leader sends: `position` is the SyncFollower's `on_position`."""
+
+    def __init__( self, output, threshold_ms=2.0 ):
+        """
+        output:
+            the BufferedAudioOutput to correct
+        threshold_ms:
+            skew below which no correction is made
+        """
+        self.output = output
+        self.threshold_ms = threshold_ms
+        self.last_skew_ms = None
+
+    def position( self, when, frames ):
+        own = self.output.position_at( when )
+        rate = self.output.sample_rate
+        if own is None or not rate:
+            return
+        skew = own - frames
+        self.last_skew_ms = skew * 1000.0 / rate
+        if abs( self.last_skew_ms ) >= self.threshold_ms:
+            self.output.correct_drift( skew )
+        else:
+            self.output.correct_drift( 0 )
@@ -0,0 +1,139 @@
+import collections
+import time
+import logging
+import threading
+import Queue
+
+
+class WorkerPoolFull( RuntimeError ):
+    pass
+
+
+class Future( object ):
+    """A minimal stand-in for a future: a result that some other thread will
+    provide at a later point.
+
+    Done-callbacks are called with the future as their only argument, on
+    whichever thread completes the future (or immediately, on the calling
+    thread, if the future is already done).
+    """
+
+    def __init__( self ):
+        self.__cond = threading.Condition()
+        self.__done = False
+        self.__result = None
+        self.__exception = None
+        self.__callbacks = []
+
+    def done( self ):
+        return self.__done
+
+    def set_result( self, result ):
+        self.__complete( result, None )
+
+    def set_exception( self, exception ):
+        self.__complete( None, exception )
+
+    def __complete( self, result, exception ):
+        with self.__cond:
+            if self.__done:
+                return
+            self.__result = result
+            self.__exception = exception
+            self.__done = True
+            callbacks, self.__callbacks = self.__callbacks, []
+            self.__cond.notify_all()
+        for cb in callbacks:
+            cb( self )
+
+    def add_done_callback( self, func ):
+        with self.__cond:
+            if not self.__done:
+                self.__callbacks.append( func )
+                return
+        func( self )
+
+    def wait( self, timeout=None ):
+        """Block until the future completes or `timeout` seconds pass.
+        Returns True if the future is done."""
+        with self.__cond:
+            if timeout is None:
+                while not self.__done:
+                    self.__cond.wait()
+            else:
+                deadline = time.time() + timeout
+                while not self.__done:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.__cond.wait( remaining )
+            return self.__done
+
+    def exception( self, timeout=None ):
+        self.wait( timeout )
+        return self.__exception
+
+    def result( self, timeout=None ):
+        """Return the result, re-raising the exception the future was
+        completed with, if any."""
+        if not self.wait( timeout ):
+            raise RuntimeError( "Future not completed within %s seconds" % timeout )
+        if self.__exception is not None:
+            raise self.__exception
+        return self.__result
+
+
+class WorkerPool( object ):
+    """A fixed number of daemon threads that run submitted functions.
+
+    The backlog of waiting work is bounded; submitting to a full pool raises
+    WorkerPoolFull rather than queueing without limit.
+    """
+
+    def __init__( self, num_workers=4, max_backlog=64, name='worker' ):
+        self.__tasks = Queue.Queue( max_backlog )
+        self.__threads = []
+        for i in xrange( num_workers ):
+            t = threading.Thread( target=self.__work, name='%s-%d' % (name, i) )
+            t.setDaemon( True )
+            t.start()
+            self.__threads.append( t )
+
+    def submit( self, func, *args, **kwargs ):
+        """Queue `func` to be called on a worker thread. Returns a Future."""
+        fut = Future()
+        try:
+            self.__tasks.put_nowait( (fut, func, args, kwargs) )
+        except Queue.Full:
+            raise WorkerPoolFull( "Worker pool backlog is full" )
+        return fut
+
+    def backlog( self ):
+        return self.__tasks.qsize()
+
+    def __work( self ):
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                return
+            fut, func, args, kwargs = task
+            try:
+                ret = func( *args, **kwargs )
+            except BaseException as ex:
+                fut.set_exception( ex )
+            else:
+                fut.set_result( ret )
+
+    def shutdown( self, wait=False ):
+        """Stop the workers once the work already queued has been done.
+
+        Workers are daemon threads, so a backlog that is too full to take the
+        stop markers does not hold up interpreter exit."""
+        for t in self.__threads:
+            try:
+                self.__tasks.put_nowait( None )
+            except Queue.Full:
+                break
+        if wait:
+            for t in self.__threads:
+                t.join()
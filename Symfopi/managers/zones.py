@@ -0,0 +1,80 @@
+import collections
+import threading
+
+from logs import get_logger
+
+log = get_logger( 'zones' )
+
+
+class Zone( object ):
+    """A room served by the controller: its own playback manager, and so its
+    own play queue and playback state, and its own motion manager."""
+
+    def __init__( self, name, playback_manager, motion_manager ):
+        self.name = name
+        self.playback_manager = playback_manager
+        self.motion_manager = motion_manager
+
+    def status( self ):
+        """Return a JSON-able dict of the zone's state."""
+        return { 'name': self.name,
+                 'playing': self.playback_manager.is_playing(),
+                 'motion_control': self.motion_manager.is_enabled() }
+
+    def finish( self ):
+        self.motion_manager.finish()
+        self.playback_manager.finish()
+
+
+class ZoneRegistry( object ):
+    """The zones hosted by one controller, by name, in the order added.
+
+    The first zone added is the default one, used by requests that do not
+    name a zone.
+    """
+
+    def __init__( self ):
+        self.__zones = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def add( self, zone ):
+        with self.__lock:
+            if zone.name in self.__zones:
+                raise ValueError( "Zone '%s' already exists" % zone.name )
+            self.__zones[zone.name] = zone
+        log.info( "Added zone %s", zone.name )
+
+    def remove( self, name ):
+        """Remove and return a zone; it is not finished."""
+        with self.__lock:
+            return self.__zones.pop( name )
+
+    def get( self, name=None ):
+        """Return the zone called `name`, or the default zone if `name` is
+        None. Raises KeyError if there is no such zone."""
+        with self.__lock:
+            if name is None:
+                if not self.__zones:
+                    raise KeyError( "No zones" )
+                return next( self.__zones.itervalues() )
+            return self.__zones[name]
+
+    def default( self ):
+        return self.get()
+
+    def names( self ):
+        with self.__lock:
+            return list( self.__zones.keys() )
+
+    def __iter__( self ):
+        with self.__lock:
+            return iter( list( self.__zones.values() ) )
+
+    def __len__( self ):
+        return len( self.__zones )
+
+    def finish( self ):
+        """Finish every zone, the default zone, which holds the session
+        the others share, last."""
+        for zone in reversed( list( self ) ):
+            zone.finish()